@@ -8,7 +8,8 @@ from django.utils.cache import add_never_cache_headers, patch_cache_control
 from mlarchive.archive import actions
 from mlarchive.archive.utils import jsonapi
 from mlarchive.archive.models import Message
-from mlarchive.archive.query_utils import get_cached_query, get_order_fields, get_qdr_kwargs
+from mlarchive.archive.query_utils import (get_cached_query, get_order_fields, get_qdr_kwargs,
+    get_window_items, parse_sort_values, run_search_after, update_result_window)
 from mlarchive.utils.decorators import check_access, superuser_only, check_ajax_list_access
 
 
@@ -58,6 +59,7 @@ def ajax_messages(request):
     '''Ajax function to retrieve more messages from queryset.
     referenceitem: index of the last/first message displayed
     referenceid: message.pk of last/first message displayed
+    sortvalues: sort values of the last/first search result displayed, JSON
     '''
     qid = request.GET.get('qid')
     browselist = request.GET.get('browselist')
@@ -73,7 +75,12 @@ def ajax_messages(request):
         queryid, query = get_cached_query(request)
         if not query:
             return HttpResponse(status=404)
-        results = get_query_results(query, referenceitem, direction)
+        sort_values = parse_sort_values(request.GET.get('sortvalues'), query)
+        results = list(get_query_results(query, referenceitem, direction, sort_values) or [])
+        # a short buffer reached the start or end of the results
+        short = len(results) < settings.SEARCH_SCROLL_BUFFER_SIZE
+        update_result_window(queryid, get_window_items(results),
+                             first=short and direction == 'previous', last=short and direction == 'next')
 
     elif browselist:
         # if browselist and special order fields
@@ -98,11 +105,15 @@ def ajax_messages(request):
         'browse_list': browselist})
 
 
-def get_query_results(query, referenceitem, direction):
+def get_query_results(query, referenceitem, direction, sort_values=None):
     '''Returns a set of messages from query using direction: next or previous
-    from the referenceitem, which is the 1 based index of the query
+    from the referenceitem, which is the 1 based index of the query.  With the
+    sort_values of the reference result use search_after, which unlike from / size
+    costs the same however far the user has scrolled
     '''
     buffer = settings.SEARCH_SCROLL_BUFFER_SIZE
+    if sort_values and direction in ('next', 'previous'):
+        return run_search_after(query, sort_values, buffer, reverse=direction == 'previous')
     if direction == 'next':
         query = query[referenceitem:referenceitem + buffer]
         return query.execute()
@@ -139,19 +150,24 @@ def get_browse_results_gbt(reference_message, direction):
     vice versa.
     '''
     buffer = settings.SEARCH_SCROLL_BUFFER_SIZE
-    results = []
+    threads = []
+    count = 0
     if direction == 'next':
         thread = reference_message.thread.get_previous()
-        while len(results) < buffer and thread:
-            results.extend(thread.message_set.order_by('thread_order'))
+        while count < buffer and thread:
+            threads.append(thread)
+            count += thread.message_count
             thread = thread.get_previous()
     elif direction == 'previous':
         thread = reference_message.thread.get_next()
-        while len(results) < buffer and thread:
-            # prepend to results
-            results = list(thread.message_set.order_by('thread_order')) + results
+        while count < buffer and thread:
+            threads.append(thread)
+            count += thread.message_count
             thread = thread.get_next()
-    return results
+    # one query for the messages of all threads, using Thread.message_count to
+    # know when there are enough
+    results = Message.objects.filter(thread__in=threads).order_by('-thread__date', 'thread_id', 'thread_order')
+    return list(results)
 
 
 def get_browse_results_date(reference_message, direction):
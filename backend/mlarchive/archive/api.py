@@ -19,7 +19,9 @@ from django.utils.decorators import method_decorator
 
 from mlarchive.exceptions import HttpJson400, HttpJson404
 from mlarchive.archive.models import Message, EmailList, Subscriber
+from mlarchive.archive.import_jobs import create_job, get_job, get_job_chunks, get_job_status
 from mlarchive.archive.mail import archive_message
+from mlarchive.archive.tasks import queue_import_batch
 from mlarchive.utils.decorators import require_api_key
 
 import logging
@@ -276,3 +278,112 @@ class ImportMessageView(View):
             return HttpResponse(status=201)
         else:
             return self._err(400, 'archive_message error')
+
+
+_import_batch_item_json_validator = jsonschema.Draft202012Validator(
+    schema=dict(_import_message_json_validator.schema, required=["list_name", "message"])
+)
+
+
+@method_decorator(require_api_key, name='dispatch')
+@method_decorator(csrf_exempt, name='dispatch')
+class ImportMessageBatchView(View):
+    '''An API to import a batch of messages asynchronously.
+    Expect a POST request with either a JSON array (Content-Type application/json)
+    or newline delimited JSON (Content-Type application/x-ndjson) of objects:
+    list_name: the email list name
+    list_visibility: public (default) or private
+    message: base64 encoded email message
+    and X-API-Key header
+
+    Messages are spooled to IMPORT_DIR and archived by Celery tasks.  Returns 202
+    with the job id, use ImportMessageBatchStatusView to get the outcomes.  The
+    job is kept even if the tasks can't be queued, they are queued later.
+    '''
+    http_method_names = ['post']
+
+    def _err(self, code, text):
+        return HttpResponse(text, status=code, content_type="text/plain")
+
+    def get_payload(self, request):
+        '''Returns list of message objects from request body.  Raises ValueError'''
+        if request.content_type == "application/json":
+            payload = json.loads(request.body)
+            if not isinstance(payload, list):
+                raise ValueError('JSON payload must be an array')
+            return payload
+        lines = request.body.decode('utf8').splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def post(self, request, **kwargs):
+
+        if request.content_type not in ("application/json", "application/x-ndjson"):
+            return self._err(415, "Content-Type must be application/json or application/x-ndjson")
+
+        # Validate
+        try:
+            payload = self.get_payload(request)
+        except json.decoder.JSONDecodeError as err:
+            msg = f'JSON parse error at line {err.lineno} col {err.colno}: {err.msg}'
+            logger.error(msg)
+            return self._err(400, msg)
+        except (ValueError, UnicodeDecodeError) as err:
+            msg = f'Error processing request. ({err})'
+            logger.error(msg)
+            return self._err(400, msg)
+
+        if not payload:
+            return self._err(400, 'No messages')
+        if len(payload) > settings.IMPORT_BATCH_MAX_MESSAGES:
+            return self._err(413, f'Too many messages, maximum is {settings.IMPORT_BATCH_MAX_MESSAGES}')
+
+        items = []
+        for index, item in enumerate(payload):
+            try:
+                _import_batch_item_json_validator.validate(item)
+                message = base64.b64decode(item["message"], validate=True)
+            except jsonschema.exceptions.ValidationError as err:
+                msg = f'JSON schema error at item {index} {err.json_path}: {err.message}'
+                logger.error(msg)
+                return self._err(400, msg)
+            except binascii.Error as err:
+                msg = f'Invalid message {index}: bad base64 encoding ({err})'
+                logger.error(msg)
+                return self._err(400, msg)
+            items.append((item["list_name"], item.get("list_visibility", "public"), message))
+
+        # stash messages on disk
+        try:
+            job_id = create_job(items)
+        except OSError as e:
+            msg = str(e)
+            logger.error(msg)
+            return self._err(500, msg)
+
+        # queue tasks.  The job is on disk, any chunks not queued now, ie. the
+        # broker is down, are queued by requeue_import_batch_task
+        try:
+            queue_import_batch(job_id, get_job_chunks(get_job(job_id)))
+        except Exception as err:
+            logger.error(f'Batch import job {job_id} not queued: {err}')
+
+        return JsonResponse({'id': job_id, 'count': len(items)}, status=202)
+
+
+@method_decorator(require_api_key, name='dispatch')
+class ImportMessageBatchStatusView(View):
+    '''An API to get the status of a batch import job.
+
+    Parameters:
+    id:     the job id returned by ImportMessageBatchView
+
+    Outcome of each message is one of queued, archived, duplicate, spam,
+    rejected or failed
+    '''
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        data = get_job_status(request.GET.get('id', ''))
+        if data is None:
+            raise HttpJson404('job not found')
+        return JsonResponse(data)
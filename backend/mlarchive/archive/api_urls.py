@@ -7,4 +7,7 @@ urlpatterns = [
     path('v1/stats/msg_counts/', api.MsgCountView.as_view(), name='api_msg_counts'),
     path('v1/stats/subscriber_counts/', api.SubscriberCountsView.as_view(), name='api_subscriber_counts'),
     path('v1/message/import/', api.ImportMessageView.as_view(), name='api_import_message'),
+    path('v1/message/import/batch/', api.ImportMessageBatchView.as_view(), name='api_import_message_batch'),
+    path('v1/message/import/batch/status/', api.ImportMessageBatchStatusView.as_view(),
+         name='api_import_message_batch_status'),
 ]
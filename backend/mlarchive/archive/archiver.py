@@ -0,0 +1,170 @@
+'''This module implements a persistent archiver service.  It is an alternative to
+spawning bin/archive-mail.py for every incoming message, which pays the cost of
+interpreter startup and django.setup() each time.
+
+The service listens on a UNIX domain socket.  The protocol is one request per
+connection:
+
+client -> server:  a single line of JSON, {"listname": str, "private": bool, "length": int}
+                   followed by exactly "length" bytes of raw message
+server -> client:  a single line containing the archive_message() status, "0" or "1"
+
+Run the server with the "archiver" management command.  Use send_message() or
+bin/call-archives.py as the client.
+
+Anyone who can write to the socket can archive mail to any list, including
+private ones, so it is created with mode settings.ARCHIVER_SOCKET_MODE, 0o660,
+owned by the user running the service and settings.ARCHIVER_SOCKET_GROUP.  The
+client runs as the MTA delivery user, the mailman user for list archivers or
+the owner of the postfix aliases file for pipe aliases, which must be a member
+of that group.
+'''
+
+import grp
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+
+from django.conf import settings
+from django.db import connection
+
+from mlarchive.archive.mail import archive_message
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300       # seconds
+MAX_HEADER_LENGTH = 4096
+
+
+class ProtocolError(Exception):
+    # the request does not conform to the archiver protocol
+    pass
+
+
+# --------------------------------------------------
+# Helper Functions
+# --------------------------------------------------
+
+
+def ensure_connection_usable():
+    '''Long running processes can lose their database connection, ie. database
+    restart.  Close it if it is no longer usable, Django will reconnect on next use.
+    Unlike close_old_connections() this keeps a healthy connection open between
+    requests regardless of CONN_MAX_AGE.
+    '''
+    if connection.connection is not None and not connection.is_usable():
+        logger.warning('archiver: database connection unusable, reconnecting')
+        connection.close()
+
+
+def read_request(rfile):
+    '''Read a request from file object rfile.  Returns tuple (data, listname, private)'''
+    line = rfile.readline(MAX_HEADER_LENGTH)
+    if not line.endswith(b'\n'):
+        raise ProtocolError('incomplete request header')
+    try:
+        header = json.loads(line)
+        listname = header['listname']
+        private = bool(header.get('private', False))
+        length = int(header['length'])
+    except (ValueError, TypeError, KeyError) as error:
+        raise ProtocolError('invalid request header: {}'.format(error))
+    if not listname or length <= 0:
+        raise ProtocolError('invalid request header: {}'.format(header))
+    data = rfile.read(length)
+    if len(data) != length:
+        raise ProtocolError('expected {} bytes, received {}'.format(length, len(data)))
+    return data, listname, private
+
+
+def send_message(data, listname, private=False, socket_path=None, timeout=DEFAULT_TIMEOUT):
+    '''Client side of the protocol.  Sends message bytes to the archiver service
+    and returns the archive_message() status.  Raises OSError if the service is
+    not available.
+    '''
+    socket_path = socket_path or settings.ARCHIVER_SOCKET
+    header = json.dumps({'listname': listname, 'private': private, 'length': len(data)})
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(header.encode('ascii') + b'\n' + data)
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            response = f.readline().strip()
+    if response not in (b'0', b'1'):
+        raise OSError('invalid response from archiver: {}'.format(response))
+    return int(response)
+
+
+# --------------------------------------------------
+# Classes
+# --------------------------------------------------
+
+
+class ArchiverRequestHandler(socketserver.StreamRequestHandler):
+    '''Handles one message per connection'''
+    timeout = DEFAULT_TIMEOUT
+
+    def handle(self):
+        try:
+            data, listname, private = read_request(self.rfile)
+        except (ProtocolError, OSError) as error:
+            logger.error('archiver: bad request [{}]'.format(error))
+            self.server.stats['errors'] += 1
+            self.respond(1)
+            return
+
+        ensure_connection_usable()
+        logger.info('archiver: envelope: {}'.format(data.decode('utf8', errors='ignore').split('\n', 1)[0]))
+        status = archive_message(data, listname.lower(), private=private)
+        logger.info('archive_message exit status: {}'.format(status))
+        self.server.stats['count'] += 1
+        if status:
+            self.server.stats['errors'] += 1
+        self.respond(status)
+
+    def respond(self, status):
+        try:
+            self.wfile.write('{}\n'.format(status).encode('ascii'))
+        except OSError as error:
+            logger.error('archiver: client went away [{}]'.format(error))
+
+
+class ArchiverServer(socketserver.UnixStreamServer):
+    '''Serves requests one at a time, in order received, like the serialized
+    delivery of messages by the MTA.  The process keeps Django, the database
+    connection and the inspector classes loaded between messages.
+    '''
+
+    def __init__(self, socket_path, mode=0o660, group=None):
+        '''Listen on socket_path, with permissions mode and group, a group name
+        or id, or None for the user's default group
+        '''
+        self.socket_path = socket_path
+        self.stats = {'count': 0, 'errors': 0}
+        # remove stale socket left by an unclean shutdown
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        directory = os.path.dirname(socket_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # no wider access than mode between bind and chmod
+        umask = os.umask(0o777 & ~mode)
+        try:
+            super().__init__(socket_path, ArchiverRequestHandler)
+        finally:
+            os.umask(umask)
+        if group is not None:
+            gid = int(group) if str(group).isdigit() else grp.getgrnam(group).gr_gid
+            os.chown(socket_path, -1, gid)
+        os.chmod(socket_path, mode)
+        connection.ensure_connection()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        logger.info('archiver: stopped. stats: {}'.format(self.stats))
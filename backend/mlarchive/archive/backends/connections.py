@@ -0,0 +1,102 @@
+'''Process wide Elasticsearch client.  Creating an Elasticsearch client creates
+its connection pools, so a client per search or per index update means new
+TCP connections for every request.  Use get_client(), which creates one client
+per process on first use and reuses it.
+
+The client is configured by settings.ELASTICSEARCH_CONNECTION:
+
+URL             Elasticsearch URL (required)
+http_auth       (user, password)
+POOL_SIZE       connections kept open per node, for concurrent requests
+TIMEOUT         request timeout in seconds
+KEEP_ALIVE      keep connections open between requests (default True)
+SNIFF           discover the cluster's nodes on start and on connection failure
+SNIFF_INTERVAL  seconds between sniffs when SNIFF is set
+MAX_RETRIES     retries of a failed request on another connection
+KWARGS          any other Elasticsearch() arguments
+
+A forked process, ie. a Celery or gunicorn worker, gets its own client, the
+parent's connections can't be shared.
+'''
+
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from elasticsearch import Elasticsearch
+
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clients = {}           # by connection options
+_pid = None             # process the clients belong to
+
+
+def get_client_kwargs(connection_options):
+    '''Returns dictionary of Elasticsearch() keyword arguments'''
+    kwargs = {}
+    if connection_options.get('http_auth'):
+        kwargs['http_auth'] = connection_options['http_auth']
+    if 'POOL_SIZE' in connection_options:
+        kwargs['maxsize'] = connection_options['POOL_SIZE']
+    if 'TIMEOUT' in connection_options:
+        kwargs['timeout'] = connection_options['TIMEOUT']
+    if 'MAX_RETRIES' in connection_options:
+        kwargs['max_retries'] = connection_options['MAX_RETRIES']
+        kwargs['retry_on_timeout'] = True
+    if not connection_options.get('KEEP_ALIVE', True):
+        kwargs['headers'] = {'Connection': 'close'}
+    if connection_options.get('SNIFF'):
+        kwargs['sniff_on_start'] = True
+        kwargs['sniff_on_connection_fail'] = True
+        kwargs['sniffer_timeout'] = connection_options.get('SNIFF_INTERVAL', 60)
+    kwargs.update(connection_options.get('KWARGS', {}))
+    return kwargs
+
+
+def get_client():
+    '''Returns the process's Elasticsearch client for settings.ELASTICSEARCH_CONNECTION'''
+    global _pid
+    connection_options = settings.ELASTICSEARCH_CONNECTION
+    if 'URL' not in connection_options:
+        raise ImproperlyConfigured("You must specify a 'URL' in your settings for connection Elasticsearch.")
+    # settings may change, ie. in tests
+    key = repr(sorted(connection_options.items()))
+    with _lock:
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = Elasticsearch(connection_options['URL'], **get_client_kwargs(connection_options))
+            _clients[key] = client
+            logger.info('Elasticsearch client created pid:{}'.format(_pid))
+    return client
+
+
+def close_clients():
+    '''Close the process's clients and their connections'''
+    with _lock:
+        for client in _clients.values():
+            client.transport.close()
+        _clients.clear()
+
+
+def get_stats():
+    '''Returns dictionary of the connection statistics of the process's clients:
+    pid, clients, requests sent and connections opened.  With connection reuse
+    requests grows and connections stays at most POOL_SIZE per node
+    '''
+    stats = {'pid': os.getpid(), 'clients': 0, 'requests': 0, 'connections': 0}
+    if _pid != os.getpid():
+        return stats
+    for client in list(_clients.values()):
+        stats['clients'] += 1
+        for connection in client.transport.connection_pool.connections:
+            pool = getattr(connection, 'pool', None)
+            if pool is not None:
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+    return stats
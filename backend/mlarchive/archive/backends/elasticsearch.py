@@ -2,7 +2,7 @@ import logging
 import re
 import six
 
-from elasticsearch import Elasticsearch, TransportError
+from elasticsearch import TransportError
 from elasticsearch.helpers import bulk
 from elasticsearch_dsl import Search, A, Q
 
@@ -11,8 +11,10 @@ from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import force_str
 
+from mlarchive.archive.backends.connections import get_client
 from mlarchive.archive.query_utils import (queries_from_params,
-    filters_from_params, get_order_fields, generate_queryid, parse_query)
+    filters_from_params, get_order_fields, generate_queryid, parse_query,
+    SEARCH_AFTER_TIEBREAKER)
 from mlarchive.archive.utils import get_noauth
 
 logger = logging.getLogger(__name__)
@@ -110,17 +112,10 @@ class ESBackend():
 
     def __init__(self):
         connection_options = settings.ELASTICSEARCH_CONNECTION
-        if 'URL' not in connection_options:
-            raise ImproperlyConfigured("You must specify a 'URL' in your settings for connection Elasticsearch.")
-
         if 'INDEX_NAME' not in connection_options:
             raise ImproperlyConfigured("You must specify a 'INDEX_NAME' in your settings for connection Elasticsearch.")
 
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
+        self.client = get_client()
         self.index_name = connection_options['INDEX_NAME']
         self.log = logging.getLogger(__name__)
         self.mapping = settings.ELASTICSEARCH_INDEX_MAPPINGS
@@ -237,12 +232,7 @@ class ElasticsearchQuery():
     def __init__(self, form, email_list=None, skip_facets=False):
         self.form = form
         self.request = form.request
-        connection_options = settings.ELASTICSEARCH_CONNECTION
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
+        self.client = get_client()
         self.search = Search(using=self.client, index=settings.ELASTICSEARCH_INDEX_NAME)
         self.skip_facets = skip_facets
         self.email_list = email_list
@@ -283,7 +273,7 @@ class ElasticsearchQuery():
             email_list=get_noauth(self.request.user))
 
     def handle_sort(self):
-        fields = get_order_fields(self.request.GET)
+        fields = list(get_order_fields(self.request.GET)) + [SEARCH_AFTER_TIEBREAKER]
         logger.debug('sort fields: {}'.format(fields))
         self.search = self.search.sort(*fields)
 
@@ -0,0 +1,256 @@
+'''This module implements spooling and status for batch message imports, see
+api.ImportMessageBatchView.  Messages are written to disk before the request
+returns and archived later by the import_batch Celery task.
+
+A job is a directory, IMPORT_DIR/batch/[job id], containing:
+
+job.json                the manifest. "items" is a list of {list_name, list_visibility},
+                        "chunk_size" the number of items per import_batch task
+[index].msg             the spooled message of item [index], zero padded
+results-[index].json    outcomes of items processed by the task whose chunk starts
+                        at [index], {item index: outcome}
+claim-[index]           touched when the task of the chunk starting at [index] is
+                        queued, locked by the task while it runs
+
+The job directory is assembled under a temporary name and renamed into place
+once every message is on disk, so a job is either complete or absent.  Chunks
+whose tasks were never queued, or were lost, are found by get_stale_jobs() and
+queued again by the requeue_import_batch_task periodic task.  A chunk may still
+be queued twice, ie. its task waits in a backlog longer than the requeue age,
+so tasks of a chunk run one at a time, under the claim lock, and skip items
+whose outcome is recorded.
+'''
+
+import datetime
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+from mlarchive.archive.mail import archive_message_result
+
+import logging
+logger = logging.getLogger(__name__)
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+QUEUED = 'queued'
+
+
+# --------------------------------------------------
+# Helper Functions
+# --------------------------------------------------
+
+
+def get_batch_dir():
+    return os.path.join(settings.IMPORT_DIR, 'batch')
+
+
+def get_job_dir(job_id):
+    '''Returns the job directory.  Raises ValueError if job_id is not valid'''
+    if not JOB_ID_PATTERN.match(job_id):
+        raise ValueError('invalid job id: {}'.format(job_id))
+    return os.path.join(get_batch_dir(), job_id)
+
+
+def get_message_path(job_dir, index):
+    return os.path.join(job_dir, '{:05d}.msg'.format(index))
+
+
+def get_claim_path(job_dir, start):
+    return os.path.join(job_dir, 'claim-{:05d}'.format(start))
+
+
+def claim_chunk(job_id, start):
+    '''Record that the task of the chunk starting at start has been queued'''
+    path = get_claim_path(get_job_dir(job_id), start)
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def is_locked(path):
+    '''Returns True if a task holds the lock on claim file path'''
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return False
+
+
+def write_durable(path, data):
+    '''Write bytes to path and flush to disk'''
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_json(path, data):
+    '''Atomically replace path with JSON data'''
+    tmp_path = path + '.tmp'
+    write_durable(tmp_path, json.dumps(data).encode('utf8'))
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def create_job(items):
+    '''Spool messages to a new job directory.  items is a list of tuples
+    (list_name, list_visibility, message bytes).  Returns the job id
+    '''
+    job_id = uuid.uuid4().hex
+    batch_dir = get_batch_dir()
+    tmp_dir = os.path.join(batch_dir, '.' + job_id)
+    os.makedirs(tmp_dir)
+    try:
+        manifest = {'id': job_id,
+                    'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'chunk_size': settings.IMPORT_BATCH_CHUNK_SIZE,
+                    'items': []}
+        for index, (list_name, list_visibility, message) in enumerate(items):
+            write_durable(get_message_path(tmp_dir, index), message)
+            manifest['items'].append({'list_name': list_name, 'list_visibility': list_visibility})
+        write_json(os.path.join(tmp_dir, 'job.json'), manifest)
+        os.rename(tmp_dir, get_job_dir(job_id))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info('Batch import job {} spooled {} messages'.format(job_id, len(items)))
+    return job_id
+
+
+def get_job(job_id):
+    '''Returns the job manifest or None if it doesn't exist'''
+    try:
+        path = os.path.join(get_job_dir(job_id), 'job.json')
+    except ValueError:
+        return None
+    if not os.path.exists(path):
+        return None
+    return read_json(path)
+
+
+def get_job_chunks(job):
+    '''Returns list of (start, end) item ranges, one per import_batch task'''
+    chunk_size = job.get('chunk_size', settings.IMPORT_BATCH_CHUNK_SIZE)
+    return [(start, start + chunk_size) for start in range(0, len(job['items']), chunk_size)]
+
+
+def get_stale_jobs(age):
+    '''Returns list of (job id, chunks) of jobs with chunks that have unprocessed
+    items, are not being processed and were claimed, or created if never
+    claimed, more than age seconds ago.  These chunks were never queued or their
+    task was lost
+    '''
+    batch_dir = get_batch_dir()
+    try:
+        names = sorted(os.listdir(batch_dir))
+    except FileNotFoundError:
+        return []
+    cutoff = time.time() - age
+    stale = []
+    for job_id in names:
+        if not JOB_ID_PATTERN.match(job_id):
+            continue
+        job_dir = get_job_dir(job_id)
+        job = get_job(job_id)
+        if job is None:
+            continue
+        created = os.path.getmtime(os.path.join(job_dir, 'job.json'))
+        results = get_job_results(job_id)
+        chunks = []
+        for start, end in get_job_chunks(job):
+            if all(i in results for i in range(start, min(end, len(job['items'])))):
+                continue
+            path = get_claim_path(job_dir, start)
+            claimed = os.path.getmtime(path) if os.path.exists(path) else created
+            if claimed > cutoff or is_locked(path):
+                continue
+            chunks.append((start, end))
+        if chunks:
+            stale.append((job_id, chunks))
+    return stale
+
+
+def get_job_results(job_id):
+    '''Returns dictionary of outcomes, {item index: outcome}, for processed items'''
+    job_dir = get_job_dir(job_id)
+    results = {}
+    for name in os.listdir(job_dir):
+        if name.startswith('results-') and name.endswith('.json'):
+            results.update({int(k): v for k, v in read_json(os.path.join(job_dir, name)).items()})
+    return results
+
+
+def get_job_status(job_id):
+    '''Returns dictionary describing job progress and per-message outcomes, or None
+    if the job doesn't exist
+    '''
+    job = get_job(job_id)
+    if job is None:
+        return None
+    results = get_job_results(job_id)
+    messages = []
+    counts = {}
+    for index, item in enumerate(job['items']):
+        outcome = results.get(index, QUEUED)
+        counts[outcome] = counts.get(outcome, 0) + 1
+        messages.append({'index': index,
+                         'list_name': item['list_name'],
+                         'status': outcome})
+    if not results:
+        status = QUEUED
+    elif len(results) < len(messages):
+        status = 'running'
+    else:
+        status = 'complete'
+    return {'id': job_id,
+            'created': job['created'],
+            'status': status,
+            'total': len(messages),
+            'counts': counts,
+            'messages': messages}
+
+
+def process_job(job_id, start, end):
+    '''Archive job items start through end - 1.  Outcomes are saved after each
+    message, items already processed are skipped, so the task can be retried.
+    Holds the lock on the chunk's claim file, a second task of the chunk waits
+    and then skips the items processed by the first.
+    '''
+    job = get_job(job_id)
+    if job is None:
+        logger.error('Batch import job {} not found'.format(job_id))
+        return
+    job_dir = get_job_dir(job_id)
+    results_path = os.path.join(job_dir, 'results-{:05d}.json'.format(start))
+    with open(get_claim_path(job_dir, start), 'a') as claim:
+        fcntl.flock(claim, fcntl.LOCK_EX)
+        # read under the lock, another task may have processed items
+        results = read_json(results_path) if os.path.exists(results_path) else {}
+        for index in range(start, min(end, len(job['items']))):
+            if str(index) in results:
+                continue
+            item = job['items'][index]
+            with open(get_message_path(job_dir, index), 'rb') as f:
+                data = f.read()
+            outcome = archive_message_result(
+                data,
+                item['list_name'],
+                private=bool(item['list_visibility'] == 'private'))
+            logger.info('Batch import job {} message {}: {}'.format(job_id, index, outcome))
+            results[str(index)] = outcome
+            write_json(results_path, results)
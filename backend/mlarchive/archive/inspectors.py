@@ -5,10 +5,18 @@ The value of the entry is a dictionary of options.
 
 Supported Options:
 "includes": a list of list names to act upon. If not present acts on all lists
+"check_only": if True raise the error without handling the file, ie. saving to _spam
+
+The setting is compiled once into a Pipeline, see get_pipeline().  Inspectors which
+only look at message headers (header_only = True) run first, before the message
+body is parsed or the database is queried.
 '''
 
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
 class InspectorMessage(Exception):
@@ -39,12 +47,14 @@ class InspectorMeta(type):
 class Inspector(object, metaclass=InspectorMeta):
     '''The base class for inspector classes.  Takes a MessageWrapper object and listname
     (string).  Inherit from this class and implement has_condition(), handle_file(),
-    raise_error() methods.  Call inspect() to run inspection.'''
+    raise_error() methods.  Call inspect() to run inspection.  Set header_only if
+    has_condition() uses nothing but message_wrapper.headers and msgid.'''
+    header_only = False
 
     def __init__(self, message_wrapper, options=None):
         self.message_wrapper = message_wrapper
         self.listname = message_wrapper.listname
-        if options:
+        if options is not None:
             self.options = options
         else:
             self.options = settings.INSPECTORS.get(self.__class__.__name__)
@@ -85,8 +95,10 @@ class SpamInspector(Inspector):
 class ListIdSpamInspector(SpamInspector):
     '''Checks for missing or bogus List-Id header (doesn't contain listname).  If so,
     message is spam (has_condition = True)'''
+    header_only = True
+
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.message_wrapper.headers.get('List-Id')
         if listid and self.listname in listid:
             return False
         else:
@@ -95,8 +107,10 @@ class ListIdSpamInspector(SpamInspector):
 
 class ListIdExistsSpamInspector(SpamInspector):
     '''Checks for missing List-Id header.  If so, message is spam (has_condition = True)'''
+    header_only = True
+
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.message_wrapper.headers.get('List-Id')
         if listid is None:
             return True
         else:
@@ -105,23 +119,29 @@ class ListIdExistsSpamInspector(SpamInspector):
 
 class SpamStatusSpamInspector(SpamInspector):
     '''Checks for SpamStatus == Yes'''
+    header_only = True
+
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Status', '').startswith('Yes')
+        return self.message_wrapper.headers.get('X-Spam-Status', '').startswith('Yes')
 
 
 class SpamLevelSpamInspector(SpamInspector):
     '''Checks for SpamLevel >= *****'''
+    header_only = True
+
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Level', '').startswith('*****')
+        return self.message_wrapper.headers.get('X-Spam-Level', '').startswith('*****')
 
 
 class NoArchiveInspector(Inspector):
     '''Checks for no archive headers'''
+    header_only = True
+
     def has_condition(self):
-        keys = self.message_wrapper.email_message.keys()
+        keys = self.message_wrapper.headers.keys()
         if 'X-No-Archive' in keys:
             return True
-        value = self.message_wrapper.email_message.get('X-Archive', '')
+        value = self.message_wrapper.headers.get('X-Archive', '')
         if value.lower() == 'no':
             return True
         return False
@@ -136,6 +156,64 @@ class NoArchiveInspector(Inspector):
 
 class LongMessageIDSpamInspector(SpamInspector):
     '''Checks if the Message-ID header exceeds max length'''
+    header_only = True
+
     def has_condition(self):
-        msgid = self.message_wrapper.email_message.get('Message-ID')
+        msgid = self.message_wrapper.headers.get('Message-ID')
         return len(msgid) > 998
+
+
+class Pipeline(object):
+    '''The inspectors of an INSPECTORS setting, resolved and ordered once.  Header
+    only inspectors come first, otherwise settings order is kept.  "includes" are
+    made sets, and the inspectors that apply to a list are cached per list name.
+    '''
+    def __init__(self, config):
+        inspectors = []
+        for name, options in config.items():
+            try:
+                klass = Inspector.registry[name.lower()]
+            except KeyError:
+                raise ImproperlyConfigured('Unknown inspector: {}'.format(name))
+            options = dict(options or {})
+            if 'includes' in options:
+                options['includes'] = frozenset(options['includes'])
+            inspectors.append((klass, options))
+        # sort is stable
+        self.inspectors = sorted(inspectors, key=lambda item: not item[0].header_only)
+        self._lists = {}
+
+    def get_inspectors(self, listname, header_only):
+        '''Returns tuple of (class, options) that act on list'''
+        key = (listname, header_only)
+        if key not in self._lists:
+            self._lists[key] = tuple(
+                (klass, options) for klass, options in self.inspectors
+                if klass.header_only == header_only and listname in options.get('includes', (listname,)))
+        return self._lists[key]
+
+    def inspect(self, message_wrapper, header_only):
+        '''Run the header only, or the remaining, inspectors.  Raises an
+        InspectorMessage if the message should not be archived
+        '''
+        for klass, options in self.get_inspectors(message_wrapper.listname, header_only):
+            klass(message_wrapper, options).inspect()
+
+
+_pipeline = None
+
+
+def get_pipeline():
+    '''Returns the Pipeline of settings.INSPECTORS'''
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = Pipeline(getattr(settings, 'INSPECTORS', {}))
+    return _pipeline
+
+
+@receiver(setting_changed)
+def reset_pipeline(setting, **kwargs):
+    '''Recompile when INSPECTORS is overridden, ie. in tests'''
+    global _pipeline
+    if setting == 'INSPECTORS':
+        _pipeline = None
@@ -3,36 +3,62 @@ import datetime
 import email
 import glob
 import hashlib
+import itertools
+import json
 import mailbox
+import mmap
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import traceback
 import uuid
-from collections import deque
+from collections import OrderedDict
 from email import policy as email_policy
+from email.parser import BytesHeaderParser
 from email.utils import getaddresses, make_msgid, parsedate_to_datetime
 from io import StringIO
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 
 from mlarchive.archive.models import (Attachment, EmailList, Legacy, Message,
-    Thread, get_in_reply_to_message, is_attachment)
+    Thread, get_thread_summary_expressions, is_attachment)
 from mlarchive.archive.management.commands._mimetypes import CONTENT_TYPES, UNKNOWN_CONTENT_TYPE
 from mlarchive.archive.inspectors import *      # noqa
-from mlarchive.archive.thread import compute_thread, reconcile_thread, parse_message_ids
+from mlarchive.archive.signals import messages_bulk_saved
+from mlarchive.archive.storage import compress, get_write_path
+from mlarchive.archive.thread import (MessageList, MessageQuerySet, compute_thread, insert_message,
+    reconcile_thread, parse_message_ids)
+from mlarchive.archive.timing import Profile, Timings, activate
 from mlarchive.utils.decorators import check_datetime
 from mlarchive.utils.encoding import decode_safely, decode_rfc2047_header, get_filename
 
 import logging
 logger = logging.getLogger(__name__)
+# one JSON line of stage timings per message archived, see archive_message_result()
+timing_logger = logging.getLogger('mlarchive.timing')
 
 NO_REFOLD_POLICY = email_policy.SMTP.clone(refold_source='none')
+DEFAULT_BATCH_SIZE = 500
+CHECKPOINT_INTERVAL = 100      # messages between checkpoints when not batching
+THREAD_CACHE_SIZE = 10000      # entries per list, see ThreadCache
+THREAD_CACHE_TTL = 300         # seconds an entry is used, see ThreadCache
+
+# archive_message_result() outcomes
+ARCHIVED = 'archived'
+DUPLICATE = 'duplicate'
+SPAM = 'spam'
+REJECTED = 'rejected'
+FAILED = 'failed'
 
 '''
 Notes on character encoding.
@@ -73,6 +99,8 @@ SEPARATOR_PATTERNS = [re.compile(b'^Return-[Pp]ath:'),
                       re.compile(b'^20[0-1][0-9]$')]      # odd one, see forces
 
 HEADER_PATTERN = re.compile(r'^[\041-\071\073-\176]{1,}:')
+MBOX_FROM_PATTERN = re.compile(b'^From ', re.MULTILINE)
+MMDF_DELIMITER_PATTERN = re.compile(b'^\x01\x01\x01\x01\n', re.MULTILINE)
 SENT_PATTERN = re.compile(
     r'^(Sun|Mon|Tue|Wed|Thu|Fri|Sat)\s+(\d{1,2})/(\d{1,2})/(\d{4,4})\s+(\d{1,2}):(\d{2,2})\s+(AM|PM)')
 MSGID_PATTERN = re.compile(r'<([^>]+)>')                    # [^>] means any character except ">"
@@ -128,6 +156,17 @@ def archive_message(data, listname, private=False, save_failed=True):
     private: boolean, True if the list is private.  Only used if this is a new list
     save_failed: default is True, set to false when calling from compare utility script
     """
+    result = archive_message_result(data, listname, private=private, save_failed=save_failed)
+    if result == FAILED:
+        return 1    # TODO: other error?
+    return 0
+
+
+def archive_message_result(data, listname, private=False, save_failed=True):
+    """Same as archive_message() but returns the outcome, one of ARCHIVED,
+    DUPLICATE, SPAM, REJECTED or FAILED
+    """
+    mw = None
     try:
         assert isinstance(data, bytes)
         mw = MessageWrapper.from_bytes(data, listname, private=private)
@@ -135,23 +174,43 @@ def archive_message(data, listname, private=False, save_failed=True):
     except DuplicateMessage as error:
         # if DuplicateMessage it's already been saved to _dupes
         logger.warning('Archive message failed [{0}]'.format(error.args))
-        return 0
+        log_timings(mw, listname, DUPLICATE)
+        return DUPLICATE
     except InspectorMessage as error:
         # if SpamMessage it's already been saved to _spam
         logger.info('Message not archived. [{0}]'.format(error.args))
-        return 0
+        outcome = SPAM if isinstance(error, SpamMessage) else REJECTED
+        log_timings(mw, listname, outcome)
+        return outcome
     except Exception as error:
+        log_timings(mw, listname, FAILED)
         traceback.print_exc(file=sys.stdout)
         logger.error('Archive message failed [{0}]'.format(error.args))
         msg = email.message_from_bytes(data)
         if not save_failed:
-            return 1
+            return FAILED
         if msg:
             save_failed_msg(msg, listname, error)
         else:
             save_failed_msg(data, listname, error)
-        return 1    # TODO: other error?
-    return 0
+        return FAILED
+    log_timings(mw, listname, ARCHIVED)
+    return ARCHIVED
+
+
+def log_timings(mw, listname, outcome):
+    """Log stage timings of the message as structured fields, formatted as JSON by
+    the "timing" handler, see settings.LOGGING
+    """
+    if mw is None:
+        return
+    timing_logger.info('message timing', extra={
+        'list': listname,
+        'msgid': mw.msgid,
+        'outcome': outcome,
+        'size': len(mw.bytes),
+        'total_ms': round(mw.timings.total * 1000, 3),
+        'stages_ms': mw.timings.as_ms()})
 
 
 def clean_spaces(s):
@@ -267,6 +326,17 @@ def get_from(msg):
             return frm
 
 
+def get_hash(msgid, listname):
+    """Returns the message hashcode, a SHA-1 digest of the Message-ID and listname.
+    Similar to the popular Web Email Archive, mail-archive.com
+    see: https://www.mail-archive.com/faq.html#msgid
+    """
+    sha = hashlib.sha1(msgid.encode('utf8'))
+    sha.update(listname.encode('utf8'))
+    b64 = base64.urlsafe_b64encode(sha.digest())
+    return b64.decode('utf8')
+
+
 def get_header_date(msg):
     """Returns the date, a naive or aware datetime object, from the message header.
     First checks the 'Date:' field, then 'Sent:'.  Returns None if it can't locate
@@ -303,7 +373,7 @@ def get_mb(path):
             line = f.readline()
         if line.startswith(b'From '):                # most common mailbox type, MBOX
             # return CustomMbox(path, separator=MBOX_SEPARATOR_PATTERN)
-            return mailbox.mbox(path)
+            return MappedMbox(path)
         elif line == b'\x01\x01\x01\x01\n':          # next most common type, MMDF
             return CustomMMDF(path)
         # TODO currently not supported
@@ -316,6 +386,13 @@ def get_mb(path):
     raise UnknownFormat('%s, %s' % (path, line))
 
 
+def get_thread_cache(email_list):
+    """Returns the process wide ThreadCache of email_list"""
+    if email_list.pk not in _thread_caches:
+        _thread_caches[email_list.pk] = ThreadCache(email_list)
+    return _thread_caches[email_list.pk]
+
+
 def get_received_date(msg):
     """Returns the date from the received header field.  Date field is last field
     using semicolon as separator, per RFC 2821 Section 4.4.  Use the most recent
@@ -362,6 +439,72 @@ def save_failed_msg(data, listname, error):
     write_file(os.path.join(path, filename), output)
 
 
+def get_mbox_stop(buf, pos):
+    """Returns the end of the mbox message that precedes offset pos, the start of
+    the next message or end of file.  A blank line before pos is not part of the
+    message
+    """
+    if pos >= 1 and buf[pos - 1:pos] == b'\n' and (pos == 1 or buf[pos - 2:pos - 1] == b'\n'):
+        return pos - 1
+    return pos
+
+
+def scan_mbox(buf):
+    """Generates (start, stop) offsets of the messages in buf, bytes or mmap of an
+    mbox file, as mailbox.mbox would.  Messages start at "From " lines
+    """
+    start = None
+    for match in MBOX_FROM_PATTERN.finditer(buf):
+        if start is not None:
+            yield start, get_mbox_stop(buf, match.start())
+        start = match.start()
+    if start is not None:
+        yield start, get_mbox_stop(buf, len(buf))
+
+
+def scan_mmdf(buf):
+    """Generates (start, stop) offsets of the messages in buf, bytes or mmap of an
+    MMDF file, as mailbox.MMDF would.  Messages are enclosed by "^A^A^A^A" lines
+    """
+    delimiters = MMDF_DELIMITER_PATTERN.finditer(buf)
+    for opening in delimiters:
+        closing = next(delimiters, None)
+        if closing is None:
+            yield opening.end(), len(buf)
+            return
+        yield opening.end(), closing.start() - 1
+
+
+def scan_separator(buf, separator, false_separator=None):
+    """Generates (start, stop) offsets of the messages in buf, bytes or mmap of a
+    mailbox file, as CustomMbox does.  Messages start at lines that match the
+    separator regex, ie. SEPARATOR_PATTERNS, and follow a blank line
+    """
+    candidates = re.compile(separator.pattern, separator.flags | re.MULTILINE)
+    start = None
+    for match in candidates.finditer(buf):
+        pos = match.start()
+        eol = buf.find(b'\n', pos)
+        line = buf[pos:eol + 1] if eol != -1 else buf[pos:]
+        if not separator.match(line) or (false_separator and false_separator.match(line)):
+            continue
+        if pos > 0 and buf[buf.rfind(b'\n', 0, pos - 1) + 1:pos].strip():
+            continue
+        if start is not None:
+            yield start, pos - 1
+        start = pos
+    if start is not None:
+        yield start, len(buf)
+
+
+def set_header(msg, name, value):
+    """Set header name of msg to value, replacing an existing header"""
+    if name in msg:
+        msg.replace_header(name, value)
+    else:
+        msg.add_header(name, value)
+
+
 def call_remote_backup(path):
     """If REMOTE_BACKUP_DIR is defined copies the message specified in path to the
     local backup archive directory, creating subdirectories as needed.  Else checks for
@@ -406,21 +549,31 @@ def subject_is_reply(text):
     return False
 
 
+def make_dirs(directory):
+    """Create directory, and any missing parents, with group write and setgid"""
+    if not os.path.exists(directory):
+        make_dirs(os.path.dirname(directory))
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            return
+        os.chmod(directory, 0o2777)
+
+
 def write_file(path, data):
     """Function to write file to disk.
     - creates directory if it doesn't exist
-    - saves file
+    - saves file, compressed if path has a compression suffix
     - sets mode of file
     - calls external backup script if defined
     """
     assert isinstance(data, bytes)
-    directory = os.path.dirname(path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        os.chmod(directory, 0o2777)
+    make_dirs(os.path.dirname(path))
 
     # convert line endings to crlf
     output = re.sub(b"\r(?!\n)|(?<!\r)\n", b"\r\n", data)
+    # compress if path has a compression suffix, see storage.py
+    output = compress(output, path)
 
     with open(path, 'wb') as f:
         f.write(output)
@@ -467,30 +620,144 @@ def get_message_from_bytes(b, policy):
         return email.message_from_bytes(b, policy=email_policy.compat32)
 
 
+def get_headers_from_bytes(b, policy):
+    """Like get_message_from_bytes() but only parses the headers.  The body is
+    left unparsed as the payload string, much faster for large messages.
+    """
+    msg = BytesHeaderParser(policy=policy).parsebytes(b)
+    try:
+        _ = list(msg.items())
+        return msg
+    except:
+        return BytesHeaderParser(policy=email_policy.compat32).parsebytes(b)
+
+
 # --------------------------------------------------
 # Classes
 # --------------------------------------------------
 
 
-class CustomMMDF(mailbox.MMDF):
+class MappedMailbox(object):
+    """Mixin for single file mailboxes which builds the table of contents by
+    scanning a read-only memory map of the file, rather than reading it line by
+    line.  The scan is lazy, it advances as messages are requested, so iterating
+    the mailbox starts returning messages before the whole file has been scanned.
+    Messages are sliced from the map.  Subclasses implement scan(buf), a generator
+    of (start, stop) offsets.  For reading only, don't use to modify a mailbox.
+    """
+    _mmap = None
+    _scanner = None
+
+    def scan(self, buf):
+        raise NotImplementedError
+
+    def _get_buffer(self):
+        if self._mmap is None:
+            if os.fstat(self._file.fileno()).st_size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mmap = b''            # can't map an empty file
+        return self._mmap
+
+    def _scan_next(self):
+        """Add the next message to the table of contents.  Returns False when the
+        scan is complete
+        """
+        if self._toc is None:
+            self._toc = {}
+            self._next_key = 0
+            self._scanner = self.scan(self._get_buffer())
+        if self._scanner is None:
+            return False
+        try:
+            self._toc[self._next_key] = next(self._scanner)
+        except StopIteration:
+            self._scanner = None
+            self._file_length = len(self._get_buffer())
+            return False
+        self._next_key += 1
+        return True
+
+    def _generate_toc(self):
+        while self._scan_next():
+            pass
+
+    def _lookup(self, key=None):
+        """Return (start, stop) or raise KeyError.  With no key complete the scan"""
+        if key is None:
+            self._generate_toc()
+            return
+        while (self._toc is None or key not in self._toc) and self._scan_next():
+            pass
+        try:
+            return self._toc[key]
+        except KeyError:
+            raise KeyError('No message with key: %s' % key) from None
+
+    def iterkeys(self):
+        """Return an iterator over keys, scanning as it goes"""
+        key = 0
+        while True:
+            try:
+                self._lookup(key)
+            except KeyError:
+                return
+            yield key
+            key += 1
+
+    def _split(self, key):
+        """Returns tuple of offsets (start, end of first line, stop) of message"""
+        start, stop = self._lookup(key)
+        eol = self._get_buffer().find(b'\n', start, stop)
+        return start, (eol + 1 if eol != -1 else stop), stop
+
+    def get_bytes(self, key, from_=False):
+        """Return a bytes representation or raise a KeyError"""
+        start, body, stop = self._split(key)
+        return self._get_buffer()[start if from_ else body:stop]
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = None
+        super().close()
+
+
+class MappedMbox(MappedMailbox, mailbox.mbox):
+    """Standard mbox, the "From " line envelope header starts each message"""
+    def scan(self, buf):
+        return scan_mbox(buf)
+
+    def get_message(self, key):
+        """Return a Message representation or raise a KeyError."""
+        start, body, stop = self._split(key)
+        buf = self._get_buffer()
+        msg = self._message_factory(buf[body:stop])
+        msg.set_from(buf[start + 5:body].rstrip(b'\n').decode('ascii'))
+        return msg
+
+
+class CustomMMDF(MappedMailbox, mailbox.MMDF):
     """Custom implementation of mailbox.MMDF.  The original class from the standard
     library is flawed in that it uses the same get_message() function as mailbox.mbox,
     which consumes the first line of the message as the "From " line envelope header.
     The MMDF format has "^A^A^A^A" postmark that separates messages, but these are
     already excluded in the _toc.
     """
+    def scan(self, buf):
+        return scan_mmdf(buf)
+
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
         start, stop = self._lookup(key)
-        self._file.seek(start)
-        # from_line = self._file.readline().replace(os.linesep, '')
-        string = self._file.read(stop - self._file.tell())
-        msg = self._message_factory(string.replace(os.linesep, '\n'))
-        # msg.set_from(from_line[5:])
-        return msg
+        return self._message_factory(self._get_buffer()[start:stop])
+
+    def get_bytes(self, key, from_=False):
+        start, stop = self._lookup(key)
+        return self._get_buffer()[start:stop]
 
 
-class CustomMbox(mailbox.mbox):
+class CustomMbox(MappedMailbox, mailbox.mbox):
     """Custom mbox class that improves message parsing.  Expects the separator keyword
     argument which is a compiled regex object representing the new message indicator.
 
@@ -509,45 +776,370 @@ class CustomMbox(mailbox.mbox):
     """
     def __init__(self, *args, **kwargs):
         self._separator = kwargs.pop('separator')
-        self._false_separator = re.compile(b'^From .* message (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s.+')
+        self._false_separator = re.compile(b'^From .* message (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\\s.+')
         # can't use super because mbox is old style class
         mailbox.mbox.__init__(self, *args, **kwargs)
 
-    def _generate_toc(self):
-        """Generate key-to-(start, stop) table of contents."""
-        starts, stops = [], []
-        lines = deque(' ', maxlen=2)
-        self._file.seek(0)
-        while True:
-            line_pos = self._file.tell()
-            lines.append(self._file.readline())
-            if self._separator.match(lines[1]) and not lines[0].strip() and not self._false_separator.match(lines[1]):
-                if len(stops) < len(starts):
-                    stops.append(line_pos - len(os.linesep))
-                starts.append(line_pos)
-            elif lines[1] == '':
-                stops.append(line_pos)
-                break
-        self._toc = dict(enumerate(zip(starts, stops)))
-        self._next_key = len(self._toc)
-        self._file_length = self._file.tell()
+    def scan(self, buf):
+        return scan_separator(buf, self._separator, self._false_separator)
 
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
-        has_from = True
-        start, stop = self._lookup(key)
-        self._file.seek(start)
-        from_line = self._file.readline().replace(os.linesep, '')
+        start, body, stop = self._split(key)
+        buf = self._get_buffer()
+        from_line = buf[start:body].rstrip(b'\r\n').decode('ascii', errors='replace')
         if HEADER_PATTERN.match(from_line):
-            self._file.seek(start)              # reset pointer to keep first header line
-            has_from = False
-        string = self._file.read(stop - self._file.tell())
-        msg = self._message_factory(string.replace(os.linesep, '\n'))
-        if has_from:
-            msg.set_from(from_line)
+            # separator is a header line, keep it
+            return self._message_factory(buf[start:stop])
+        msg = self._message_factory(buf[body:stop])
+        msg.set_from(from_line[5:] if from_line.startswith('From ') else from_line)
         return msg
 
 
+class DedupeIndex(object):
+    """In-memory index of the msgids and hashcodes of messages already archived
+    for one list, used by bulk loads to check for duplicates without a database
+    query per message.  Message hashcodes are derived from msgid and listname so
+    the list's own hashcodes are sufficient for the duplicate hash check.  If
+    legacy is True the msgids of the list's Legacy records are loaded too, for
+    the firstrun filter.
+
+    The index is only valid while the loader is the sole writer for the list.
+    MessageWrapper.save() adds each message it saves.  Single message archiving,
+    archive_message(), queries the database instead.
+    """
+    def __init__(self, listname, legacy=False):
+        self.listname = listname
+        messages = Message.objects.filter(email_list__name=listname)
+        self.msgids = set(messages.values_list('msgid', flat=True).iterator())
+        self.hashcodes = set(messages.values_list('hashcode', flat=True).iterator())
+        self.legacy = None
+        if legacy:
+            legacy_msgids = Legacy.objects.filter(email_list_id=listname).values_list('msgid', flat=True)
+            self.legacy = set(legacy_msgids.iterator())
+        logger.info('dedupe index loaded for {}: {} messages'.format(listname, len(self.msgids)))
+
+    def __len__(self):
+        return len(self.msgids)
+
+    def has_msgid(self, msgid):
+        return msgid in self.msgids
+
+    def has_hashcode(self, hashcode):
+        return hashcode in self.hashcodes
+
+    def has_legacy(self, msgid):
+        return msgid in self.legacy
+
+    def add(self, msgid, hashcode):
+        self.msgids.add(msgid)
+        self.hashcodes.add(hashcode)
+
+    def remove(self, msgid, hashcode):
+        self.msgids.discard(msgid)
+        self.hashcodes.discard(hashcode)
+
+
+class ThreadCache(object):
+    """LRU cache of the thread of one list's messages, for threading incoming
+    messages without a query per message id, see MessageWrapper.get_thread().
+    Holds msgid -> (message pk, thread pk) and base_subject -> (date, thread pk)
+    of a message with the subject.  Only messages found are cached.
+
+    One cache per list and process, get_thread_cache(), shared by Loader and
+    the archiver service.  Kept current by the Message save and delete signals
+    and messages_bulk_saved of this process.  Other processes archive and delete
+    messages too, so entries expire after ttl seconds and a subject entry is
+    only used after checking no newer message has the subject.  Entries naming
+    a thread that no longer exists are ignored by the caller.
+    """
+    def __init__(self, email_list, size=THREAD_CACHE_SIZE, ttl=THREAD_CACHE_TTL):
+        self.email_list = email_list
+        self.size = size
+        self.ttl = ttl
+        self.msgids = OrderedDict()     # values are (value, expiry time)
+        self.subjects = OrderedDict()
+
+    def __len__(self):
+        return len(self.msgids)
+
+    def _get(self, table, key):
+        item = table.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del table[key]
+            return None
+        table.move_to_end(key)
+        return value
+
+    def _set(self, table, key, value):
+        table[key] = (value, time.monotonic() + self.ttl)
+        table.move_to_end(key)
+        if len(table) > self.size:
+            table.popitem(last=False)
+
+    def resolve(self, msgids):
+        """Returns dictionary {msgid: (message pk, thread pk) or None} for msgids.
+        Those not cached are looked up with one query.  Message ids used by more
+        than one message of the list are ambiguous and resolve to None
+        """
+        result = {}
+        missing = []
+        for msgid in msgids:
+            result[msgid] = self._get(self.msgids, msgid)
+            if result[msgid] is None:
+                missing.append(msgid)
+        if missing:
+            rows = Message.objects.filter(email_list=self.email_list, msgid__in=missing)
+            found = {}
+            for msgid, pk, thread_id in rows.values_list('msgid', 'pk', 'thread_id'):
+                found[msgid] = None if msgid in found else (pk, thread_id)
+            for msgid, value in found.items():
+                if value is not None:
+                    self._set(self.msgids, msgid, value)
+                    result[msgid] = value
+        return result
+
+    def get_latest_by_subject(self, base_subject, date):
+        """Returns (date, thread pk) of the latest message with base_subject
+        before date, or None.  The cached message is used if an indexed
+        existence query finds no message after it and before date
+        """
+        messages = Message.objects.filter(email_list=self.email_list, base_subject=base_subject)
+        latest = self._get(self.subjects, base_subject)
+        if latest is not None and latest[0] < date:
+            if not messages.filter(date__gt=latest[0], date__lt=date).exists():
+                return latest
+        latest = messages.filter(date__lt=date).order_by('-date').values_list('date', 'thread_id').first()
+        if latest is not None:
+            self._set(self.subjects, base_subject, latest)
+        return latest
+
+    def add(self, message):
+        self._set(self.msgids, message.msgid, (message.pk, message.thread_id))
+        latest = self._get(self.subjects, message.base_subject)
+        if latest is None or message.date >= latest[0]:
+            self._set(self.subjects, message.base_subject, (message.date, message.thread_id))
+
+    def remove(self, message):
+        self.msgids.pop(message.msgid, None)
+        self.subjects.pop(message.base_subject, None)
+
+
+# process wide ThreadCaches by list pk
+_thread_caches = {}
+
+
+@receiver(post_save, sender=Message)
+def _thread_cache_add(sender, instance, **kwargs):
+    thread_cache = _thread_caches.get(instance.email_list_id)
+    if thread_cache is not None:
+        thread_cache.add(instance)
+
+
+@receiver(messages_bulk_saved, sender=Message)
+def _thread_cache_add_bulk(sender, instances, **kwargs):
+    for instance in instances:
+        _thread_cache_add(sender, instance)
+
+
+@receiver(post_delete, sender=Message)
+def _thread_cache_remove(sender, instance, **kwargs):
+    thread_cache = _thread_caches.get(instance.email_list_id)
+    if thread_cache is not None:
+        thread_cache.remove(instance)
+
+
+@receiver(post_delete, sender=EmailList)
+def _thread_cache_clear(sender, instance, **kwargs):
+    _thread_caches.pop(instance.pk, None)
+
+
+class MessageBatch(object):
+    """Buffers processed MessageWrappers and writes them to the database together,
+    see flush().  Used by Loader for bulk loads in place of MessageWrapper.save().
+
+    Messages waiting in the batch are not in the database yet, so the batch also
+    serves lookups for MessageWrapper.process(): pending messages by msgid and
+    subject, the messages of each thread and one Thread instance per thread.
+    Thread order and depth of existing messages changed by new arrivals are
+    written with one bulk_update().
+
+    bulk_create() doesn't send post_save, so flush() does the work of the
+    Message post_save receivers, updating Thread.first and sending one
+    messages_bulk_saved signal for the indexer.  The CDN cache is not purged,
+    bulk loads are of historical messages.
+    """
+    def __init__(self, index, size=DEFAULT_BATCH_SIZE, test=False):
+        self.index = index
+        self.size = size
+        self.test = test
+        self.clear()
+
+    def __len__(self):
+        return len(self.wrappers)
+
+    def clear(self):
+        self.wrappers = []
+        self.messages = {}              # pending messages by msgid
+        self.subjects = {}              # pending messages by base_subject
+        self.threads = {}               # Thread instances by pk
+        self.thread_messages = {}       # messages of thread by thread pk
+        self.updated = {}               # existing messages changed, by pk
+
+    def is_full(self):
+        return len(self.wrappers) >= self.size
+
+    def get_message(self, msgid):
+        """Returns pending message with msgid or None"""
+        return self.messages.get(msgid)
+
+    def get_latest_by_subject(self, base_subject, date):
+        """Returns the latest pending message with base_subject before date, or None"""
+        messages = [m for m in self.subjects.get(base_subject, []) if m.date < date]
+        if messages:
+            return max(messages, key=lambda m: m.date)
+
+    def get_thread(self, thread):
+        """Returns the batch's instance of thread, so pending changes to the thread
+        are seen by all messages in the batch
+        """
+        return self.threads.setdefault(thread.pk, thread)
+
+    def get_thread_messages(self, thread):
+        """Returns list of messages in thread, existing and pending, ordered by date"""
+        if thread.pk not in self.thread_messages:
+            self.thread_messages[thread.pk] = list(thread.message_set.all().order_by('date'))
+        return sorted(self.thread_messages[thread.pk], key=lambda m: m.date)
+
+    def add(self, mw):
+        """Add a processed and checked MessageWrapper to the batch"""
+        message = mw.archive_message
+        self.wrappers.append(mw)
+        self.messages[mw.msgid] = message
+        self.subjects.setdefault(message.base_subject, []).append(message)
+        self.get_thread_messages(message.thread)
+        self.thread_messages[message.thread.pk].append(message)
+        self.index.add(mw.msgid, mw.hashcode)
+
+        # apply new thread order to existing messages
+        for info in mw.thread_info.values():
+            other = info.message
+            if other is message:
+                continue
+            if (other.thread_order != info.order or other.thread_depth != info.depth):
+                other.thread_order = info.order
+                other.thread_depth = info.depth
+                if other.pk is not None:
+                    self.updated[other.pk] = other
+
+    def flush(self):
+        """Write pending messages, attachments and thread changes in one transaction.
+        Returns the number of messages written.  On failure the message files written
+        are deleted, the pending messages are removed from the index and the
+        exception is raised, the caller should save them as failed and clear() the batch.
+        """
+        if not self.wrappers:
+            return 0
+        messages = [mw.archive_message for mw in self.wrappers]
+        paths = []
+
+        try:
+            # write message files first, the indexer requires the file to be present
+            if not self.test:
+                for mw in self.wrappers:
+                    paths.append(mw.write_msg())
+
+            with transaction.atomic():
+                # in_reply_to may refer to another message in this batch, which
+                # has no primary key until created
+                replies = [(m, m.in_reply_to) for m in messages
+                           if m.in_reply_to is not None and m.in_reply_to.pk is None]
+                for message, _ in replies:
+                    message.in_reply_to = None
+                Message.objects.bulk_create(messages)
+                for message, parent in replies:
+                    message.in_reply_to = parent
+                Message.objects.bulk_update([m for m, _ in replies], ['in_reply_to'])
+
+                attachments = []
+                for mw in self.wrappers:
+                    attachments.extend(mw.get_attachments())
+                Attachment.objects.bulk_create(attachments)
+
+                now = timezone.now()
+                updated = list(self.updated.values())
+                for message in updated:
+                    message.updated = now
+                Message.objects.bulk_update(updated, ['thread_order', 'thread_depth', 'updated'])
+
+                # see signals._update_thread().  The summary is recomputed in the
+                # database, other processes may have added to the threads since
+                # the batch read them
+                threads = {}
+                for message in messages:
+                    thread = message.thread
+                    if not thread.first_id or message.date < thread.date:
+                        thread.first = message
+                        thread.date = message.date
+                    threads[thread.pk] = thread
+                Thread.objects.bulk_update(list(threads.values()), ['first', 'date'])
+                Thread.objects.filter(pk__in=list(threads)).update(**get_thread_summary_expressions())
+        except Exception:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            for mw in self.wrappers:
+                self.index.remove(mw.msgid, mw.hashcode)
+            raise
+
+        messages_bulk_saved.send(sender=Message, instances=messages + updated)
+        logger.info('Batch archived list:{} messages:{} updated:{} attachments:{}'.format(
+            self.index.listname, len(messages), len(updated), len(attachments)))
+        count = len(messages)
+        self.clear()
+        return count
+
+
+class Checkpoint(object):
+    """Import progress of a list's mailbox files, so an interrupted load can be
+    resumed, see Loader.  Saved as JSON to IMPORT_CHECKPOINT_DIR/[listname].json,
+    {path: {key, offset, size, complete}} where key and offset identify the next
+    message to load and size is the size of the file when the checkpoint was made
+    """
+    def __init__(self, listname):
+        self.path = os.path.join(settings.IMPORT_CHECKPOINT_DIR, listname + '.json')
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.files = json.load(f)
+
+    def get(self, filename):
+        return self.files.get(os.path.abspath(filename))
+
+    def update(self, filename, key, offset, size, complete=False):
+        self.files[os.path.abspath(filename)] = {
+            'key': key,
+            'offset': offset,
+            'size': size,
+            'complete': complete}
+        self.save()
+
+    def save(self):
+        """Atomically replace the checkpoint file"""
+        make_dirs(os.path.dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.files, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
 class Loader(object):
     """Object which handles loading messages from a mailbox file.  filename is the name
     of the file to load.  Accepts the following keyword options:
@@ -557,6 +1149,18 @@ class Loader(object):
     listname: the name of the email list we are loading messages for
     private: True is this is a private list
     test: if True don't save the message to disk archive (only to database)
+    batch_size: if set, messages are saved in batches of this size, see MessageBatch
+    resume: if True start after the last message recorded in the checkpoint
+    progress: optional function called with the loader at every checkpoint
+
+    index: an optional DedupeIndex for the list, shared by the loaders of the list's
+    files.  If not provided one is created for the file.
+
+    checkpoint: an optional Checkpoint.  The position in the file is recorded after
+    every committed batch, or every CHECKPOINT_INTERVAL messages when not batching.
+
+    stats['profile'] is a timing.Profile of the stages of loading each message,
+    plus "read" from the mailbox and "flush" of each batch.
 
     NOTE: if the message is from the last 30 days we skip firstrun step, because there
     will be some lag between when the legacy archive index was created and the
@@ -564,12 +1168,26 @@ class Loader(object):
     found in the original message and we had to create one, becasue it obviously
     won't exist in the web archive.
     """
-    def __init__(self, filename, **options):
+    def __init__(self, filename, index=None, checkpoint=None, **options):
         self.filename = filename
         self.options = options
         self.stats = {'count': 0, 'errors': 0, 'spam': 0, 'bytes_loaded': 0}
+        self.profile = self.stats['profile'] = Profile()
         self.private = options.get('private')
         self.listname = options.get('listname')
+        if index is None:
+            index = DedupeIndex(self.listname, legacy=options.get('firstrun'))
+        self.index = index
+        self.checkpoint = checkpoint
+        self.progress = options.get('progress')
+        self.size = os.path.getsize(filename)
+        self.offset = 0             # start of the next message to load
+        self.start_offset = 0
+        self.start_time = time.time()
+        self.flushed = False
+        self.batch = None
+        if options.get('batch_size') and not options.get('dryrun'):
+            self.batch = MessageBatch(index, size=options['batch_size'], test=options.get('test'))
         self.mb = get_mb(filename)
         self.klass = self.mb.__class__.__name__
         self.stats[self.klass] = self.stats.get(self.klass, 0) + 1
@@ -587,16 +1205,29 @@ class Loader(object):
         """
         self.stats['count'] += 1
         try:
-            mw = MessageWrapper.from_message(msg, self.listname, private=self.private)
+            mw = MessageWrapper.from_message(msg, self.listname, private=self.private, batch=self.batch)
         except Exception as e:
             print(self.filename)
             raise
             # import sys
             # raise e.with_traceback(sys.exc_info()[2])
+        try:
+            self._process_message(mw)
+        finally:
+            self.profile.add_timings(mw.timings)
+
+    def _process_message(self, mw):
+        """Filter, check and save or batch the MessageWrapper"""
+        # reject spam before any database work
+        if not self.options.get('dryrun'):
+            mw.check_headers()
 
         # filter using Legacy archive
         if self.options.get('firstrun') and mw.date < (datetime.datetime.now() - datetime.timedelta(days=30)) and mw.created_id is False:  # noqa
-            legacy = Legacy.objects.filter(msgid=mw.msgid, email_list_id=self.listname)
+            if self.index.legacy is not None:
+                legacy = self.index.has_legacy(mw.msgid)
+            else:
+                legacy = Legacy.objects.filter(msgid=mw.msgid, email_list_id=self.listname).exists()
             if not legacy:
                 self.stats['spam'] += 1
                 if not (self.options.get('dryrun') or self.options.get('test')):
@@ -607,13 +1238,96 @@ class Loader(object):
         mw.archive_message
         self.stats['bytes_loaded'] += len(mw.bytes)
 
-        if not self.options.get('dryrun'):
-            mw.save(test=self.options.get('test'))
+        if self.batch is not None:
+            mw.check(index=self.index)
+            self.batch.add(mw)
+            if self.batch.is_full():
+                self._flush()
+        elif not self.options.get('dryrun'):
+            mw.save(test=self.options.get('test'), index=self.index)
+
+    def _flush(self):
+        """Write the pending batch.  If it fails save all of its messages as failed
+        """
+        timings = Timings()
+        try:
+            with activate(timings), timings.stage('flush'):
+                self.batch.flush()
+        except Exception as error:
+            for mw in self.batch.wrappers:
+                save_failed_msg(mw.email_message, self.listname, error)
+            self.stats['errors'] += len(self.batch)
+            self.batch.clear()
+            if self.options.get('break'):
+                raise
+        finally:
+            self.profile.add_timings(timings)
+        self.flushed = True
+
+    def _get_offset(self, key):
+        """Returns byte offset of message key in the mailbox file"""
+        return self.mb._lookup(key)[0]
+
+    def _get_start_key(self):
+        """Returns the key to start loading at.  When resuming, the message after
+        the checkpoint if the file hasn't changed since, otherwise the first.
+        Mailbox keys are sequential integers
+        """
+        state = self.checkpoint.get(self.filename) if self.checkpoint else None
+        if not (self.options.get('resume') and state):
+            return 0
+        key = state['key']
+        try:
+            matches = state['size'] <= self.size and self._get_offset(key) == state['offset']
+        except KeyError:
+            matches = False
+        if matches:
+            logger.info('resuming {} at message {}, offset {}'.format(self.filename, key, state['offset']))
+            return key
+        logger.warning('checkpoint does not match {}, loading from start'.format(self.filename))
+        return 0
+
+    def _save_checkpoint(self, key, complete=False):
+        """Record that all messages before key are committed"""
+        if complete:
+            offset = self.size
+        else:
+            try:
+                offset = self._get_offset(key)
+            except KeyError:
+                # key is past the last message, the complete checkpoint follows
+                return
+        self.flushed = False
+        self.offset = offset
+        if self.checkpoint and not self.options.get('dryrun'):
+            self.checkpoint.update(self.filename, key, self.offset, self.size, complete=complete)
+        if self.progress:
+            self.progress(self)
+
+    def is_complete(self):
+        """Returns True if the checkpoint shows this file, unchanged, was loaded"""
+        state = self.checkpoint.get(self.filename) if self.checkpoint else None
+        return bool(state and state['complete'] and state['size'] == self.size)
 
     def process(self):
-        """If the "break" option is set propogate the exception
+        """Load the file's messages, from the checkpoint if resuming.  If the "break"
+        option is set propogate the exception
         """
-        for m in self.mb:
+        if self.options.get('resume') and self.is_complete():
+            logger.info('skipping {}, already loaded'.format(self.filename))
+            self.stats['skipped'] = 1
+            self._cleanup()
+            return
+
+        start = end = self._get_start_key()
+        if start:
+            self.offset = self.start_offset = self._get_offset(start)
+        # the mailbox scans lazily, see MappedMailbox, so loading starts right away
+        for key in itertools.islice(self.mb.iterkeys(), start, None):
+            end = key + 1
+            read_start = time.perf_counter()
+            m = self.mb[key]
+            self.profile.add('read', time.perf_counter() - read_start)
             try:
                 self._load_message(m)
             except DuplicateMessage as error:
@@ -624,6 +1338,12 @@ class Loader(object):
                 if self.options.get('break'):
                     raise
 
+            if self.flushed or (self.batch is None and (end - start) % CHECKPOINT_INTERVAL == 0):
+                self._save_checkpoint(end)
+
+        if self.batch is not None:
+            self._flush()
+        self._save_checkpoint(end, complete=True)
         self._cleanup()
 
 
@@ -638,10 +1358,12 @@ class MessageWrapper(object):
     must explicitly call process() or access the archive_message object for the object
     to contain valid data.
     """
-    def __init__(self, bytes=None, message=None, listname=None, private=False, backup=True):
+    def __init__(self, bytes=None, message=None, listname=None, private=False, backup=True, batch=None):
         """Create a MessageWrapper out of raw bytes or a email.Message
 
-        Exactly one of 'bytes', 'message' must be given.
+        Exactly one of 'bytes', 'message' must be given.  If the message will be
+        saved as part of a MessageBatch it must be given, so threading can see
+        the batch's pending messages.
         """
         
         if not listname or not bytes and not message:
@@ -649,20 +1371,26 @@ class MessageWrapper(object):
 
         self._archive_message = None
         self._date = None
+        self.batch = batch
         self.created_id = False
-        if bytes is not None:
-            self.bytes = bytes
-            self.email_message = get_message_from_bytes(bytes, policy=NO_REFOLD_POLICY)
-        else:
-            self.bytes = message.as_bytes(policy=NO_REFOLD_POLICY)
-            self.email_message = message
+        self.timings = Timings()
+        with self.timings.stage('parse'):
+            if bytes is not None:
+                self.bytes = bytes
+                self._email_message = None
+                self.headers = get_headers_from_bytes(bytes, policy=NO_REFOLD_POLICY)
+            else:
+                self.bytes = message.as_bytes(policy=NO_REFOLD_POLICY)
+                self._email_message = message
+                self.headers = message
         self.hashcode = None
         self.listname = listname
         self.private = private
         self.spam_score = 0
+        self.headers_checked = False
         
         # fail right away if no headers
-        if not list(self.email_message.items()):         # no headers, something is wrong
+        if not list(self.headers.items()):         # no headers, something is wrong
             raise NoHeaders
 
         self.msgid = self.get_msgid()
@@ -672,8 +1400,21 @@ class MessageWrapper(object):
         return cls(bytes=bytes, listname=listname, private=private)
 
     @classmethod
-    def from_message(cls, message, listname, private=False):
-        return cls(message=message, listname=listname, private=private)
+    def from_message(cls, message, listname, private=False, batch=None):
+        return cls(message=message, listname=listname, private=private, batch=batch)
+
+    def _get_email_message(self):
+        """Returns the fully parsed email.Message.  When created from bytes only the
+        headers are parsed on init, self.headers, which is all that filtering,
+        duplicate checks and threading need.  The body is parsed on first access.
+        """
+        if self._email_message is None:
+            with self.timings.stage('parse'):
+                self._email_message = get_message_from_bytes(self.bytes, policy=NO_REFOLD_POLICY)
+            if self.created_id:
+                set_header(self._email_message, 'Message-ID', self.msgid)
+        return self._email_message
+    email_message = property(_get_email_message)
 
     def _get_archive_message(self):
         """Returns the archive.models.Message instance"""
@@ -684,17 +1425,37 @@ class MessageWrapper(object):
 
     def _get_date(self):
         if not self._date:
-            self._date = self.get_date()
+            with self.timings.stage('date'):
+                self._date = self.get_date()
         return self._date
     date = property(_get_date)
 
     def _init_in_reply_to_fields(self):
         """Initialize self.in_reply_to, self.in_reply_to_value"""
         assert self.email_list
-        self.in_reply_to_value = self.email_message.get('In-Reply-To', '')
-        self.in_reply_to = get_in_reply_to_message(
-            self.in_reply_to_value,
-            self.email_list)
+        self.in_reply_to_value = self.headers.get('In-Reply-To', '')
+        self.in_reply_to = None
+        msgids = parse_message_ids(self.in_reply_to_value)
+        if not msgids:
+            return
+        if self.batch:
+            self.in_reply_to = self.batch.get_message(msgids[0])
+        if self.in_reply_to is None and self.resolved.get(msgids[0]):
+            pk = self.resolved[msgids[0]][0]
+            self.in_reply_to = Message.objects.select_related('thread').filter(pk=pk).first()
+        if self.in_reply_to is None:
+            # not in this list, see get_message_prefer_list()
+            self.in_reply_to = Message.objects.filter(msgid=msgids[0]).first()
+
+    def _resolve_msgids(self, values):
+        """Look up the message ids in header values, those not pending in the batch,
+        with the list's ThreadCache.  Results accumulate in self.resolved
+        """
+        msgids = [m for v in values for m in parse_message_ids(v) if m not in self.resolved]
+        if self.batch:
+            msgids = [m for m in msgids if not self.batch.get_message(m)]
+        if msgids:
+            self.resolved.update(self.thread_cache.resolve(msgids))
 
     @staticmethod
     def get_addresses(text):
@@ -712,7 +1473,7 @@ class MessageWrapper(object):
 
     def get_cc(self):
         """Returns the CC field realname and email addresses"""
-        cc = self.email_message.get('cc')
+        cc = self.headers.get('cc')
         if not cc:
             return ''
         return self.get_addresses(cc)
@@ -737,33 +1498,25 @@ class MessageWrapper(object):
         the UTC timezone is assigned.
         """
         for func in (get_received_date, get_header_date, get_envelope_date):
-            date = func(self.email_message)
+            date = func(self.headers)
             if date:
                 return date.astimezone(datetime.timezone.utc)
 
         else:
             # can't really proceed without a date, likely indicates bigger parsing error
-            raise DateError("%s, %s" % (self.msgid, self.email_message.get_unixfrom()))
+            raise DateError("%s, %s" % (self.msgid, self.headers.get_unixfrom()))
 
     def get_hash(self):
-        """Returns the message hashcode, a SHA-1 digest of the Message-ID and listname.
-        Similar to the popular Web Email Archive, mail-archive.com
-        see: https://www.mail-archive.com/faq.html#msgid
-        """
-        msgid = self.msgid.encode('utf8')
-        listname = self.listname.encode('utf8')
-        sha = hashlib.sha1(msgid)
-        sha.update(listname)
-        b64 = base64.urlsafe_b64encode(sha.digest())
-        return b64.decode('utf8')
+        """Returns the message hashcode, see get_hash()"""
+        return get_hash(self.msgid, self.listname)
 
     def get_msgid(self):
-        msgid = self.normalize(self.email_message.get('Message-ID', ''))
+        msgid = self.normalize(self.headers.get('Message-ID', ''))
         if msgid:
             msgid = msgid.strip('<>')
         else:
             # see if this is a resent Message, which sometimes have missing Message-ID field
-            resent_msgid = self.email_message.get('Resent-Message-ID')
+            resent_msgid = self.headers.get('Resent-Message-ID')
             if resent_msgid:
                 msgid = resent_msgid.strip('<>')
         if not msgid:
@@ -771,10 +1524,7 @@ class MessageWrapper(object):
             self.created_id = True
             self.spam_score = self.spam_score | settings.MARK_BITS['NO_MSGID']
             # add message-id to email_message headers so it gets to disk file
-            if 'message-id' in self.email_message:
-                self.email_message.replace_header('Message-ID', msgid)
-            else:
-                self.email_message.add_header('Message-ID', msgid)
+            set_header(self.headers, 'Message-ID', msgid)
             # raise GenericWarning('No MessageID (%s)' % self.email_message.get_from())
         return msgid
 
@@ -782,14 +1532,14 @@ class MessageWrapper(object):
         """Gets the message subject.  Truncate very long lines (probably spam) to
         avoid databaser errors.
         """
-        subject = self.normalize(self.email_message.get('Subject', ''))
+        subject = self.normalize(self.headers.get('Subject', ''))
         if len(subject) > 512:
             subject = subject[:512]
         return subject
 
     def get_to(self):
         """Returns the To field realname and email addresses"""
-        to = self.email_message.get('to')
+        to = self.headers.get('to')
         if not to:
             return ''
         return self.get_addresses(to)
@@ -802,6 +1552,12 @@ class MessageWrapper(object):
         - http://www.jwz.org/doc/threading.html
         - http://tools.ietf.org/html/rfc5256
         """
+        thread = self._get_thread()
+        if self.batch:
+            thread = self.batch.get_thread(thread)
+        return thread
+
+    def _get_thread(self):
         for header in (self.references, self.in_reply_to_value):
             thread = self.get_thread_from_header(header)
             if thread:
@@ -809,23 +1565,37 @@ class MessageWrapper(object):
 
         # check subject
         if subject_is_reply(self.subject):
-            messages = Message.objects.filter(email_list=self.email_list,
-                                              date__lt=self.date,
-                                              base_subject=self.base_subject).order_by('-date')
-            if messages:
-                return messages[0].thread
+            latest = self.thread_cache.get_latest_by_subject(self.base_subject, self.date)
+            if self.batch:
+                pending = self.batch.get_latest_by_subject(self.base_subject, self.date)
+                if pending and (latest is None or pending.date > latest[0]):
+                    return pending.thread
+            if latest:
+                thread = self.get_thread_by_pk(latest[1])
+                if thread:
+                    return thread
 
         # return a new thread
         return Thread.objects.create(date=self.date, email_list=self.email_list)
 
+    def get_thread_by_pk(self, pk):
+        """Returns Thread or None.  Uses the in_reply_to message's thread if it's
+        the one
+        """
+        if self.in_reply_to is not None and self.in_reply_to.thread_id == pk:
+            return self.in_reply_to.thread
+        return Thread.objects.filter(pk=pk).first()
+
     def get_thread_from_header(self, value):
         """Returns the thread given text containing message ids"""
+        self._resolve_msgids([value])
         for msgid in parse_message_ids(value):
-            try:
-                message = Message.objects.get(email_list=self.email_list, msgid=msgid)
-                return message.thread
-            except (Message.DoesNotExist, Message.MultipleObjectsReturned):
-                pass
+            if self.batch and self.batch.get_message(msgid):
+                return self.batch.get_message(msgid).thread
+            if self.resolved.get(msgid):
+                thread = self.get_thread_by_pk(self.resolved[msgid][1])
+                if thread:
+                    return thread
 
     def normalize(self, header_text):
         """This function takes some header_text as a string.
@@ -856,6 +1626,10 @@ class MessageWrapper(object):
         """Perform the rest of the parsing and construct the Message object.  Note,
         we are not saving the object to the database.  This happens in the save() function.
         """
+        with self.timings.stage('process'):
+            self._process()
+
+    def _process(self):
         self.email_list, created = EmailList.objects.get_or_create(
             name=self.listname, defaults={'description': self.listname, 'private': self.private})
         if not created and self.private is True and self.email_list.private is False:
@@ -864,15 +1638,19 @@ class MessageWrapper(object):
             self.email_list.private = True
             self.email_list.save()
         self.hashcode = self.get_hash()
+        self.thread_cache = get_thread_cache(self.email_list)
+        self.references = self.headers.get('References', '')
+        self.resolved = {}
+        self._resolve_msgids([self.references, self.headers.get('In-Reply-To', '')])
         self._init_in_reply_to_fields()
-        self.references = self.email_message.get('References', '')
         self.subject = self.get_subject()
         self.base_subject = get_base_subject(self.subject)
-        self.thread = self.get_thread()
-        self.from_line = self.normalize(get_from(self.email_message)) or ''
+        with self.timings.stage('thread'):
+            self.thread = self.get_thread()
+        self.from_line = self.normalize(get_from(self.headers)) or ''
         if self.from_line:
             self.from_line = self.from_line[5:].lstrip()    # we only need the unique part
-        self.frm = self.normalize(self.email_message.get('From', ''))
+        self.frm = self.normalize(self.headers.get('From', ''))
         self._archive_message = Message(base_subject=self.base_subject,
                                         cc=self.get_cc(),
                                         date=self.date,
@@ -889,9 +1667,20 @@ class MessageWrapper(object):
                                         thread=self.thread,
                                         to=self.get_to())
         # not saving here.
-        thread_messages = list(self.thread.message_set.all().order_by('date'))
-        thread_messages.append(self._archive_message)
-        self.thread_info = compute_thread(thread_messages)
+        with self.timings.stage('compute_thread'):
+            if self.batch:
+                thread_messages = self.batch.get_thread_messages(self.thread)
+                self.thread_info = insert_message(MessageList(thread_messages), self._archive_message)
+            else:
+                thread_messages = None
+                self.thread_info = insert_message(MessageQuerySet(self.thread.message_set.all()),
+                                                  self._archive_message)
+            if self.thread_info is None:
+                # full recompute
+                if thread_messages is None:
+                    thread_messages = list(self.thread.message_set.all().order_by('date'))
+                thread_messages.append(self._archive_message)
+                self.thread_info = compute_thread(thread_messages)
         info = self.thread_info[self.hashcode]
         self._archive_message.thread_depth = info.depth
         self._archive_message.thread_order = info.order
@@ -906,37 +1695,75 @@ class MessageWrapper(object):
         NOTE: Python 3 has iter_attachments()
         NOTE: get_filename() may return folded name so remove newlines
         """
-        for sequence, part in enumerate(self.email_message.walk()):
+        for attachment in self.get_attachments():
+            attachment.save()
+
+    def get_attachments(self):
+        """Returns list of unsaved Attachment objects for the message parts that are
+        attachments.  See process_attachments()
+        """
+        # a single part message is its own only part, no need to parse the body
+        if self.headers.get_content_maintype() in ('multipart', 'message'):
+            parts = self.email_message.walk()
+        else:
+            parts = [self.headers]
+        attachments = []
+        for sequence, part in enumerate(parts):
             if is_attachment(part):
                 filename = get_filename(part)
                 filename = filename.replace('\r', '').replace('\n', '')
-                Attachment.objects.create(message=self.archive_message,
-                                          description='',
-                                          content_type=part.get_content_type(),
-                                          content_disposition=get_content_disposition(part),
-                                          name=filename,
-                                          sequence=sequence)
-
-    def save(self, test=False):
-        """Ensure message is not duplicate message-id or hash.  Save message to database.
-        Save to disk (if not test mode) and process attachments.
+                attachments.append(Attachment(message=self.archive_message,
+                                              description='',
+                                              content_type=part.get_content_type(),
+                                              content_disposition=get_content_disposition(part),
+                                              name=filename,
+                                              sequence=sequence))
+        return attachments
+
+    def check_headers(self):
+        """Run the header only inspectors.  They need neither the message body nor
+        the database so call this as early as possible, spam and no-archive messages
+        are rejected before process().  Raises an InspectorMessage
+        """
+        if not self.headers_checked:
+            with self.timings.stage('inspectors'):
+                get_pipeline().inspect(self, header_only=True)
+            self.headers_checked = True
+
+    def check(self, index=None):
+        """Run the inspectors and check for duplicate message-id or hash.  Raises an
+        exception if the message should not be saved.  If a DedupeIndex is provided the
+        duplicate checks use it instead of querying the database.
         """
         # check for spam
-        if hasattr(settings, 'INSPECTORS'):
-            for inspector_name in settings.INSPECTORS:
-                inspector_class = eval(inspector_name)
-                inspector = inspector_class(self)
-                inspector.inspect()
-
-        # check for duplicate message id, and skip
-        if Message.objects.filter(msgid=self.msgid, email_list__name=self.listname):
-            self.write_msg(subdir='_dupes')
-            raise DuplicateMessage('Duplicate msgid: %s' % self.msgid)
-
-        # check for duplicate hash
-        if Message.objects.filter(hashcode=self.hashcode):
-            self.write_msg(subdir='_dupes')
-            raise CommandError('Duplicate hash, msgid: %s' % self.msgid)
+        self.check_headers()
+        with self.timings.stage('inspectors'):
+            get_pipeline().inspect(self, header_only=False)
+
+        with self.timings.stage('dedupe'):
+            # check for duplicate message id, and skip
+            if index is not None:
+                duplicate = index.has_msgid(self.msgid)
+            else:
+                duplicate = Message.objects.filter(msgid=self.msgid, email_list__name=self.listname).exists()
+            if duplicate:
+                self.write_msg(subdir='_dupes')
+                raise DuplicateMessage('Duplicate msgid: %s' % self.msgid)
+
+            # check for duplicate hash
+            if index is not None:
+                duplicate = index.has_hashcode(self.hashcode)
+            else:
+                duplicate = Message.objects.filter(hashcode=self.hashcode).exists()
+            if duplicate:
+                self.write_msg(subdir='_dupes')
+                raise CommandError('Duplicate hash, msgid: %s' % self.msgid)
+
+    def save(self, test=False, index=None):
+        """Ensure message is not duplicate message-id or hash.  Save message to database.
+        Save to disk (if not test mode) and process attachments.  See check() for index.
+        """
+        self.check(index=index)
 
         # ensure message has been processed
         _ = self.archive_message    # noqa
@@ -944,21 +1771,29 @@ class MessageWrapper(object):
         # write message to disk and then save, post_save signal calls indexer
         # which requires file to be present
         if not test:
-            self.write_msg()
-        self.archive_message.save()
-        logger.info('Message archived list:{} from:{}'.format(self.listname, self.frm))
-
-        # update thread information
-        if self.archive_message.thread.message_set.count() > 1:
-            reconcile_thread(self.thread_info)
-
-        # now that the archive.Message object is created we can process any attachments
-        self.process_attachments(test=test)
+            with self.timings.stage('write'):
+                self.write_msg()
+        # signal handlers record their stages, ie. "index", to the current timings
+        with activate(self.timings):
+            with self.timings.stage('save'):
+                self.archive_message.save()
+            if index is not None:
+                index.add(self.msgid, self.hashcode)
+            logger.info('Message archived list:{} from:{}'.format(self.listname, self.frm))
+
+            # update thread information
+            with self.timings.stage('reconcile'):
+                if self.archive_message.thread.message_count > 1:
+                    reconcile_thread(self.thread_info)
+
+            # now that the archive.Message object is created we can process any attachments
+            with self.timings.stage('attachments'):
+                self.process_attachments(test=test)
 
     def write_msg(self, subdir=None):
         """Write a copy of the original email message to the disk archive.
         Use optional argument subdir to specify a subdirectory within the list directory
-        ie. "_filtered" or "_failure"
+        ie. "_filtered" or "_failure".  Returns the path written
         """
         # set filename
         filename = self.hashcode
@@ -969,7 +1804,7 @@ class MessageWrapper(object):
         if subdir:
             path = os.path.join(settings.ARCHIVE_DIR, self.listname, subdir, filename)
         else:
-            path = os.path.join(settings.ARCHIVE_DIR, self.listname, filename)
+            path = get_write_path(self.listname, filename)
 
         # if the file already exists, append a suffix
         if os.path.exists(path):
@@ -979,3 +1814,4 @@ class MessageWrapper(object):
 
         # write file
         write_file(path, self.bytes)
+        return path
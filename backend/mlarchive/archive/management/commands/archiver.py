@@ -0,0 +1,40 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mlarchive.archive.archiver import ArchiverServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run the persistent archiver service, listening on a UNIX socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--socket', dest='socket', default=settings.ARCHIVER_SOCKET,
+            help='path of the UNIX socket to listen on (default is settings.ARCHIVER_SOCKET)')
+        parser.add_argument('-m', '--mode', dest='mode', type=lambda value: int(value, 8),
+            default=settings.ARCHIVER_SOCKET_MODE,
+            help='octal permissions of the socket (default is settings.ARCHIVER_SOCKET_MODE)')
+        parser.add_argument('-g', '--group', dest='group', default=settings.ARCHIVER_SOCKET_GROUP,
+            help='group of the socket, the MTA delivery user must be a member '
+                 '(default is settings.ARCHIVER_SOCKET_GROUP)')
+
+    def handle(self, *args, **options):
+        server = ArchiverServer(options['socket'], mode=options['mode'], group=options['group'])
+
+        def shutdown(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, shutdown)
+        logger.info('archiver: listening on {}'.format(options['socket']))
+        self.stdout.write('Listening on {}'.format(options['socket']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write('Archived {count} messages, {errors} errors'.format(**server.stats))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.models import EmailList, Thread, get_thread_summary_expressions
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Check the summary fields of every Thread, message_count, last_date, '
+            'participant_count and subject, against the thread\'s messages and fix '
+            'any that have drifted.  Use --dry-run to only report them, with -v 2 to '
+            'list them.  The rethread command also fixes the summary.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--listname', dest='listname',
+            help='only check this list (default is all lists)')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
+            help='report threads with wrong summary without fixing them')
+
+    def handle(self, *args, **options):
+        if options['listname']:
+            lists = EmailList.objects.filter(name=options['listname'])
+            if not lists:
+                raise CommandError('List not found: {}'.format(options['listname']))
+        else:
+            lists = EmailList.objects.all().order_by('name')
+
+        total = {'threads': 0, 'drifted': 0}
+        for elist in lists:
+            stats = self.check_list(elist, options)
+            for key, val in stats.items():
+                total[key] += val
+            self.stdout.write('{}: threads:{threads} drifted:{drifted}'.format(elist.name, **stats))
+        self.stdout.write('Total: threads:{threads} drifted:{drifted}'.format(**total))
+
+    def check_list(self, elist, options):
+        '''Compare the stored summary of the list's threads with one computed in
+        the database.  Returns stats dictionary
+        '''
+        fields = Thread.SUMMARY_FIELDS
+        expressions = get_thread_summary_expressions()
+        threads = Thread.objects.filter(email_list=elist).order_by('pk')
+        # annotations may not use the name of a field
+        threads = threads.annotate(**{'actual_' + f: expressions[f] for f in fields})
+        rows = threads.values_list('pk', *fields, *['actual_' + f for f in fields])
+        stats = {'threads': 0, 'drifted': 0}
+        drifted = []
+        for row in rows.iterator():
+            stats['threads'] += 1
+            stored, actual = row[1:len(fields) + 1], row[len(fields) + 1:]
+            if stored != actual:
+                drifted.append(row[0])
+                if options['verbosity'] > 1:
+                    self.stdout.write('{}: thread:{} {}'.format(elist.name, row[0], ' '.join(
+                        '{}:{}->{}'.format(f, s, a) for f, s, a in zip(fields, stored, actual) if s != a)))
+        stats['drifted'] = len(drifted)
+        if drifted and not options['dryrun']:
+            Thread.objects.filter(pk__in=drifted).update(**expressions)
+            logger.info('check_thread_summary: fixed {} threads of {}'.format(len(drifted), elist.name))
+        return stats
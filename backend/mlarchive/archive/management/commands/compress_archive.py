@@ -0,0 +1,91 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.storage import (COMPRESSORS, compress, find_path, get_month, load_segment_index,
+    read_file, split_suffix)
+
+import logging
+logger = logging.getLogger(__name__)
+
+NONE = 'none'
+
+
+class Command(BaseCommand):
+    help = ('Recompress message files to the compression format, default is '
+            'settings.ARCHIVE_COMPRESSION.  Safe to run on a live archive, readers '
+            'find files in any format.  Set ARCHIVE_COMPRESSION first so new messages '
+            'are written in the new format.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--listname', dest='listname',
+            help='only compress this list (default is all lists)')
+        parser.add_argument('--format', dest='format', choices=list(COMPRESSORS) + [NONE],
+            help='target format, "none" to decompress (default is settings.ARCHIVE_COMPRESSION)')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
+            help='report what would be converted without converting anything')
+
+    def handle(self, *args, **options):
+        compression = options['format'] or settings.ARCHIVE_COMPRESSION or NONE
+        suffix = '' if compression == NONE else COMPRESSORS[compression].suffix
+        if compression != (settings.ARCHIVE_COMPRESSION or NONE):
+            self.stderr.write('Warning: target format differs from ARCHIVE_COMPRESSION ({})'.format(
+                settings.ARCHIVE_COMPRESSION))
+        if options['listname']:
+            lists = EmailList.objects.filter(name=options['listname'])
+            if not lists:
+                raise CommandError('List not found: {}'.format(options['listname']))
+        else:
+            lists = EmailList.objects.all().order_by('name')
+
+        total = {'converted': 0, 'current': 0, 'missing': 0, 'before': 0, 'after': 0}
+        for elist in lists:
+            stats = self.compress_list(elist, suffix, options['dryrun'])
+            for key, val in stats.items():
+                total[key] += val
+            self.stdout.write(self.format_stats(elist.name, stats))
+        self.stdout.write(self.format_stats('Total', total))
+
+    def format_stats(self, name, stats):
+        return '{}: converted:{converted} current:{current} missing:{missing} bytes:{before}->{after}'.format(
+            name, **stats)
+
+    def compress_list(self, elist, suffix, dryrun=False):
+        '''Convert the list's message files to compression suffix.  Returns stats
+        dictionary.  before and after are the total bytes of converted files
+        '''
+        stats = {'converted': 0, 'current': 0, 'missing': 0, 'before': 0, 'after': 0}
+        rows = Message.objects.filter(email_list=elist).values_list('hashcode', 'date')
+        for hashcode, date in rows.iterator():
+            source = find_path(elist.name, hashcode)
+            if source is None and hashcode in load_segment_index(elist.name, get_month(date)):
+                # packed, see pack_archive
+                stats['current'] += 1
+                continue
+            if source is None:
+                logger.warning('compress_archive: message file missing {}:{}'.format(elist.name, hashcode))
+                stats['missing'] += 1
+                continue
+            base, current = split_suffix(source)
+            if current == suffix:
+                stats['current'] += 1
+                continue
+            target = base + suffix
+            data = compress(read_file(source), target)
+            stats['before'] += os.path.getsize(source)
+            stats['after'] += len(data)
+            stats['converted'] += 1
+            if dryrun:
+                continue
+            # write under temporary name and rename so readers never see a partial file.
+            # there is a moment where both files exist, readers may use either
+            tmp_path = target + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, os.stat(source).st_mode & 0o777)
+            os.rename(tmp_path, target)
+            os.remove(source)
+        logger.info('compress_archive: {} to {} {}'.format(elist.name, suffix or NONE, stats))
+        return stats
@@ -1,22 +1,70 @@
 import datetime
+import multiprocessing
 import os
 import re
 import shutil
 import time
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from mlarchive.archive.models import EmailList, Legacy
-from mlarchive.archive.mail import get_mb, CustomMbox, Loader, UnknownFormat
+from mlarchive.archive.mail import get_mb, Checkpoint, CustomMbox, DedupeIndex, Loader, UnknownFormat
 
 import logging
 logger = logging.getLogger(__name__)
 
+FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
 
 
+def add_stats(total, stats):
+    """Add values of stats dictionary to total"""
+    for key, val in list(stats.items()):
+        total[key] = total.get(key, 0) + val
+    return total
+
+
+def gather_files(source):
+    """Returns list of mailbox files to import from source, a file or directory.
+    Directory files are sorted in chronological order so thread resolution works
+    """
+    if os.path.isfile(source):
+        return [source]
+    elif os.path.isdir(source):
+        mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
+        sorted_mboxs = sorted(mboxs)
+        full = [os.path.join(source, x) for x in sorted_mboxs]
+        # exclude directories and empty files
+        return list(filter(isfile, full))
+    else:
+        raise CommandError("%s is not a file or directory" % source)
+
+
+def gather_lists(source):
+    """Returns list of (listname, files) tuples for a directory of list directories,
+    ie. [source]/[listname]/YYYY-MM.mail.  If source is a single list directory
+    the list name is the directory name.  Largest lists first, so the long jobs
+    start early.
+    """
+    if not os.path.isdir(source):
+        raise CommandError("%s is not a directory" % source)
+    subdirs = sorted(d for d in os.listdir(source) if os.path.isdir(os.path.join(source, d)))
+    if not subdirs:
+        subdirs = [os.path.basename(os.path.normpath(source))]
+        source = os.path.dirname(os.path.normpath(source))
+    jobs = []
+    for name in subdirs:
+        files = gather_files(os.path.join(source, name))
+        if files:
+            jobs.append((name.lower(), files))
+    jobs.sort(key=lambda job: sum(os.path.getsize(f) for f in job[1]), reverse=True)
+    return jobs
+
+
 def guess_list(path):
     """Try to guess the list we are importing based on header values
     """
@@ -53,6 +101,52 @@ def isfile(path):
     return True
 
 
+def load_files(files, options):
+    """Load mailbox files, in order, for the list options['listname'].  Returns
+    stats dictionary
+    """
+    stats = {}
+    # one duplicate index for all of the list's files
+    index = DedupeIndex(options['listname'], legacy=options.get('firstrun'))
+    checkpoint = Checkpoint(options['listname'])
+    for filename in files:
+        try:
+            loader = Loader(filename, index=index, checkpoint=checkpoint, **options)
+            loader.process()
+            add_stats(stats, loader.stats)
+        except UnknownFormat as error:
+            # save failed message
+            if not (options['dryrun'] or options['test']):
+                target = EmailList.get_failed_dir(options['listname'])
+                if not os.path.exists(target):
+                    os.makedirs(target)
+                shutil.copy(filename, target)
+            logger.error("Import Error [Unknown file format, {0}]".format(error.args))
+            stats['unknown'] = stats.get('unknown', 0) + 1
+    return stats
+
+
+def init_worker():
+    """Pool initializer.  The parent closes its connections before forking, make
+    sure the worker starts without any so it opens its own.
+    """
+    connections.close_all()
+
+
+def load_list(job, options):
+    """Pool worker function.  Imports all files of one list.  Returns tuple
+    (pid, listname, stats, elapsed seconds)
+    """
+    listname, files = job
+    options = dict(options, listname=listname)
+    start_time = time.time()
+    try:
+        stats = load_files(files, options)
+    finally:
+        connections.close_all()
+    return (os.getpid(), listname, stats, time.time() - start_time)
+
+
 # --------------------------------------------------
 # Classes
 # --------------------------------------------------
@@ -79,26 +173,29 @@ class Command(BaseCommand):
             help="test mode.  write database but don't store message files"),
         parser.add_argument('--firstrun', action='store_true', dest='firstrun', default=False,
             help='only use this on the initial import of the archive'),
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=0,
+            help='save messages to the database in batches of this size (default is one at a time)'),
+        parser.add_argument('-w', '--workers', type=int, dest='workers', default=0,
+            help='import lists in parallel using this many processes.  source is a directory '
+                 'of list directories, [source]/[listname]/YYYY-MM.mail'),
+        parser.add_argument('--profile', action='store_true', dest='profile', default=False,
+            help='show time spent in each stage of loading messages'),
+        parser.add_argument('-r', '--resume', action='store_true', dest='resume', default=False,
+            help='resume an interrupted load from the last checkpoint.  files already loaded '
+                 'are skipped'),
 
     def handle(self, *args, **options):
-        stats = {}
         source = options['source']
         if options.get('firstrun') and Legacy.objects.all().count() == 0:
             raise CommandError('firstrun specified but the legacy archive table is empty')
 
+        if options['workers']:
+            if options['listname']:
+                raise CommandError('listname is taken from the directory name with --workers')
+            return self.handle_parallel(source, options)
+
         # gather source files
-        if os.path.isfile(source):
-            files = [source]
-        elif os.path.isdir(source):
-            FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
-            mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
-            # we need to import the files in chronological order so thread resolution works
-            sorted_mboxs = sorted(mboxs)
-            full = [os.path.join(source, x) for x in sorted_mboxs]
-            # exclude directories and empty files
-            files = list(filter(isfile, full))
-        else:
-            raise CommandError("%s is not a file or directory" % source)
+        files = gather_files(source)
 
         # determine list
         if not options['listname']:
@@ -109,25 +206,65 @@ class Command(BaseCommand):
         # force listname lowercase
         options['listname'] = options['listname'].lower()
 
+        if not options.get('summary'):
+            options['progress'] = self.write_progress
+
         start_time = time.time()
-        for filename in files:
-            try:
-                loader = Loader(filename, **options)
-                loader.process()
-                for key, val in list(loader.stats.items()):          # compile stats
-                    stats[key] = stats.get(key, 0) + val
-            except UnknownFormat as error:
-                # save failed message
-                if not (options['dryrun'] or options['test']):
-                    target = EmailList.get_failed_dir(options['listname'])
-                    if not os.path.exists(target):
-                        os.makedirs(target)
-                    shutil.copy(filename, target)
-                logger.error("Import Error [Unknown file format, {0}]".format(error.args))
-                stats['unknown'] = stats.get('unknown', 0) + 1
+        stats = load_files(files, options)
+        stats['time'] = int(time.time() - start_time)
+
+        return self.format_stats(stats, options)
+
+    def handle_parallel(self, source, options):
+        """Import lists in parallel.  Each list is imported by one worker, in
+        chronological order, so thread resolution within the list still works.
+        """
+        stats = {}
+        workers = {}
+        jobs = gather_lists(source)
+        options = {k: v for k, v in options.items() if k not in ('stdout', 'stderr')}
+
+        # don't share database connections with the forked workers
+        connections.close_all()
+        start_time = time.time()
+        with multiprocessing.Pool(processes=options['workers'], initializer=init_worker) as pool:
+            results = [pool.apply_async(load_list, (job, options)) for job in jobs]
+            for result in results:
+                pid, listname, list_stats, elapsed = result.get()
+                add_stats(stats, list_stats)
+                worker = workers.setdefault(pid, {'lists': 0, 'count': 0, 'time': 0.0})
+                worker['lists'] += 1
+                worker['count'] += list_stats.get('count', 0)
+                worker['time'] += elapsed
+                logger.info('load: list {} loaded by worker {} {}'.format(listname, pid, list_stats))
 
         stats['time'] = int(time.time() - start_time)
+        stats['lists'] = len(jobs)
+
+        if not options.get('summary'):
+            for pid, worker in sorted(workers.items()):
+                rate = worker['count'] / worker['time'] if worker['time'] else 0
+                self.stdout.write('worker {}: lists:{} messages:{} time:{:.1f}s msgs/sec:{:.1f}'.format(
+                    pid, worker['lists'], worker['count'], worker['time'], rate))
+        return self.format_stats(stats, options)
+
+    def write_progress(self, loader):
+        """Write progress of the loader's file, with estimated time remaining"""
+        elapsed = time.time() - loader.start_time
+        rate = (loader.offset - loader.start_offset) / elapsed if elapsed else 0
+        if rate:
+            eta = str(datetime.timedelta(seconds=int((loader.size - loader.offset) / rate)))
+        else:
+            eta = 'unknown'
+        percent = 100.0 * loader.offset / loader.size if loader.size else 100.0
+        self.stdout.write('{}: {:.1f}% messages:{} elapsed:{} eta:{}'.format(
+            os.path.basename(loader.filename), percent, loader.stats['count'],
+            datetime.timedelta(seconds=int(elapsed)), eta))
 
+    def format_stats(self, stats, options):
+        profile = stats.pop('profile', None)
+        if options.get('profile') and profile:
+            self.stdout.write('\n'.join(profile.format_table()))
         if options.get('summary'):
             return stats.__str__()
         else:
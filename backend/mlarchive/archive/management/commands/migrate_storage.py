@@ -0,0 +1,74 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.mail import make_dirs
+from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.storage import (LAYOUTS, find_path, get_layout, get_month, load_segment_index,
+    split_suffix)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Move message files to the storage layout, default is settings.ARCHIVE_LAYOUT. '
+            'Safe to run on a live archive, readers find files in either layout. '
+            'Set ARCHIVE_LAYOUT first so new messages are written in the new layout.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--listname', dest='listname',
+            help='only migrate this list (default is all lists)')
+        parser.add_argument('--layout', dest='layout', choices=list(LAYOUTS),
+            help='target layout (default is settings.ARCHIVE_LAYOUT)')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
+            help='report what would be moved without moving anything')
+
+    def handle(self, *args, **options):
+        layout = get_layout(options['layout'])
+        if options['layout'] and options['layout'] != settings.ARCHIVE_LAYOUT:
+            self.stderr.write('Warning: target layout differs from ARCHIVE_LAYOUT ({})'.format(
+                settings.ARCHIVE_LAYOUT))
+        if options['listname']:
+            lists = EmailList.objects.filter(name=options['listname'])
+            if not lists:
+                raise CommandError('List not found: {}'.format(options['listname']))
+        else:
+            lists = EmailList.objects.all().order_by('name')
+
+        total = {'moved': 0, 'current': 0, 'missing': 0}
+        for elist in lists:
+            stats = self.migrate_list(elist, layout, options['dryrun'])
+            for key, val in stats.items():
+                total[key] += val
+            self.stdout.write('{}: moved:{moved} current:{current} missing:{missing}'.format(
+                elist.name, **stats))
+        self.stdout.write('Total: moved:{moved} current:{current} missing:{missing}'.format(**total))
+
+    def migrate_list(self, elist, layout, dryrun=False):
+        '''Move the list's message files to layout.  Returns stats dictionary'''
+        stats = {'moved': 0, 'current': 0, 'missing': 0}
+        rows = Message.objects.filter(email_list=elist).values_list('hashcode', 'date')
+        for hashcode, date in rows.iterator():
+            source = find_path(elist.name, hashcode)
+            if source is None and hashcode in load_segment_index(elist.name, get_month(date)):
+                # packed, see pack_archive
+                stats['current'] += 1
+                continue
+            if source is None:
+                logger.warning('migrate_storage: message file missing {}:{}'.format(elist.name, hashcode))
+                stats['missing'] += 1
+                continue
+            # keep compression, see compress_archive
+            target = layout.get_path(elist.name, hashcode) + split_suffix(source)[1]
+            if source == target:
+                stats['current'] += 1
+                continue
+            if not dryrun:
+                make_dirs(os.path.dirname(target))
+                # rename is atomic, readers see the file in one place or the other
+                os.rename(source, target)
+            stats['moved'] += 1
+        logger.info('migrate_storage: {} to {} {}'.format(elist.name, layout.name, stats))
+        return stats
@@ -0,0 +1,142 @@
+import datetime
+import itertools
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.mail import get_hash, make_dirs
+from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.storage import (append_segment, find_path, get_month, get_packed_dir,
+    get_segment_months, load_segment_index, read_file, verify_segment)
+
+import logging
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Pack message files of closed months into per list, per month, append-only '
+            'segment files, see storage.py.  Safe to run on a live archive and to re-run, '
+            'messages that arrive late for a packed month are appended.  Use --verify to '
+            'check packed messages against their digests and hashcodes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--listname', dest='listname',
+            help='only pack this list (default is all lists)')
+        parser.add_argument('--before', dest='before',
+            help='pack months before this one, YYYY-MM (default is the current month)')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
+            help='report what would be packed without packing anything')
+        parser.add_argument('--verify', action='store_true', dest='verify', default=False,
+            help='verify packed segments instead of packing')
+
+    def handle(self, *args, **options):
+        if options['listname']:
+            lists = EmailList.objects.filter(name=options['listname'])
+            if not lists:
+                raise CommandError('List not found: {}'.format(options['listname']))
+        else:
+            lists = EmailList.objects.all().order_by('name')
+
+        if options['verify']:
+            return self.handle_verify(lists)
+
+        try:
+            before = self.get_cutoff(options['before'])
+        except ValueError:
+            raise CommandError('Invalid month, use YYYY-MM: {}'.format(options['before']))
+
+        total = {'packed': 0, 'current': 0, 'missing': 0}
+        for elist in lists:
+            stats = self.pack_list(elist, before, options['dryrun'])
+            for key, val in stats.items():
+                total[key] += val
+            self.stdout.write('{}: packed:{packed} current:{current} missing:{missing}'.format(
+                elist.name, **stats))
+        self.stdout.write('Total: packed:{packed} current:{current} missing:{missing}'.format(**total))
+
+    def get_cutoff(self, month):
+        '''Returns aware datetime of the start of month, YYYY-MM, default current month'''
+        if month:
+            date = datetime.datetime.strptime(month, '%Y-%m')
+        else:
+            date = datetime.datetime.now(datetime.timezone.utc).replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        return date.replace(tzinfo=datetime.timezone.utc)
+
+    def pack_list(self, elist, before, dryrun=False):
+        '''Pack the list's messages dated before the cutoff.  Returns stats dictionary'''
+        stats = {'packed': 0, 'current': 0, 'missing': 0}
+        messages = Message.objects.filter(email_list=elist, date__lt=before).order_by('date')
+        rows = messages.values_list('hashcode', 'date').iterator()
+        for month, group in itertools.groupby(rows, key=lambda row: get_month(row[1])):
+            month_stats = self.pack_month(elist, month, [row[0] for row in group], dryrun)
+            for key, val in month_stats.items():
+                stats[key] += val
+        logger.info('pack_archive: {} {}'.format(elist.name, stats))
+        return stats
+
+    def pack_month(self, elist, month, hashcodes, dryrun=False):
+        '''Append message files to the month's segment, in date order, then remove
+        them.  Returns stats dictionary
+        '''
+        stats = {'packed': 0, 'current': 0, 'missing': 0}
+        if not dryrun:
+            make_dirs(get_packed_dir(elist.name))
+        index = load_segment_index(elist.name, month)
+        pending = []
+        for hashcode in hashcodes:
+            path = find_path(elist.name, hashcode)
+            if hashcode in index:
+                stats['current'] += 1
+                # left behind by an interrupted run
+                if path and not dryrun:
+                    os.remove(path)
+                continue
+            if path is None:
+                logger.warning('pack_archive: message file missing {}:{}'.format(elist.name, hashcode))
+                stats['missing'] += 1
+                continue
+            stats['packed'] += 1
+            if not dryrun:
+                pending.append((hashcode, path))
+            if len(pending) >= CHUNK_SIZE:
+                self.write_chunk(elist, month, pending)
+                pending = []
+        if pending:
+            self.write_chunk(elist, month, pending)
+        return stats
+
+    def write_chunk(self, elist, month, pending):
+        '''Append files to segment.  Files are removed only after the segment index
+        that references them is written
+        '''
+        append_segment(elist.name, month, [(hashcode, read_file(path)) for hashcode, path in pending])
+        for hashcode, path in pending:
+            os.remove(path)
+
+    def handle_verify(self, lists):
+        '''Check every packed message against the SHA-1 digest of its bytes and
+        the SHA-1 hashcode of its msgid and listname
+        '''
+        total = {'messages': 0, 'errors': 0, 'orphaned': 0}
+        for elist in lists:
+            for month in get_segment_months(elist.name):
+                errors = verify_segment(elist.name, month)
+                index = load_segment_index(elist.name, month)
+                rows = Message.objects.filter(email_list=elist, hashcode__in=list(index))
+                msgids = dict(rows.values_list('hashcode', 'msgid'))
+                for hashcode in sorted(index):
+                    if hashcode not in msgids:
+                        # message deleted after packing
+                        total['orphaned'] += 1
+                    elif get_hash(msgids[hashcode], elist.name) != hashcode:
+                        errors.append((hashcode, 'hashcode mismatch'))
+                for hashcode, error in errors:
+                    self.stdout.write('{}:{}:{}: {}'.format(elist.name, month, hashcode, error))
+                total['messages'] += len(index)
+                total['errors'] += len(errors)
+        self.stdout.write('Total: messages:{messages} errors:{errors} orphaned:{orphaned}'.format(**total))
+        if total['errors']:
+            raise CommandError('Verification failed')
@@ -92,6 +92,16 @@ class Command(BaseCommand):
             ),
         )
 
+        PeriodicTask.objects.get_or_create(
+            name="Requeue batch imports",
+            task="mlarchive.archive.tasks.requeue_import_batch_task",
+            defaults=dict(
+                enabled=False,
+                crontab=self.crontabs["every_15m"],
+                description="Queue again batch import chunks that were never queued or were lost"
+            ),
+        )
+
         PeriodicTask.objects.get_or_create(
             name="Update MBOX",
             task="mlarchive.archive.tasks.update_mbox_files_task",
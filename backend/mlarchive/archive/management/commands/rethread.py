@@ -0,0 +1,87 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.rethread import rethread
+
+import logging
+logger = logging.getLogger(__name__)
+
+STATS = ('threads', 'messages', 'moved', 'fixed', 'skipped')
+
+
+def init_worker():
+    """Pool initializer, see load.init_worker()"""
+    connections.close_all()
+
+
+def rethread_list(listname, dryrun=False, rate=0):
+    """Rethread all messages of the list.  Pool worker function.  Returns tuple
+    (listname, stats, list of Changes, elapsed seconds)
+    """
+    start_time = time.time()
+    stats, changes = rethread(Message.objects.filter(email_list__name=listname), dryrun=dryrun, rate=rate)
+    logger.info('rethread: {} {}'.format(listname, stats))
+    return (listname, stats, changes, time.time() - start_time)
+
+
+class Command(BaseCommand):
+    help = ('Recompute thread order and depth of every message, and the first message, '
+            'date and summary of every thread, see archive/rethread.py.  Lists are processed in name order, '
+            'changes to a list are written in one transaction.  Safe to run on a live archive, '
+            'use --rate to limit the load.  Use --dry-run to report how many messages would '
+            'move, with -v 2 to list them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--listname', dest='listname',
+            help='only rethread this list (default is all lists)')
+        parser.add_argument('-r', '--resume', dest='resume',
+            help='resume an interrupted run, starting at this list')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
+            help='report changes without writing anything')
+        parser.add_argument('-w', '--workers', type=int, dest='workers', default=0,
+            help='rethread lists in parallel using this many processes')
+        parser.add_argument('--rate', type=int, dest='rate', default=0,
+            help='maximum messages per second, per worker (default is no limit)')
+
+    def handle(self, *args, **options):
+        if options['listname']:
+            lists = EmailList.objects.filter(name=options['listname'])
+            if not lists:
+                raise CommandError('List not found: {}'.format(options['listname']))
+        else:
+            lists = EmailList.objects.all().order_by('name')
+        if options['resume']:
+            lists = lists.filter(name__gte=options['resume'])
+        names = list(lists.values_list('name', flat=True))
+        kwargs = {'dryrun': options['dryrun'], 'rate': options['rate']}
+
+        start_time = time.time()
+        total = dict.fromkeys(STATS, 0)
+        if options['workers']:
+            # don't share database connections with the forked workers
+            connections.close_all()
+            with multiprocessing.Pool(processes=options['workers'], initializer=init_worker) as pool:
+                # results in name order, resume with the first list not reported
+                results = [pool.apply_async(rethread_list, (name,), kwargs) for name in names]
+                for result in results:
+                    self.report(total, *result.get(), options)
+        else:
+            for name in names:
+                self.report(total, *rethread_list(name, **kwargs), options)
+        self.stdout.write('Total: {} time:{:.1f}s'.format(self.format_stats(total), time.time() - start_time))
+
+    def format_stats(self, stats):
+        return ' '.join('{}:{}'.format(key, stats[key]) for key in STATS)
+
+    def report(self, total, listname, stats, changes, elapsed, options):
+        for key in STATS:
+            total[key] += stats[key]
+        if options['verbosity'] > 1:
+            for change in changes:
+                self.stdout.write('{}: message:{} thread:{} depth,order:{},{} -> {},{}'.format(
+                    listname, change.pk, change.thread_id, *change.old, *change.new))
+        self.stdout.write('{}: {} time:{:.1f}s'.format(listname, self.format_stats(stats), elapsed))
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.13 on 2026-10-17 10:12
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def forward(apps, schema_editor):
+    '''Populate the summary fields with one update, see
+    models.get_thread_summary_expressions()
+    '''
+    Message = apps.get_model('archive', 'Message')
+    Thread = apps.get_model('archive', 'Thread')
+
+    messages = Message.objects.filter(thread=OuterRef('pk')).order_by().values('thread')
+    Thread.objects.update(
+        message_count=Coalesce(Subquery(messages.annotate(value=Count('id')).values('value')), 0),
+        last_date=Subquery(messages.annotate(value=Max('date')).values('value')),
+        participant_count=Coalesce(
+            Subquery(messages.annotate(value=Count('frm', distinct=True)).values('value')), 0),
+        subject=Coalesce(Subquery(
+            Message.objects.filter(thread=OuterRef('pk')).order_by('date').values('subject')[:1]), Value('')),
+    )
+
+
+def reverse(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("archive", "0003_fix_message_msgid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="thread",
+            name="last_date",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="message_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="participant_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="subject",
+            field=models.CharField(blank=True, max_length=512),
+        ),
+        migrations.RunPython(forward, reverse),
+    ]
@@ -10,11 +10,14 @@ import subprocess
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import Case, Count, F, Max, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.urls import reverse
 from django.utils.http import urlencode
 from django.template.loader import render_to_string
 
 from mlarchive.archive.generator import Generator
+from mlarchive.archive.storage import get_month, open_message, read_message, resolve_path
 from mlarchive.archive.thread import parse_message_ids
 from mlarchive.utils.encoding import is_attachment, custom_policy
 
@@ -73,6 +76,22 @@ def is_small_year(email_list, year):
     return count < settings.STATIC_INDEX_YEAR_MINIMUM
 
 
+def get_thread_summary_expressions():
+    '''Returns dictionary of expressions that compute the Thread summary fields
+    from the thread's messages, for use with update(), ie.
+    Thread.objects.filter(...).update(**get_thread_summary_expressions())
+    '''
+    messages = Message.objects.filter(thread=OuterRef('pk')).order_by().values('thread')
+    return {
+        'message_count': Coalesce(Subquery(messages.annotate(value=Count('id')).values('value')), 0),
+        'last_date': Subquery(messages.annotate(value=Max('date')).values('value')),
+        'participant_count': Coalesce(
+            Subquery(messages.annotate(value=Count('frm', distinct=True)).values('value')), 0),
+        'subject': Coalesce(Subquery(
+            Message.objects.filter(thread=OuterRef('pk')).order_by('date').values('subject')[:1]), Value('')),
+    }
+
+
 # --------------------------------------------------
 # Models
 # --------------------------------------------------
@@ -83,6 +102,14 @@ class Thread(models.Model):
     email_list = models.ForeignKey('EmailList', db_index=True, on_delete=models.CASCADE, null=True)
     # first message in thread, by date
     first = models.ForeignKey('Message', on_delete=models.SET_NULL, related_name='thread_key', blank=True, null=True)
+    # summary of the thread's messages, maintained by the Message signal handlers,
+    # MessageBatch and rethreading.  See get_summary()
+    message_count = models.IntegerField(default=0)
+    last_date = models.DateTimeField(blank=True, null=True, db_index=True)     # date of last message
+    participant_count = models.IntegerField(default=0)                       # distinct From
+    subject = models.CharField(max_length=512, blank=True)                   # subject of first message
+
+    SUMMARY_FIELDS = ('message_count', 'last_date', 'participant_count', 'subject')
 
     def __str__(self):
         return str(self.id)
@@ -100,7 +127,49 @@ class Thread(models.Model):
             message = self.message_set.all().order_by('date').first()
         self.first = message
         self.date = message.date
-        self.save()
+        self.subject = message.subject
+        self.save(update_fields=['first', 'date', 'subject', 'email_list'])
+
+    def get_summary(self):
+        """Returns dictionary of the summary fields computed from the thread's messages"""
+        messages = self.message_set.all()
+        summary = messages.aggregate(message_count=Count('id'),
+                                     last_date=Max('date'),
+                                     participant_count=Count('frm', distinct=True))
+        first = messages.order_by('date').first()
+        summary['subject'] = first.subject if first else ''
+        return summary
+
+    def update_summary(self):
+        """Recompute and save the summary fields"""
+        for field, value in self.get_summary().items():
+            setattr(self, field, value)
+        self.save(update_fields=self.SUMMARY_FIELDS)
+
+    def add_message(self, message):
+        """Update the summary fields for message, which has just been saved to
+        the thread.  The fields are updated in the database with expressions
+        of their current values, so concurrent writers to the thread, ie. the
+        archiver and load, don't lose updates.  Only the distinct participant
+        count is recomputed from the thread's messages
+        """
+        date = Value(message.date)
+        self._update_counts(message_count=F('message_count') + 1,
+                            last_date=Coalesce(Greatest(F('last_date'), date), date))
+
+    def remove_message(self, message):
+        """Update the summary fields for message, which has just been deleted
+        from the thread, see add_message().  last_date is recomputed only if
+        message was the last one
+        """
+        last_date = Case(When(last_date__lte=message.date, then=get_thread_summary_expressions()['last_date']),
+                         default=F('last_date'))
+        self._update_counts(message_count=Greatest(F('message_count') - 1, 0), last_date=last_date)
+
+    def _update_counts(self, **values):
+        values['participant_count'] = get_thread_summary_expressions()['participant_count']
+        Thread.objects.filter(pk=self.pk).update(**values)
+        self.refresh_from_db(fields=['message_count', 'last_date', 'participant_count'])
 
     def get_next(self):
         """Returns next thread in the list"""
@@ -184,8 +253,7 @@ class Message(models.Model):
         """Returns the message formated as HTML.  Uses MHonarc standalone
         Not used as of v1.00
         """
-        with open(self.get_file_path()) as f:
-            mhout = subprocess.check_output(TXT2HTML, stdin=f)
+        mhout = subprocess.check_output(TXT2HTML, input=self.read_file())
 
         # extract body
         within = False
@@ -242,7 +310,7 @@ class Message(models.Model):
             return self._pymsg
         else:
             try:
-                with open(self.get_file_path(), 'rb') as f:
+                with self.open_file() as f:
                     self._pymsg = get_message_from_binary_file(f, policy=custom_policy)
                     self._pymsg_error = ''
             except IOError:
@@ -298,8 +366,7 @@ class Message(models.Model):
         NOTE: this will include encoded attachments
         """
         try:
-            with open(self.get_file_path(), 'rb') as f:
-                return f.read()
+            return self.read_file()
         except IOError:
             msg = 'Error reading message file: %s' % self.get_file_path()
             logger.error(msg)
@@ -365,10 +432,8 @@ class Message(models.Model):
         return [host_url + self.get_static_date_page_url(), host_url + self.get_static_thread_page_url()]
 
     def get_file_path(self):
-        return os.path.join(
-            settings.ARCHIVE_DIR,
-            self.email_list.name,
-            self.hashcode)
+        """Returns path of the message file, in whichever storage layout it exists"""
+        return resolve_path(self.email_list.name, self.hashcode)
 
     def get_from_line(self):
         """Returns the "From " envelope header from the original mbox file if it
@@ -467,6 +532,16 @@ class Message(models.Model):
         else:
             return None
 
+    def open_file(self):
+        """Returns binary file object of the original message, from the message
+        file or packed segment, see storage.py
+        """
+        return open_message(self.email_list.name, self.hashcode, get_month(self.date))
+
+    def read_file(self):
+        """Returns bytes of the original message.  Raises IOError if not found"""
+        return read_message(self.email_list.name, self.hashcode, get_month(self.date))
+
     @property
     def thread_date(self):
         """Returns the date of the first message in the associated thread.  Use for
@@ -1,14 +1,15 @@
+import json
 import random
 import re
 from datetime import datetime, timedelta, timezone
 
 from django.conf import settings
 from django.core.cache import cache
-from django.core.paginator import Paginator
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import RequestError
-from elasticsearch_dsl import Q, Search
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, RequestError, TransportError
+from elasticsearch_dsl import MultiSearch, Q, Search
 
+from mlarchive.archive.backends.connections import get_client
 from mlarchive.archive.utils import get_lists
 
 import logging
@@ -25,6 +26,9 @@ VALID_SORT_OPTIONS = ('frm', '-frm', 'date', '-date', 'email_list', '-email_list
 DEFAULT_SORT = getattr(settings, 'ARCHIVE_DEFAULT_SORT', '-date')
 DB_THREAD_SORT_FIELDS = ('-thread__date', 'thread_id', 'thread_order')
 IDX_THREAD_SORT_FIELDS = ('-thread_date', 'thread_id', 'thread_order')
+# last sort field of every search, unique per message, so the sort values of a
+# hit identify its position for search_after
+SEARCH_AFTER_TIEBREAKER = 'django_id'
 
 # --------------------------------------------------
 # Functions handle URL parameters
@@ -58,13 +62,7 @@ def get_cached_query(request):
     search_dict = cache.get(queryid)
     if search_dict:
         logger.debug('Found search in cache: {}'.format(search_dict))
-        connection_options = settings.ELASTICSEARCH_CONNECTION
-        client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
-        search = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+        search = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
         search = search.update_from_dict(search_dict)
         logger.debug('Built search object from cache: {}'.format(search))
         return (queryid, search)
@@ -72,6 +70,56 @@ def get_cached_query(request):
         return (None, None)
 
 
+def get_result_window_key(queryid):
+    return '{}-window'.format(queryid)
+
+
+def get_result_window(queryid):
+    '''Returns the result window of queryid, see update_result_window()'''
+    return cache.get(get_result_window_key(queryid)) or {}
+
+
+def get_window_items(hits):
+    '''Returns list of (message pk, sort values) of search hits'''
+    items = []
+    for hit in hits:
+        sort_values = getattr(hit.meta, 'sort', None)
+        items.append((int(hit.django_id), list(sort_values) if sort_values is not None else None))
+    return items
+
+
+def update_result_window(queryid, items, first=False, last=False):
+    '''Record the order of results of queryid served to the user, so the detail
+    page can find a message's neighbours in the results without running the
+    search.  items is a list of (message pk, sort values), consecutive results,
+    sort values may be None if unknown.  first / last mean the items start / end
+    the results.
+
+    The window is a dictionary of message pk to a dictionary of "sort" and, when
+    known, "previous" and "next" message pk, None if there is none.  It keeps
+    the SEARCH_RESULT_WINDOW_SIZE messages recorded most recently
+    '''
+    if not items:
+        return
+    key = get_result_window_key(queryid)
+    window = cache.get(key) or {}
+    pks = [pk for pk, _ in items]
+    for i, (pk, sort_values) in enumerate(items):
+        # move to the end, the most recent
+        entry = window.pop(pk, {})
+        if sort_values is not None:
+            entry['sort'] = sort_values
+        if i > 0 or first:
+            entry['previous'] = pks[i - 1] if i > 0 else None
+        if i < len(items) - 1 or last:
+            entry['next'] = pks[i + 1] if i < len(items) - 1 else None
+        window[pk] = entry
+    for pk in list(window)[:max(0, len(window) - settings.SEARCH_RESULT_WINDOW_SIZE)]:
+        del window[pk]
+    # same lifetime as the cached query
+    cache.set(key, window, 7200)
+
+
 def clean_queryid(query_id):
     if VALID_QUERYID_RE.match(query_id):
         return query_id
@@ -261,16 +309,79 @@ def get_count(query):
     return count
 
 
+def get_total(response):
+    '''Returns the total hits of a search response, an integer, or a dictionary
+    with "value" from Elasticsearch 7'''
+    total = response.hits.total
+    return total if isinstance(total, int) else total.value
+
+
+def run_multi_search(queries):
+    '''Execute the queries with one _msearch request.  Returns list of responses
+    in the same order.  Raises RequestError for a bad query, as execute() does.
+    Connection and server errors are raised unchanged'''
+    ms = MultiSearch(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    for query in queries:
+        ms = ms.add(query)
+    try:
+        return ms.execute()
+    except TransportError as error:
+        # msearch reports the error of each query in its response, which
+        # MultiSearch raises with status 'N/A'.  ConnectionError uses the same
+        # status so check for it first
+        if isinstance(error, ESConnectionError) or error.status_code != 'N/A':
+            raise
+        raise RequestError(400, error.error, error.info)
+
+
+def parse_sort_values(value, query):
+    '''Returns the list of sort values from value, JSON as rendered with the
+    search results, or None if it isn't valid for query'''
+    try:
+        values = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != len(query.to_dict().get('sort', [])):
+        return None
+    if not all(isinstance(v, (str, int, float)) or v is None for v in values):
+        return None
+    return values
+
+
+def reverse_sort(sort):
+    '''Returns the list of sort fields, as in Search.to_dict(), in reverse order'''
+    fields = []
+    for field in sort:
+        if isinstance(field, dict):
+            (name, options), = field.items()
+            options = {'order': options} if isinstance(options, str) else dict(options)
+        else:
+            name, options = field, {}
+        order = options.get('order', 'desc' if name == '_score' else 'asc')
+        options['order'] = 'asc' if order == 'desc' else 'desc'
+        # keep hits missing the field at the same end of the results
+        options['missing'] = '_first' if options.get('missing', '_last') == '_last' else '_last'
+        fields.append({name: options})
+    return fields
+
+
+def run_search_after(query, sort_values, size, reverse=False):
+    '''Returns list of size hits of query following the hit with sort_values,
+    or preceding it if reverse.  Unlike from / size the cost doesn't grow with
+    the position in the results, nor is it limited by max_result_window'''
+    if reverse:
+        query = query.sort(*reverse_sort(query.to_dict().get('sort', [])))
+    query = query.extra(search_after=sort_values, track_total_hits=False)[:size]
+    hits = list(run_query(query))
+    if reverse:
+        hits.reverse()
+    return hits
+
+
 # TODO: remove?
 def get_empty_response():
     '''Return an empty elasticsearch response'''
-    connection_options = settings.ELASTICSEARCH_CONNECTION
-    client = Elasticsearch(
-        connection_options['URL'],
-        index=connection_options['INDEX_NAME'],
-        http_auth=connection_options['http_auth'],
-        **connection_options.get('KWARGS', {}))
-    s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
     s = s.query('term', dummy='')
     return s.execute()
 
@@ -278,23 +389,47 @@ def get_empty_response():
 class CustomPaginator(Paginator):
     '''A Django Paginator customized to handle Elasticsearch Search
     object as object_list input. page.object_list is the search
-    response object'''
+    response object.
+
+    A page of a Search is one request, with track_total_hits, which returns
+    the hits, the count and any aggregations of the search.  Paginator.count
+    is taken from the response rather than a separate count request'''
 
     def page(self, number):
         """Return a Page object for the given 1-based page number."""
-        # Note: this will call search.count() which will unveil
-        # any parsing errors
-        number = self.validate_number(number)
+        if not hasattr(self.object_list, 'execute'):
+            return super().page(number)
+
+        # count is unknown until the page is fetched, check the lower bound only
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
         bottom = (number - 1) * self.per_page
         top = bottom + self.per_page
-        if top + self.orphans >= self.count:
-            top = self.count
 
-        # add slice info to query and execute to get actual object_list
-        query = self.object_list[bottom:top]
-        if hasattr(query, 'execute'):
-            response = run_query(query)
+        # Note: executing the query will unveil any parsing errors
+        if self.orphans:
+            # the last page takes the orphans, fetch the page with and without
+            # them in one request
+            response, last = run_multi_search([
+                self.get_page_query(bottom, top),
+                self.get_page_query(bottom, top + self.orphans)])
+            self.set_count(get_total(last))
+            if top + self.orphans >= self.count:
+                response = last
         else:
-            response = query
+            response = self.get_page_query(bottom, top).execute()
+            self.set_count(get_total(response))
 
+        number = self.validate_number(number)
         return self._get_page(response, number, self)
+
+    def get_page_query(self, bottom, top):
+        return self.object_list[bottom:top].extra(track_total_hits=True)
+
+    def set_count(self, count):
+        # Paginator.count is a cached_property
+        self.__dict__['count'] = count
@@ -0,0 +1,197 @@
+'''Bulk rethreading of archived messages.  Recomputes thread_order and
+thread_depth of every message of a set of threads with thread.BulkThreader,
+which gives the same result as compute_thread(), and repairs Thread.first,
+Thread.date and the Thread summary fields.  Used by the rethread command.
+
+Messages are read as rows of values, not Message instances, in thread and date
+order, one thread at a time, so memory is bounded by the largest thread rather
+than the size of the archive.  Only changed messages are written, with
+bulk_update() in one transaction, followed by messages_bulk_saved so the search
+index is updated.  Message.thread is not changed.
+
+Rethreading is safe alongside incoming mail.  The threads to be written are
+locked with select_for_update() and checked in the same transaction: a thread
+whose messages were added, removed or updated since it was read is skipped, to
+be picked up by the next run, rather than overwritten with stale values.  New
+messages and Thread summary updates wait on the lock until the write commits.
+'''
+
+import itertools
+import time
+from collections import namedtuple
+from operator import attrgetter
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from mlarchive.archive.models import Message, Thread
+from mlarchive.archive.signals import messages_bulk_saved
+from mlarchive.archive.thread import BulkThreader
+
+BATCH_SIZE = 1000
+THREAD_FIELDS = ('first', 'date') + Thread.SUMMARY_FIELDS
+ROW_FIELDS = ('pk', 'thread_id', 'msgid', 'date', 'frm', 'subject', 'base_subject', 'references',
+              'in_reply_to_value', 'thread_depth', 'thread_order', 'updated') + \
+    tuple('thread_' + f for f in THREAD_FIELDS)
+
+Row = namedtuple('Row', ROW_FIELDS)
+# old and new are tuples (depth, order)
+Change = namedtuple('Change', ['pk', 'thread_id', 'old', 'new'])
+# the messages of a thread as read, to detect concurrent changes
+State = namedtuple('State', ['pks', 'updated'])
+
+
+def make_row(**fields):
+    '''Returns Row of fields, the others None, thread_depth and thread_order 0.
+    For rows not read with get_threads(), ie. bin/benchmark_thread.py
+    '''
+    values = dict.fromkeys(Row._fields)
+    values.update(thread_depth=0, thread_order=0, **fields)
+    return Row(**values)
+
+
+class RateLimiter(object):
+    '''Limits processing to rate messages per second, zero for no limit.  Call
+    wait() after processing count messages
+    '''
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.count = 0
+        self.start = time.monotonic()
+
+    def wait(self, count):
+        if not self.rate:
+            return
+        self.count += count
+        ahead = self.count / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def chunks(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_threads(messages):
+    '''Returns generator of lists of Rows, one list per thread, in date order.
+    messages is a Message queryset which should include all messages of each
+    thread it touches
+    '''
+    rows = messages.annotate(**{'thread_' + f: F('thread__' + f) for f in THREAD_FIELDS})
+    rows = rows.order_by('thread_id', 'date', 'pk').values_list(*ROW_FIELDS)
+    rows = map(Row._make, rows.iterator(chunk_size=BATCH_SIZE))
+    for _, group in itertools.groupby(rows, key=attrgetter('thread_id')):
+        yield list(group)
+
+
+def get_changes(rows, threader=None):
+    '''Returns list of Changes for the messages of one thread, rows as returned
+    by get_threads(), whose stored depth or order differ from the computed ones
+    '''
+    threader = threader or BulkThreader()
+    changes = []
+    for info in threader.compute_thread(rows):
+        row = info.message
+        old = (row.thread_depth, row.thread_order)
+        if old != (info.depth, info.order):
+            changes.append(Change(row.pk, row.thread_id, old, (info.depth, info.order)))
+    return changes
+
+
+def get_thread(rows):
+    '''Returns unsaved Thread with first, date and summary fields computed from
+    rows, or None if the stored ones are correct.  See Thread.set_first() and
+    Thread.get_summary()
+    '''
+    first = rows[0]
+    thread = Thread(pk=first.thread_id,
+                    first_id=first.pk,
+                    date=first.date,
+                    message_count=len(rows),
+                    last_date=rows[-1].date,
+                    participant_count=len({row.frm for row in rows}),
+                    subject=first.subject)
+    stored = tuple(getattr(first, 'thread_' + f) for f in THREAD_FIELDS)
+    if stored != (thread.first_id,) + tuple(getattr(thread, f) for f in THREAD_FIELDS[1:]):
+        return thread
+
+
+def get_state(rows):
+    '''Returns State of one thread, rows as returned by get_threads()'''
+    return State(frozenset(row.pk for row in rows), max(row.updated for row in rows))
+
+
+def get_changed_threads(states):
+    '''Returns set of thread ids whose current State differs from the one in
+    states, a dictionary of thread id to State
+    '''
+    pks = {}
+    updated = {}
+    for thread_ids in chunks(sorted(states)):
+        rows = Message.objects.filter(thread_id__in=thread_ids).values_list('thread_id', 'pk', 'updated')
+        for thread_id, pk, date in rows.iterator(chunk_size=BATCH_SIZE):
+            pks.setdefault(thread_id, set()).add(pk)
+            updated[thread_id] = max(updated.get(thread_id, date), date)
+    return {pk for pk, state in states.items() if State(pks.get(pk), updated.get(pk)) != state}
+
+
+def write_changes(changes, threads=(), states=None):
+    '''Writes message changes and Threads, as returned by get_thread(), in one
+    transaction.  states is a dictionary of the State read per thread, the
+    threads are locked and those whose messages changed since are skipped.
+    Returns list of thread ids skipped
+    '''
+    skipped = set()
+    now = timezone.now()
+    with transaction.atomic():
+        if states:
+            # lock in pk order, so concurrent writers can't deadlock
+            for thread_ids in chunks(sorted(states)):
+                list(Thread.objects.select_for_update().filter(pk__in=thread_ids).order_by('pk').values_list('pk'))
+            skipped = get_changed_threads(states)
+            changes = [c for c in changes if c.thread_id not in skipped]
+            threads = [t for t in threads if t.pk not in skipped]
+        for batch in chunks(changes):
+            messages = [Message(pk=c.pk, thread_depth=c.new[0], thread_order=c.new[1], updated=now) for c in batch]
+            Message.objects.bulk_update(messages, ['thread_order', 'thread_depth', 'updated'])
+        Thread.objects.bulk_update(threads, THREAD_FIELDS, batch_size=BATCH_SIZE)
+
+    # index once committed, with complete instances
+    for batch in chunks([c.pk for c in changes]):
+        messages_bulk_saved.send(sender=Message, instances=list(Message.objects.filter(pk__in=batch)))
+    return sorted(skipped)
+
+
+def rethread(messages, dryrun=False, rate=0):
+    '''Rethreads the threads of messages, a Message queryset, ie. the messages
+    of one list.  Returns tuple (stats dictionary, list of Changes).  Changes
+    are written in one transaction unless dryrun
+    '''
+    stats = {'threads': 0, 'messages': 0, 'moved': 0, 'fixed': 0, 'skipped': 0}
+    threader = BulkThreader()
+    limiter = RateLimiter(rate)
+    changes = []
+    threads = []
+    states = {}
+    for rows in get_threads(messages):
+        thread_changes = get_changes(rows, threader)
+        thread = get_thread(rows)
+        if thread_changes or thread:
+            states[rows[0].thread_id] = get_state(rows)
+        changes.extend(thread_changes)
+        if thread:
+            threads.append(thread)
+        stats['threads'] += 1
+        stats['messages'] += len(rows)
+        limiter.wait(len(rows))
+
+    if not dryrun and states:
+        skipped = set(write_changes(changes, threads, states))
+        stats['skipped'] = len(skipped)
+        changes = [c for c in changes if c.thread_id not in skipped]
+        threads = [t for t in threads if t.pk not in skipped]
+    stats['moved'] = len(changes)
+    stats['fixed'] = len(threads)
+    return stats, changes
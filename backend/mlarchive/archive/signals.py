@@ -11,16 +11,22 @@ from importlib import import_module
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.dispatch import receiver
+from django.dispatch import Signal, receiver
 from django.db.models.signals import pre_delete, post_delete, post_save
 from django.db import models, connection, transaction
 
-from mlarchive.archive.models import Message, EmailList
+from mlarchive.archive import timing
+from mlarchive.archive.models import Message, EmailList, Thread
 from mlarchive.archive.backends.elasticsearch import ESBackend, get_identifier
+from mlarchive.archive.storage import find_path, get_month, remove_packed
 from mlarchive.archive.utils import _export_lists
 
 logger = logging.getLogger(__name__)
 
+# Sent after a batch of messages is written with bulk_create() / bulk_update(),
+# which do not send post_save.  Provides argument "instances", a list of Messages
+messages_bulk_saved = Signal()
+
 
 # --------------------------------------------------
 # Signal Handlers
@@ -37,29 +43,18 @@ def _clear_lists_cache(sender, instance, **kwargs):
 @receiver(pre_delete, sender=Message)
 def _message_remove(sender, instance, **kwargs):
     """When messages are removed, via the admin page, we need to move the message
-    archive file to the "_removed" directory and purge the cache
+    archive file to the "_removed" directory and purge the cache.  A packed
+    message is removed from its segment index and its bytes written to "_removed"
     """
-    path = instance.get_file_path()
-    if not os.path.exists(path):
-        return
-    target_dir = instance.get_removed_dir()
-    if not os.path.exists(target_dir):
-        os.mkdir(target_dir)
-        os.chmod(target_dir, 0o2777)
-    target_path = os.path.join(target_dir, os.path.basename(path))
-    if os.path.exists(target_path):
-        os.remove(path)
-    else:
-        shutil.move(path, target_dir)
-
-    logger.info('message file moved: {} => {}'.format(path, target_dir))
+    move_message_file(instance)
 
     # if message is first of many in thread, should reset thread.first before
-    # deleting
-    if (instance.thread.first == instance and
-            instance.thread.message_set.count() > 1):
-        next_in_thread = instance.thread.message_set.order_by('date')[1]
-        instance.thread.set_first(next_in_thread)
+    # deleting.  Query the thread's messages, message_count may have been
+    # changed by another process since the thread was read
+    if instance.thread.first_id == instance.pk:
+        next_in_thread = instance.thread.message_set.exclude(pk=instance.pk).order_by('date').first()
+        if next_in_thread:
+            instance.thread.set_first(next_in_thread)
 
     # handle cache
     if settings.SERVER_MODE == 'production' and settings.USING_CDN:
@@ -67,13 +62,26 @@ def _message_remove(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=Message)
-def _update_thread(sender, instance, **kwargs):
+def _update_thread(sender, instance, created=False, **kwargs):
     """When messages are saved, udpate thread info
     """
+    if created:
+        instance.thread.add_message(instance)
     if not instance.thread.first or instance.date < instance.thread.date:
         instance.thread.set_first(instance)
 
 
+@receiver(post_delete, sender=Message)
+def _update_thread_remove(sender, instance, **kwargs):
+    """When messages are deleted, update thread summary
+    """
+    try:
+        thread = Thread.objects.get(pk=instance.thread_id)
+    except Thread.DoesNotExist:
+        return
+    thread.remove_message(instance)
+
+
 @receiver(post_save, sender=Message)
 def _purge_cache(sender, instance, created, **kwargs):
     if created and settings.SERVER_MODE == 'production' and settings.USING_CDN:
@@ -90,6 +98,37 @@ def _list_save_handler(sender, instance, created, **kwargs):
 # --------------------------------------------------
 
 
+def move_message_file(message):
+    """Move the message file, or packed message, to the list's "_removed" directory"""
+    path = find_path(message.email_list.name, message.hashcode)
+    data = None
+    if path is None:
+        data = remove_packed(message.email_list.name, message.hashcode, get_month(message.date))
+        if data is None:
+            return
+    target_dir = message.get_removed_dir()
+    if not os.path.exists(target_dir):
+        os.mkdir(target_dir)
+        os.chmod(target_dir, 0o2777)
+
+    if data is not None:
+        target_path = os.path.join(target_dir, message.hashcode)
+        if not os.path.exists(target_path):
+            with open(target_path, 'wb') as f:
+                f.write(data)
+        logger.info('packed message removed: {}:{} => {}'.format(
+            message.email_list.name, message.hashcode, target_dir))
+        return
+
+    target_path = os.path.join(target_dir, os.path.basename(path))
+    if os.path.exists(target_path):
+        os.remove(path)
+    else:
+        shutil.move(path, target_dir)
+
+    logger.info('message file moved: {} => {}'.format(path, target_dir))
+
+
 def get_purge_cache_urls(message, created=True):
     """Retuns a list of absolute urls to purge from cache when message
     is created or deleted
@@ -174,11 +213,22 @@ class BaseSignalProcessor(object):
         Given an individual model instance, update the index
         """
         try:
-            self.backend.update([instance])
+            with timing.stage('index'):
+                self.backend.update([instance])
         except Exception:
             # TODO: Maybe log it or let the exception bubble?
             pass
 
+    def handle_bulk_save(self, sender, instances, **kwargs):
+        """
+        Given a list of model instances, update the index with one request
+        """
+        try:
+            with timing.stage('index'):
+                self.backend.update(instances)
+        except Exception:
+            pass
+
     def handle_delete(self, sender, instance, **kwargs):
         """
         Given an individual model instance, delete from index.
@@ -198,10 +248,12 @@ class RealtimeSignalProcessor(BaseSignalProcessor):
     def setup(self):
         models.signals.post_save.connect(self.handle_save, sender=Message)
         models.signals.post_delete.connect(self.handle_delete, sender=Message)
+        messages_bulk_saved.connect(self.handle_bulk_save, sender=Message)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.handle_save, sender=Message)
         models.signals.post_delete.disconnect(self.handle_delete, sender=Message)
+        messages_bulk_saved.disconnect(self.handle_bulk_save, sender=Message)
 
 
 class CelerySignalProcessor(BaseSignalProcessor):
@@ -209,28 +261,38 @@ class CelerySignalProcessor(BaseSignalProcessor):
     def setup(self):
         models.signals.post_save.connect(self.enqueue_save, sender=Message)
         models.signals.post_delete.connect(self.enqueue_delete, sender=Message)
+        messages_bulk_saved.connect(self.enqueue_bulk_save, sender=Message)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.enqueue_save, sender=Message)
         models.signals.post_delete.disconnect(self.enqueue_delete, sender=Message)
+        messages_bulk_saved.disconnect(self.enqueue_bulk_save, sender=Message)
 
     def enqueue_save(self, sender, instance, **kwargs):
         return self.enqueue('update', instance, sender, **kwargs)
 
+    def enqueue_bulk_save(self, sender, instances, **kwargs):
+        return self.enqueue('bulk_update', instances, sender, **kwargs)
+
     def enqueue_delete(self, sender, instance, **kwargs):
         return self.enqueue('delete', instance, sender, **kwargs)
 
     def enqueue(self, action, instance, sender, **kwargs):
-        enqueue_task(action, instance)
+        with timing.stage('index'):
+            enqueue_task(action, instance)
         return
 
 
 def enqueue_task(action, instance, **kwargs):
     """
     Common utility for enqueing a task for the given action and
-    model instance.
+    model instance.  For action "bulk_update" instance is a list of
+    instances, sent as a list of identifiers.
     """
-    identifier = get_identifier(instance)
+    if action == 'bulk_update':
+        identifier = [get_identifier(i) for i in instance]
+    else:
+        identifier = get_identifier(instance)
 
     task = get_update_task()
     task_func = lambda: task.apply_async((action, identifier), kwargs) # noqa
@@ -0,0 +1,378 @@
+'''This module defines the on-disk layouts of the message store.  Message files
+are named by hashcode and stored under ARCHIVE_DIR/[listname].
+
+flat:       ARCHIVE_DIR/[listname]/[hashcode]
+sharded:    ARCHIVE_DIR/[listname]/[h0]/[h1]/[hashcode], subdirectories are
+            taken from the leading characters of the hashcode
+
+New messages are written using the layout named by settings.ARCHIVE_LAYOUT.
+Readers use resolve_path() which also finds files stored in any other layout,
+so an archive can be converted, with the migrate_storage command, while in use.
+
+Message files may also be compressed, settings.ARCHIVE_COMPRESSION.  The
+format is given by the file name suffix, ie. [hashcode].gz.  Always read
+message files with open_file() or read_file() which decompress transparently,
+returning the original bytes.  zstd requires the optional zstandard package.
+
+Messages of closed months can be packed, with the pack_archive command, into
+one append-only segment per list and month:
+
+ARCHIVE_DIR/[listname]/_packed/[YYYY-MM].seg    original message bytes, concatenated
+ARCHIVE_DIR/[listname]/_packed/[YYYY-MM].idx    JSON index, {hashcode: [offset, length, sha1]}
+
+sha1 is the hex digest of the message bytes, used by verify_segment().  Message
+files are only removed once the index referencing them is on disk.  Use
+read_message() or open_message() to read a message from whichever store
+holds it, loose files take precedence.  Deleting a packed message removes its
+entry from the index, see remove_packed(), the bytes stay in the segment
+unreferenced.
+'''
+
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compressor(object):
+    '''Compression format of message files'''
+    def __init__(self, name, suffix):
+        self.name = name
+        self.suffix = suffix
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def open(self, path):
+        return io.BytesIO(self.decompress(read_raw(path)))
+
+
+class GzipCompressor(Compressor):
+    def compress(self, data):
+        # fixed mtime so output depends only on data
+        return gzip.compress(data, compresslevel=6, mtime=0)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+    def open(self, path):
+        return gzip.open(path, 'rb')
+
+
+class ZstdCompressor(Compressor):
+    def compress(self, data):
+        if zstandard is None:
+            raise ImproperlyConfigured('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def decompress(self, data):
+        if zstandard is None:
+            raise ImproperlyConfigured('zstd compression requires the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor('gzip', '.gz'),
+    'zstd': ZstdCompressor('zstd', '.zst'),
+}
+SUFFIXES = {c.suffix: c for c in COMPRESSORS.values()}
+
+
+class FlatLayout(object):
+    '''All of a list's messages in one directory'''
+    name = 'flat'
+
+    def get_path(self, listname, hashcode):
+        return os.path.join(settings.ARCHIVE_DIR, listname, hashcode)
+
+
+class ShardedLayout(object):
+    '''Messages in hash prefix subdirectories.  Hashcodes are base64 so each level
+    of width one has up to 64 subdirectories, the default of two levels spreads a
+    list over 4096 directories.
+    '''
+    name = 'sharded'
+
+    def __init__(self, levels=2, width=1):
+        self.levels = levels
+        self.width = width
+
+    def get_shard(self, hashcode):
+        '''Returns list of subdirectory names for hashcode'''
+        return [hashcode[i * self.width:(i + 1) * self.width] for i in range(self.levels)]
+
+    def get_path(self, listname, hashcode):
+        return os.path.join(settings.ARCHIVE_DIR, listname, *self.get_shard(hashcode), hashcode)
+
+
+LAYOUTS = {
+    FlatLayout.name: FlatLayout,
+    ShardedLayout.name: ShardedLayout,
+}
+
+
+def get_layout(name=None):
+    '''Returns layout instance, default is settings.ARCHIVE_LAYOUT'''
+    name = name or settings.ARCHIVE_LAYOUT
+    try:
+        klass = LAYOUTS[name]
+    except KeyError:
+        raise ValueError('Unknown archive layout: {}'.format(name))
+    return klass(**settings.ARCHIVE_LAYOUT_OPTIONS.get(name, {}))
+
+
+def get_compressor(name=None):
+    '''Returns Compressor, default is settings.ARCHIVE_COMPRESSION, or None
+    for uncompressed
+    '''
+    name = name or settings.ARCHIVE_COMPRESSION
+    if not name:
+        return None
+    try:
+        return COMPRESSORS[name]
+    except KeyError:
+        raise ValueError('Unknown archive compression: {}'.format(name))
+
+
+def get_suffix(compression=None):
+    compressor = get_compressor(compression)
+    return compressor.suffix if compressor else ''
+
+
+def split_suffix(path):
+    '''Returns tuple (path without compression suffix, suffix)'''
+    base, ext = os.path.splitext(path)
+    if ext in SUFFIXES:
+        return base, ext
+    return path, ''
+
+
+def get_write_path(listname, hashcode):
+    '''Returns path to write a new message file to.  write_file() compresses
+    according to the suffix
+    '''
+    return get_layout().get_path(listname, hashcode) + get_suffix()
+
+
+def find_path(listname, hashcode):
+    '''Returns path of existing message file in any layout and compression,
+    or None
+    '''
+    layout = get_layout()
+    preferred = get_suffix()
+    suffixes = [preferred] + [x for x in [''] + list(SUFFIXES) if x != preferred]
+    names = [layout.name] + [name for name in LAYOUTS if name != layout.name]
+    for name in names:
+        base = get_layout(name).get_path(listname, hashcode)
+        for suffix in suffixes:
+            if os.path.exists(base + suffix):
+                return base + suffix
+
+
+def resolve_path(listname, hashcode):
+    '''Returns path of the message file.  If the file doesn't exist returns the
+    path in the current layout
+    '''
+    return find_path(listname, hashcode) or get_write_path(listname, hashcode)
+
+
+def compress(data, path):
+    '''Returns data compressed as called for by the suffix of path'''
+    compressor = SUFFIXES.get(split_suffix(path)[1])
+    return compressor.compress(data) if compressor else data
+
+
+def read_raw(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_file(path):
+    '''Returns the contents of message file, decompressed'''
+    compressor = SUFFIXES.get(split_suffix(path)[1])
+    data = read_raw(path)
+    return compressor.decompress(data) if compressor else data
+
+
+def open_file(path):
+    '''Returns binary file object of the message file, decompressed'''
+    compressor = SUFFIXES.get(split_suffix(path)[1])
+    if compressor:
+        return compressor.open(path)
+    return open(path, 'rb')
+
+
+# --------------------------------------------------
+# Packed segments
+# --------------------------------------------------
+
+PACKED_DIR = '_packed'
+
+# cache of loaded segment indexes, {index path: (mtime, index)}
+_segment_indexes = {}
+
+
+def get_month(date):
+    '''Returns the segment name, YYYY-MM in UTC, for a message date'''
+    if date.tzinfo:
+        date = date.astimezone(datetime.timezone.utc)
+    return date.strftime('%Y-%m')
+
+
+def get_packed_dir(listname):
+    return os.path.join(settings.ARCHIVE_DIR, listname, PACKED_DIR)
+
+
+def get_segment_paths(listname, month):
+    '''Returns tuple (segment path, index path)'''
+    base = os.path.join(get_packed_dir(listname), month)
+    return base + '.seg', base + '.idx'
+
+
+def get_segment_months(listname):
+    '''Returns sorted list of months packed for list'''
+    try:
+        names = os.listdir(get_packed_dir(listname))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-4] for name in names if name.endswith('.idx'))
+
+
+def load_segment_index(listname, month):
+    '''Returns the segment index, {hashcode: [offset, length, sha1]}, empty if
+    the segment doesn't exist.  Cached until the index file changes
+    '''
+    path = get_segment_paths(listname, month)[1]
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _segment_indexes.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        index = json.load(f)
+    _segment_indexes[path] = (mtime, index)
+    return index
+
+
+def write_segment_index(listname, month, index):
+    '''Atomically replace the segment index'''
+    path = get_segment_paths(listname, month)[1]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def append_segment(listname, month, messages):
+    '''Append messages, a list of tuples (hashcode, bytes), to the segment.
+    Returns the updated index.  Data is flushed to disk before the index is
+    replaced so the index never references missing data.  Hashcodes already
+    in the index are skipped.
+    '''
+    seg_path, _ = get_segment_paths(listname, month)
+    index = dict(load_segment_index(listname, month))
+    with open(seg_path, 'ab') as f:
+        offset = f.tell()
+        for hashcode, data in messages:
+            if hashcode in index:
+                continue
+            f.write(data)
+            index[hashcode] = [offset, len(data), hashlib.sha1(data).hexdigest()]
+            offset += len(data)
+        f.flush()
+        os.fsync(f.fileno())
+    write_segment_index(listname, month, index)
+    return index
+
+
+def read_segment(seg_path, offset, length):
+    fd = os.open(seg_path, os.O_RDONLY)
+    try:
+        return os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+
+
+def read_packed(listname, hashcode, month):
+    '''Returns message bytes from the segment or None if not packed'''
+    entry = load_segment_index(listname, month).get(hashcode)
+    if entry is None:
+        return None
+    offset, length, _ = entry
+    return read_segment(get_segment_paths(listname, month)[0], offset, length)
+
+
+def remove_packed(listname, hashcode, month):
+    '''Remove the message from the segment index.  Returns the message bytes,
+    or None if it isn't packed.  The bytes are left in the segment, no longer
+    referenced, so a message archived again with the same hashcode is packed anew
+    '''
+    index = load_segment_index(listname, month)
+    if hashcode not in index:
+        return None
+    data = read_packed(listname, hashcode, month)
+    index = dict(index)
+    del index[hashcode]
+    write_segment_index(listname, month, index)
+    return data
+
+
+def verify_segment(listname, month):
+    '''Returns list of (hashcode, error) for segment entries whose bytes don't
+    match the stored SHA-1 digest
+    '''
+    errors = []
+    seg_path, _ = get_segment_paths(listname, month)
+    size = os.path.getsize(seg_path)
+    for hashcode, (offset, length, sha1) in sorted(load_segment_index(listname, month).items()):
+        if offset + length > size:
+            errors.append((hashcode, 'truncated'))
+            continue
+        data = read_segment(seg_path, offset, length)
+        if hashlib.sha1(data).hexdigest() != sha1:
+            errors.append((hashcode, 'checksum mismatch'))
+    return errors
+
+
+def read_message(listname, hashcode, month):
+    '''Returns the original message bytes from whichever store holds it.
+    Raises FileNotFoundError if the message can't be found
+    '''
+    path = find_path(listname, hashcode)
+    if path:
+        return read_file(path)
+    return get_packed(listname, hashcode, month)
+
+
+def open_message(listname, hashcode, month):
+    '''Returns binary file object of the original message from whichever
+    store holds it.  Raises FileNotFoundError if the message can't be found
+    '''
+    path = find_path(listname, hashcode)
+    if path:
+        return open_file(path)
+    return io.BytesIO(get_packed(listname, hashcode, month))
+
+
+def get_packed(listname, hashcode, month):
+    data = read_packed(listname, hashcode, month)
+    if data is None:
+        raise FileNotFoundError('Message not found: {}:{}'.format(listname, hashcode))
+    return data
@@ -7,6 +7,7 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
 
 from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.import_jobs import claim_chunk, get_stale_jobs, process_job
 from mlarchive.celeryapp import app
 from mlarchive.archive.utils import create_mbox_file
 from mlarchive.archive.utils import get_membership_3
@@ -73,9 +74,11 @@ class CelerySignalHandler(Task):
     def run(self, action, identifier, **kwargs):
         """
         Trigger the actual index handler depending on the
-        given action ('update' or 'delete').
+        given action ('update', 'bulk_update' or 'delete').
         """
-        
+        if action == 'bulk_update':
+            return self.run_bulk_update(identifier, **kwargs)
+
         # First get the object path and pk (e.g. ('notes.note', 23))
         object_path, pk = self.split_identifier(identifier, **kwargs)
         if object_path is None or pk is None:
@@ -124,6 +127,40 @@ class CelerySignalHandler(Task):
             logger.error("Unrecognized action '%s'. Moving on..." % action)
             raise ValueError("Unrecognized action %s" % action)
 
+    def run_bulk_update(self, identifiers, **kwargs):
+        """
+        Update the index for a list of identifiers, of the same model, with
+        one request
+        """
+        pks = []
+        for identifier in identifiers:
+            object_path, pk = self.split_identifier(identifier, **kwargs)
+            if object_path is None or pk is None:
+                msg = "Couldn't handle object with identifier %s" % identifier
+                logger.error(msg)
+                raise ValueError(msg)
+            pks.append(int(pk))
+
+        model_class = self.get_model_class(object_path, **kwargs)
+        backend = ESBackend()
+        instances = list(model_class._default_manager.filter(pk__in=pks))
+        if len(instances) != len(pks):
+            logger.error("Couldn't load %s of %s objects. Somehow they went missing?" %
+                         (len(pks) - len(instances), len(pks)))
+        if not instances:
+            return
+
+        try:
+            backend.update(instances)
+        except Exception as exc:
+            logger.exception(exc)
+            self.retry(exc=exc)
+        else:
+            msg = ("Updated %s objects (with %s)" %
+                   (len(instances), backend.index_name))
+            logger.debug(msg)
+            return msg
+
 
 @app.task
 def update_mbox(files):
@@ -132,6 +169,21 @@ def update_mbox(files):
         create_mbox_file(file[0], file[1], elist)
 
 
+@app.task(acks_late=True)
+def import_batch(job_id, start, end):
+    '''Archive spooled messages start through end - 1 of a batch import job.
+    Acknowledged when done, so the task is delivered again if the worker dies'''
+    process_job(job_id, start, end)
+
+
+def queue_import_batch(job_id, chunks):
+    '''Queue an import_batch task for each (start, end) chunk of the job and
+    claim the chunk, so it isn't requeued while the task waits to run'''
+    for start, end in chunks:
+        import_batch.delay(job_id, start, end)
+        claim_chunk(job_id, start)
+
+
 CelerySignalHandler = app.register_task(CelerySignalHandler())
 
 
@@ -158,6 +210,18 @@ def get_subscriber_counts_task():
         logger.error(f"Error in get_subscriber_counts_task: {err}")
 
 
+@shared_task
+def requeue_import_batch_task():
+    '''Queue again batch import chunks that were never queued or were lost, see
+    import_jobs.get_stale_jobs()'''
+    try:
+        for job_id, chunks in get_stale_jobs(settings.IMPORT_BATCH_REQUEUE_AGE):
+            logger.warning(f"Requeue batch import job {job_id} chunks: {chunks}")
+            queue_import_batch(job_id, chunks)
+    except Exception as err:
+        logger.error(f"Error in requeue_import_batch_task: {err}")
+
+
 @shared_task
 def purge_incoming_task():
     '''Purge messages older than 90 days from incoming dir'''
@@ -1,4 +1,5 @@
 import datetime
+import json
 from django import template
 from django.conf import settings
 from django.utils.http import urlencode
@@ -149,6 +150,18 @@ def max_depth(depth):
         return settings.MAX_THREAD_DEPTH
 
 
+@register.filter
+def sort_values(result):
+    """Returns the sort values of a search result as JSON, to fetch the
+    results after it with search_after.  Empty for a database result
+    """
+    meta = getattr(result, 'meta', None)
+    values = getattr(meta, 'sort', None)
+    if values is None:
+        return ''
+    return json.dumps(list(values))
+
+
 @register.filter
 def custom_date(date):
     """A custom date filter that handles ISO date as string,
@@ -23,16 +23,22 @@ from builtins import input
 
 import re
 
+from array import array
 from collections import defaultdict, namedtuple, OrderedDict
 from operator import methodcaller
 
+from django.db.models import Count, Max, Min, Q
+
 CONTAINER_COUNT = 0
 DEBUG = False
 MESSAGE_ID_RE = re.compile(r'<(.*?)>')
 
+ThreadInfo = namedtuple('ThreadInfo', ['message', 'depth', 'order'])
+
 
 class Container(object):
     '''Used to construct the thread ordering then discarded'''
+    __slots__ = ('message', 'parent', 'child', 'next', 'depth')
 
     def __init__(self, message=None):
         self.message = message
@@ -69,18 +75,21 @@ class Container(object):
             return '{} ({})'.format(subject, self.message.msgid)
 
     def has_ancestor(self, target):
-        '''Returns True if target is an ancestor'''
-        if self.parent is None:
-            return False
-        elif self.parent == target:
-            return True
-        else:
-            return self.parent.has_ancestor(target)
+        '''Returns True if target is an ancestor.  Follows parent links, so
+        takes time proportional to depth'''
+        node = self.parent
+        while node is not None:
+            if node is target:
+                return True
+            node = node.parent
+        return False
 
     def has_descendent(self, target):
-        '''Returns True if the target is a descendent'''
-        flat = [c for c in self.walk()]
-        return target in flat
+        '''Returns True if the target is a descendent, or self'''
+        if target is self:
+            return True
+        # a new container has no children, skip following target's parents
+        return self.child is not None and target.has_ancestor(self)
 
     def has_relative(self, target):
         '''Returns True if target is either an ancestor or descendent'''
@@ -91,23 +100,23 @@ class Container(object):
         return self.message is None
 
     def reverse_children(self):
-        '''Reverse order of children'''
-        if self.child:
+        '''Reverse order of children, at all levels'''
+        stack = [self]
+        while stack:
+            container = stack.pop()
             prev = None
-            kid = self.child
-            rest = kid.next
+            kid = container.child
             while kid:
+                rest = kid.next
                 kid.next = prev
-
-                # continue
                 prev = kid
                 kid = rest
-                rest = None if rest is None else rest.next
-            self.child = prev
+            container.child = prev
 
-            kid = self.child
+            kid = container.child
             while kid:
-                kid.reverse_children()
+                if kid.child:
+                    stack.append(kid)
                 kid = kid.next
 
     def sort_date(self):
@@ -123,18 +132,401 @@ class Container(object):
             return None
 
     def walk(self, depth=0):
-        '''Returns a generator that walks the tree and returns
-        containers'''
-        container = self
-        while container:
-            container.depth = depth
+        '''Returns a generator that walks the tree, depth first, and returns
+        containers.  Siblings of self are included unless depth is 0'''
+        stack = [(self, depth)]
+        while stack:
+            container, level = stack.pop()
+            container.depth = level
             yield container
+            if container.next and level != 0:
+                stack.append((container.next, level))
             if container.child:
-                for c in container.child.walk(depth=depth + 1):
-                    yield c
-            if depth == 0:
-                break
-            container = container.next
+                stack.append((container.child, level + 1))
+
+
+class MessageList(object):
+    '''Messages of a thread held in memory, ie. by MessageBatch, for
+    insert_message()'''
+    def __init__(self, messages):
+        self.messages = messages
+
+    def get_stats(self):
+        messages = self.messages
+        return {'count': len(messages),
+                'orders': len(set(m.thread_order for m in messages)),
+                'max_order': max((m.thread_order for m in messages), default=None),
+                'roots': sum(1 for m in messages if m.thread_order == 0),
+                'msgids': len(set(m.msgid for m in messages)),
+                'date': max((m.date for m in messages), default=None)}
+
+    def get_by_order(self, orders):
+        return {m.thread_order: m for m in self.messages if m.thread_order in orders}
+
+    def get_by_msgid(self, msgids):
+        return {m.msgid: m for m in self.messages if m.msgid in msgids}
+
+    def get_subtree_end(self, order, depth):
+        return min((m.thread_order for m in self.messages
+                    if m.thread_order > order and m.thread_depth <= depth), default=None)
+
+    def get_suffix(self, order):
+        return sorted((m for m in self.messages if m.thread_order >= order), key=lambda m: m.thread_order)
+
+    def is_referenced(self, msgid):
+        return any(msgid in get_references_or_in_reply_to(m) for m in self.messages)
+
+
+class MessageQuerySet(MessageList):
+    '''Messages of a thread in the database, ie. thread.message_set.all().
+    Each method is one query, only messages whose order changes are loaded'''
+    def get_stats(self):
+        return self.messages.aggregate(
+            count=Count('id'),
+            orders=Count('thread_order', distinct=True),
+            max_order=Max('thread_order'),
+            roots=Count('id', filter=Q(thread_order=0)),
+            msgids=Count('msgid', distinct=True),
+            date=Max('date'))
+
+    def get_by_order(self, orders):
+        return {m.thread_order: m for m in self.messages.filter(thread_order__in=orders)}
+
+    def get_by_msgid(self, msgids):
+        return {m.msgid: m for m in self.messages.filter(msgid__in=msgids)}
+
+    def get_subtree_end(self, order, depth):
+        messages = self.messages.filter(thread_order__gt=order, thread_depth__lte=depth)
+        return messages.aggregate(end=Min('thread_order'))['end']
+
+    def get_suffix(self, order):
+        return list(self.messages.filter(thread_order__gte=order).order_by('thread_order'))
+
+    def is_referenced(self, msgid):
+        # may match more than get_references_or_in_reply_to(), which only
+        # means falling back to compute_thread()
+        return self.messages.filter(Q(references__contains=msgid) | Q(in_reply_to_value__contains=msgid)).exists()
+
+
+class BulkThreader(object):
+    '''Array version of process() and compute_thread(), for rethreading many
+    threads.  Works on rows, any objects with the Message attributes msgid, date,
+    subject, base_subject, references and in_reply_to_value, ie. namedtuples of
+    values_list() results.  Containers are integer indexes into parallel arrays
+    of links, -1 for None, and message-ids are interned to containers, so there
+    is no Container object per message.  The arrays are reused for each thread.
+    Results are identical to compute_thread(), including its handling of
+    duplicate message-ids and loops.
+    '''
+
+    def __init__(self):
+        self.reset([])
+
+    def reset(self, rows):
+        self.rows = rows
+        self.id_table = {}
+        self.message = array('i')
+        self.parent = array('i')
+        self.child = array('i')
+        self.next = array('i')
+
+    def new_container(self, message=-1):
+        self.message.append(message)
+        self.parent.append(-1)
+        self.child.append(-1)
+        self.next.append(-1)
+        return len(self.message) - 1
+
+    def compute_thread(self, rows):
+        '''Computes the thread tree for rows, in date order.  Returns list of
+        ThreadInfo, message is the row, in thread order
+        '''
+        if not rows:
+            return []
+        self.reset(rows)
+        for index in range(len(rows)):
+            self.build_container(index)
+        root = self.find_root_set()
+        self.prune_empty_containers(root)
+        self.reverse_children(root)
+        self.gather_subjects(root)
+        self.sort_thread(root)
+
+        data = []
+        branch = self.child[root]
+        while branch != -1:
+            for order, (container, depth) in enumerate(self.walk(branch)):
+                if self.message[container] != -1:
+                    data.append(ThreadInfo(message=rows[self.message[container]], depth=depth, order=order))
+            branch = self.next[branch]
+        self.reset([])
+        return data
+
+    def get_row(self, container):
+        '''Returns row of container, or of its first child if it is empty, or None'''
+        index = self.message[container]
+        if index == -1 and self.child[container] != -1:
+            index = self.message[self.child[container]]
+        return None if index == -1 else self.rows[index]
+
+    def has_ancestor(self, container, target):
+        node = self.parent[container]
+        while node != -1:
+            if node == target:
+                return True
+            node = self.parent[node]
+        return False
+
+    def has_descendent(self, container, target):
+        if target == container:
+            return True
+        return self.child[container] != -1 and self.has_ancestor(target, container)
+
+    def has_relative(self, container, target):
+        return self.has_descendent(container, target) or self.has_ancestor(container, target)
+
+    def link(self, container, parent):
+        self.parent[container] = parent
+        self.next[container] = self.child[parent]
+        self.child[parent] = container
+
+    def build_container(self, index):
+        '''See build_container()'''
+        message, parent, child, next_ = self.message, self.parent, self.child, self.next
+        row = self.rows[index]
+        msgid = row.msgid
+        container = self.id_table.get(msgid)
+        if container is not None:
+            if message[container] == -1:
+                message[container] = index
+            else:
+                # duplicate message-id.  process() passes bogus_id_count by
+                # value so every duplicate gets the same id
+                msgid = 'Bogus-id:0'
+                container = None
+        if container is None:
+            container = self.new_container(index)
+            self.id_table[msgid] = container
+
+        parent_ref = -1
+        for reference_id in get_references_or_in_reply_to(row):
+            ref = self.id_table.get(reference_id)
+            if ref is None:
+                ref = self.new_container()
+                self.id_table[reference_id] = ref
+            if (parent_ref != -1 and parent[ref] == -1 and parent_ref != ref and
+                    not self.has_relative(parent_ref, ref)):
+                self.link(ref, parent_ref)
+            parent_ref = ref
+
+        if parent_ref != -1 and (parent_ref == container or self.has_descendent(container, parent_ref)):
+            parent_ref = -1
+
+        if parent[container] != -1:
+            prev = -1
+            rest = child[parent[container]]
+            while rest != -1 and rest != container:
+                prev = rest
+                rest = next_[rest]
+            if rest == -1:
+                raise Exception("Couldn't find container {} in parent {}".format(container, parent[container]))
+            if prev == -1:
+                child[parent[container]] = next_[container]
+            else:
+                next_[prev] = next_[container]
+            next_[container] = -1
+            parent[container] = -1
+
+        if parent_ref != -1:
+            self.link(container, parent_ref)
+
+    def find_root_set(self):
+        '''See find_root_set().  Returns the root container'''
+        root = self.new_container()
+        for container in self.id_table.values():
+            if self.parent[container] == -1:
+                if self.next[container] != -1:
+                    raise Exception('container.next is {}'.format(self.next[container]))
+                self.next[container] = self.child[root]
+                self.child[root] = container
+        return root
+
+    def prune_empty_containers(self, parent):
+        '''See prune_empty_containers()'''
+        message, child, next_ = self.message, self.child, self.next
+        stack = [parent]
+        while stack:
+            parent = stack.pop()
+            prev = -1
+            container = child[parent]
+            if container == -1:
+                continue
+            following = next_[container]
+            while container != -1:
+                if message[container] == -1 and child[container] == -1:
+                    if prev == -1:
+                        child[parent] = next_[container]
+                    else:
+                        next_[prev] = next_[container]
+                    container = prev
+                elif (message[container] == -1 and child[container] != -1 and
+                      (self.parent[container] != -1 or next_[child[container]] == -1)):
+                    kids = child[container]
+                    if prev == -1:
+                        child[parent] = kids
+                    else:
+                        next_[prev] = kids
+                    tail = kids
+                    while next_[tail] != -1:
+                        self.parent[tail] = self.parent[container]
+                        tail = next_[tail]
+                    self.parent[tail] = self.parent[container]
+                    next_[tail] = next_[container]
+                    following = kids
+                    container = prev
+                elif child[container] != -1:
+                    stack.append(container)
+                prev = container
+                container = following
+                following = -1 if container == -1 else next_[container]
+
+    def reverse_children(self, container):
+        '''See Container.reverse_children()'''
+        child, next_ = self.child, self.next
+        stack = [container]
+        while stack:
+            container = stack.pop()
+            prev = -1
+            kid = child[container]
+            while kid != -1:
+                rest = next_[kid]
+                next_[kid] = prev
+                prev = kid
+                kid = rest
+            child[container] = prev
+            kid = prev
+            while kid != -1:
+                if child[kid] != -1:
+                    stack.append(kid)
+                kid = next_[kid]
+
+    def is_reply(self, container):
+        return subject_is_reply(self.rows[self.message[container]])
+
+    def build_subject_table(self, root):
+        '''See build_subject_table()'''
+        message = self.message
+        subject_table = {}
+        container = self.child[root]
+        while container != -1:
+            subject = self.get_row(container).base_subject
+            if subject:
+                existing = subject_table.get(subject)
+                if existing is None:
+                    subject_table[subject] = container
+                elif message[container] == -1 and message[existing] != -1:
+                    subject_table[subject] = container
+                elif (message[existing] != -1 and self.is_reply(existing) and
+                      message[container] != -1 and not self.is_reply(container)):
+                    subject_table[subject] = container
+            container = self.next[container]
+        return subject_table
+
+    def gather_subjects(self, root):
+        '''See gather_subjects()'''
+        message, parent, child, next_ = self.message, self.parent, self.child, self.next
+        subject_table = self.build_subject_table(root)
+        if not subject_table:
+            return
+
+        prev = -1
+        container = child[root]
+        rest = next_[container]
+        while container != -1:
+            subject = self.get_row(container).base_subject
+            if subject:
+                old = subject_table.get(subject)
+                if old != container:
+                    if prev == -1:
+                        child[root] = next_[container]
+                    else:
+                        next_[prev] = next_[container]
+                    next_[container] = -1
+
+                    if message[old] == -1 and message[container] == -1:
+                        tail = child[old]
+                        while tail != -1 and next_[tail] != -1:
+                            tail = next_[tail]
+                        next_[tail] = child[container]
+                        tail = child[container]
+                        while tail != -1:
+                            parent[tail] = old
+                            tail = next_[tail]
+                        child[container] = -1
+                    elif message[old] == -1 or (message[container] != -1 and self.is_reply(container) and
+                                                not self.is_reply(old)):
+                        self.link(container, old)
+                    else:
+                        new_container = self.new_container(message[old])
+                        child[new_container] = child[old]
+                        tail = child[new_container]
+                        while tail != -1:
+                            parent[tail] = new_container
+                            tail = next_[tail]
+                        message[old] = -1
+                        child[old] = -1
+                        parent[container] = old
+                        parent[new_container] = old
+                        child[old] = container
+                        next_[container] = new_container
+
+                    container = prev
+
+            prev = container
+            container = rest
+            rest = -1 if rest == -1 else next_[rest]
+
+    def sort_date(self, container):
+        row = self.get_row(container)
+        return None if row is None else row.date
+
+    def sort_siblings(self, siblings, reverse=False):
+        '''See sort_siblings()'''
+        siblings = sorted(siblings, key=self.sort_date, reverse=reverse)
+        for container, following in zip(siblings, siblings[1:]):
+            self.next[container] = following
+        self.next[siblings[-1]] = -1
+        return siblings
+
+    def sort_thread(self, root):
+        '''See sort_thread()'''
+        siblings = defaultdict(list)
+        stack = [root]
+        while stack:
+            container = self.child[stack.pop()]
+            while container != -1:
+                siblings[self.parent[container]].append(container)
+                if self.child[container] != -1:
+                    stack.append(container)
+                container = self.next[container]
+        root_set = siblings.pop(-1)
+        self.child[root] = self.sort_siblings(root_set, reverse=True)[0]
+        for parent, children in siblings.items():
+            if len(children) > 1:
+                self.child[parent] = self.sort_siblings(children)[0]
+
+    def walk(self, container):
+        '''See Container.walk().  Yields tuples (container, depth) of the
+        tree under container, without its siblings
+        '''
+        stack = [(container, 0)]
+        while stack:
+            container, depth = stack.pop()
+            yield container, depth
+            if depth != 0 and self.next[container] != -1:
+                stack.append((self.next[container], depth))
+            if self.child[container] != -1:
+                stack.append((self.child[container], depth + 1))
 
 
 def build_container(message, id_table, bogus_id_count):
@@ -263,7 +655,6 @@ def compute_thread(thread):
     else:
         messages = thread.message_set.all().order_by('date')
     data = OrderedDict()
-    ThreadInfo = namedtuple('ThreadInfo', ['message', 'depth', 'order'])
     root_node = process(messages)
     for branch in get_root_set(root_node):
         for order, container in enumerate(branch.walk()):
@@ -277,6 +668,61 @@ def compute_thread(thread):
     return data
 
 
+def insert_message(messages, message):
+    '''Incremental alternative to compute_thread() for adding a message to a
+    thread whose thread_order and thread_depth are up to date.  messages is a
+    MessageList or MessageQuerySet of the thread's existing messages.  Returns
+    OrderedDict key=hashcode,value=ThreadInfo of message and the messages
+    after it, whose order is incremented.  Other messages are unchanged.
+
+    Returns None, and the caller should use compute_thread(), unless the result
+    is certain to be the same.  The common case qualifies: the thread is one tree
+    under a root message, message is newer than all of it and its references are
+    a path of the tree ending at the parent.  Then the full algorithm only links
+    message under the parent, as its last child, and the new order follows from
+    the stored ones.  See test_insert_message_agrees.
+    '''
+    refs = get_references_or_in_reply_to(message)
+    if not refs or message.msgid in refs:
+        return None
+    stats = messages.get_stats()
+    count = stats['count']
+    # one tree, messages numbered 0..count-1 in walk order, no duplicate msgids
+    if (count == 0 or stats['orders'] != count or stats['max_order'] != count - 1 or
+            stats['roots'] != 1 or stats['msgids'] != count or message.date <= stats['date']):
+        return None
+    found = messages.get_by_msgid(refs + [message.msgid])
+    if message.msgid in found or len(found) != len(refs):
+        return None
+    # each reference after the first already has its parent, the one before,
+    # so build_container() doesn't relink them
+    chain = [found[ref] for ref in refs]
+    for parent, child in zip(chain, chain[1:]):
+        child_refs = get_references_or_in_reply_to(child)
+        if child.thread_depth != parent.thread_depth + 1 or not child_refs or child_refs[-1] != parent.msgid:
+            return None
+    # a message at order 1 which is a child of the root proves there isn't a
+    # second tree, under an empty root, numbered 1..n
+    if count > 1:
+        top = messages.get_by_order([0, 1])
+        top_refs = get_references_or_in_reply_to(top[1])
+        if not top_refs or top_refs[-1] != top[0].msgid:
+            return None
+    # an existing message refers to this one
+    if messages.is_referenced(message.msgid):
+        return None
+
+    parent = chain[-1]
+    end = messages.get_subtree_end(parent.thread_order, parent.thread_depth)
+    if end is None:
+        end = count
+    data = OrderedDict()
+    data[message.hashcode] = ThreadInfo(message=message, depth=parent.thread_depth + 1, order=end)
+    for other in messages.get_suffix(end):
+        data[other.hashcode] = ThreadInfo(message=other, depth=other.thread_depth, order=other.thread_order + 1)
+    return data
+
+
 def reconcile_thread(thread_data):
     '''Updates message.thread_depth and message.thread_order as needed, given
     computed thread info
@@ -337,10 +783,9 @@ def display_thread(parent):
 
 def find_root(node):
     '''Find the top level node'''
-    if not node.parent:
-        return node
-    else:
-        return find_root(node.parent)
+    while node.parent:
+        node = node.parent
+    return node
 
 
 def find_root_set(id_table):
@@ -360,12 +805,14 @@ def find_root_set(id_table):
 
 def gather_siblings(parent, siblings):
     '''Build mapping of parent to list of children containers'''
-    container = parent.child
-    while container:
-        siblings[container.parent].append(container)
-        if container.child:
-            gather_siblings(container, siblings)
-        container = container.next
+    stack = [parent]
+    while stack:
+        container = stack.pop().child
+        while container:
+            siblings[container.parent].append(container)
+            if container.child:
+                stack.append(container)
+            container = container.next
 
 
 def gather_subjects(root_node):
@@ -505,49 +952,52 @@ def prune_empty_containers(parent):
     After calling this, there will only be empty container objects
     at depth 0, and those will all have at least two kids
     '''
-    prev = None
-    container = parent.child
-    if container is None:
-        return
-    next_ = container.next
-    while container:
-        # remove empty container with no children
-        if container.message is None and container.child is None:
-            if prev is None:
-                parent.child = container.next
-            else:
-                prev.next = container.next
-            container = prev
-
-        elif (container.message is None and
-              container.child and
-              (container.parent or container.child.next is None)):
-            tail = Container()
-            kids = container.child
-            if prev is None:
-                parent.child = kids
-            else:
-                prev.next = kids
+    # containers whose children remain to be pruned
+    stack = [parent]
+    while stack:
+        parent = stack.pop()
+        prev = None
+        container = parent.child
+        if container is None:
+            continue
+        next_ = container.next
+        while container:
+            # remove empty container with no children
+            if container.message is None and container.child is None:
+                if prev is None:
+                    parent.child = container.next
+                else:
+                    prev.next = container.next
+                container = prev
 
-            # splice kids into the list in place of container
-            tail = kids
-            while tail.next:
-                tail.parent = container.parent
-                tail = tail.next
+            elif (container.message is None and
+                  container.child and
+                  (container.parent or container.child.next is None)):
+                kids = container.child
+                if prev is None:
+                    parent.child = kids
+                else:
+                    prev.next = kids
 
-            tail.parent = container.parent
-            tail.next = container.next
+                # splice kids into the list in place of container
+                tail = kids
+                while tail.next:
+                    tail.parent = container.parent
+                    tail = tail.next
 
-            next_ = kids
-            container = prev
+                tail.parent = container.parent
+                tail.next = container.next
 
-        elif container.child:
-            prune_empty_containers(container)
+                next_ = kids
+                container = prev
 
-        # continue with loop
-        prev = container
-        container = next_
-        next_ = None if container is None else container.next
+            elif container.child:
+                stack.append(container)
+
+            # continue with loop
+            prev = container
+            container = next_
+            next_ = None if container is None else container.next
 
 
 def process(queryset, display=False, debug=False):
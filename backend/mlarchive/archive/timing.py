@@ -0,0 +1,181 @@
+'''Lightweight per-stage timing of message ingestion.
+
+Each MessageWrapper has a Timings object which records the time spent in each
+stage of processing, ie. parse, date, inspectors, thread, write, save.  Stages
+may nest, a stage's time excludes the time of stages run inside it, so times of
+all stages add up to the total.  Code that has no access to the wrapper, ie.
+the indexing signal processors, uses the module level stage() which records to
+the Timings made current with activate().
+
+Profile aggregates Timings of many messages into a histogram per stage, see
+Loader.stats and load --profile.  Overhead is a few microseconds per message.
+'''
+
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# histogram bucket upper bounds, milliseconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_local = threading.local()
+_null_stage = nullcontext()
+
+
+class Stage(object):
+    '''Context manager that times one stage'''
+    __slots__ = ('timings', 'name')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings.start(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.stop()
+
+
+class Timings(object):
+    '''Elapsed seconds per stage of one message'''
+    __slots__ = ('stages', '_stack')
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+
+    def start(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        name, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def as_ms(self):
+        '''Returns dictionary of stage milliseconds, for logging'''
+        return {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+
+
+@contextmanager
+def activate(timings):
+    '''Context manager which makes timings current for stage()'''
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def stage(name):
+    '''Returns context manager that times stage name of the current Timings, if any'''
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return _null_stage
+    return timings.stage(name)
+
+
+class Histogram(object):
+    '''Distribution of stage times, in milliseconds, over BUCKETS'''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''Returns upper bound of the bucket containing the pth percentile'''
+        target = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_ms': round(self.total, 3),
+                'mean_ms': round(self.mean, 3),
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'max_ms': round(self.max, 3)}
+
+
+class Profile(object):
+    '''Histograms of stage times over many messages.  Profiles can be added so
+    stats dictionaries holding them can be summed, see load.add_stats
+    '''
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(seconds * 1000)
+
+    def add_timings(self, timings):
+        for name, seconds in timings.stages.items():
+            self.add(name, seconds)
+
+    def merge(self, other):
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def __add__(self, other):
+        profile = Profile()
+        profile.merge(self)
+        if other:
+            profile.merge(other)
+        return profile
+
+    __radd__ = __add__
+
+    def as_dict(self):
+        return {name: histogram.as_dict() for name, histogram in self.histograms.items()}
+
+    def format_table(self):
+        '''Returns summary table, slowest stages first, as a list of lines'''
+        total = sum(h.total for h in self.histograms.values()) or 1.0
+        lines = ['{:<14}{:>9}{:>11}{:>7}{:>10}{:>10}{:>10}{:>10}'.format(
+            'stage', 'count', 'total(s)', '%', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'max(ms)')]
+        items = sorted(self.histograms.items(), key=lambda item: item[1].total, reverse=True)
+        for name, h in items:
+            lines.append('{:<14}{:>9}{:>11.2f}{:>7.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                name, h.count, h.total / 1000, 100 * h.total / total, h.mean,
+                h.percentile(50), h.percentile(95), h.max))
+        return lines
@@ -10,6 +10,7 @@ import mailbox
 import os
 import re
 import requests
+import shutil
 import subprocess
 from collections import defaultdict
 
@@ -379,7 +380,7 @@ def create_mbox_file(month, year, elist):
         os.makedirs(os.path.dirname(path))
     mbox = mailbox.mbox(path)
     for message in messages:
-        with open(message.get_file_path(), 'rb') as f:
+        with message.open_file() as f:
             msg = email.message_from_binary_file(f)
         mbox.add(msg)
     mbox.close()
@@ -401,6 +402,16 @@ def purge_incoming():
     cutoff_date = datetime.datetime.now() - datetime.timedelta(days=90)
     for file in os.listdir(path):
         file_path = os.path.join(path, file)
+        if os.path.isdir(file_path):
+            continue
         file_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
         if file_mtime < cutoff_date:
             os.remove(file_path)
+    # batch import jobs, see import_jobs.py
+    batch_path = os.path.join(path, 'batch')
+    if os.path.isdir(batch_path):
+        for job in os.listdir(batch_path):
+            job_path = os.path.join(batch_path, job)
+            job_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(job_path))
+            if job_mtime < cutoff_date:
+                shutil.rmtree(job_path)
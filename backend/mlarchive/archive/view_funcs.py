@@ -25,6 +25,9 @@ from django.utils.encoding import smart_bytes
 
 from mlarchive.archive.forms import RulesForm
 from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.query_utils import (get_result_window, get_window_items, run_query,
+    run_search_after, update_result_window)
+from mlarchive.archive.storage import split_suffix
 from mlarchive.archive.utils import get_lists_for_user
 
 
@@ -68,11 +71,23 @@ def chunks(l, n):
     return result
 
 
-def apply_objects(hits):
+def apply_objects(hits, chunk_size=None):
     '''Add object attribute (Message) to list of hits,
-    to simulate Haystack results'''
+    to simulate Haystack results.  Messages are fetched with one query per
+    chunk_size hits.  Returns list of the hits, in order, without those whose
+    message has been deleted since it was indexed'''
+    hits = list(hits)
+    chunk_size = chunk_size or settings.HYDRATE_CHUNK_SIZE
+    queryset = Message.objects.select_related('email_list', 'thread')
+    objects = {}
+    for chunk in chunks(hits, chunk_size):
+        objects.update(queryset.in_bulk([int(hit.django_id) for hit in chunk]))
+    results = []
     for hit in hits:
-        hit.object = Message.objects.get(pk=hit.django_id)
+        hit.object = objects.get(int(hit.django_id))
+        if hit.object is not None:
+            results.append(hit)
+    return results
 
 # --------------------------------------------------
 # View Functions
@@ -168,8 +183,10 @@ def get_export(search, export_type, request):
         messages.error(request, f'Export exceeds message limit of {settings.EXPORT_LIMIT}')
         return redirect(redirect_url)
     search = search.params(preserve_order=True)
-    results = list(search.scan())
-    apply_objects(results)
+    results = apply_objects(search.scan())
+    if not results:
+        messages.error(request, 'No messages to export.')
+        return redirect(redirect_url)
     if export_type == 'url':
         return get_export_url(results, export_type, request)
     else:
@@ -233,7 +250,17 @@ def build_maildir_tar(results, tar, basename):
     """Returns tar file with messages from SearchQuerySet in maildir format"""
     for result in results:
         arcname = os.path.join(basename, result.object.email_list.name, result.object.hashcode)
-        tar.add(result.object.get_file_path(), arcname=arcname)
+        path = result.object.get_file_path()
+        if os.path.exists(path) and not split_suffix(path)[1]:
+            tar.add(path, arcname=arcname)
+        else:
+            # compressed or packed, add original bytes
+            data = result.object.read_file()
+            info = tarfile.TarInfo(arcname)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(result.object.date.timestamp())
+            tar.addfile(info, BytesIO(data))
     return tar
 
 
@@ -260,7 +287,7 @@ def build_mbox_tar(results, tar, basename):
             mbox_date = date
             mbox_list = mlist
 
-        with open(result.object.get_file_path(), 'rb') as input:
+        with result.object.open_file() as input:
             # add envelope header if missing
             if not input.read(5) == b'From ':
                 from_line = smart_bytes(result.object.get_from_line()) + b'\n'
@@ -301,16 +328,38 @@ def get_message_after(response, index):
         return None
 
 
-def get_query_neighbors(search, message):
+def get_query_neighbors(search, message, queryid=None):
     """Returns a tuple previous_message and next_message given a message
-    from the query results"""
-    response = search.execute()
-    apply_objects(response)
-    index = get_message_index(response, message)
-    if index == -1:
-        return None, None
-    else:
-        return get_message_before(response, index), get_message_after(response, index)
+    from the query results.  The neighbours of a message on a page of results
+    already served come from the result window of queryid, any not known are
+    found with search_after from the message's sort values.  The search itself
+    is not run"""
+    entry = get_result_window(queryid).get(message.pk, {}) if queryid else {}
+    sort_values = entry.get('sort')
+    if sort_values is None:
+        response = run_query(search.filter('term', django_id=message.pk).extra(track_total_hits=False)[:1])
+        if not response:
+            return None, None
+        sort_values = getattr(response[0].meta, 'sort', None)
+        if sort_values is None:
+            return None, None
+        sort_values = list(sort_values)
+
+    items = {'previous': [], 'next': []}
+    neighbors = {}
+    for key in ('previous', 'next'):
+        if key in entry:
+            neighbors[key] = entry[key]
+            continue
+        hits = run_search_after(search, sort_values, 1, reverse=key == 'previous')
+        items[key] = get_window_items(hits)
+        neighbors[key] = items[key][0][0] if items[key] else None
+
+    if queryid and (items['previous'] or items['next'] or 'sort' not in entry):
+        update_result_window(queryid, items['previous'] + [(message.pk, sort_values)] + items['next'],
+                             first=neighbors['previous'] is None, last=neighbors['next'] is None)
+    objects = Message.objects.select_related('email_list').in_bulk([pk for pk in neighbors.values() if pk])
+    return objects.get(neighbors['previous']), objects.get(neighbors['next'])
 
 
 def get_query_string(request):
@@ -37,7 +37,7 @@ from mlarchive.archive import actions
 from mlarchive.archive.backends.elasticsearch import search_from_form
 from mlarchive.archive.query_utils import (get_qdr_kwargs,
     get_cached_query, get_browse_equivalent, parse_query_string, get_order_fields,
-    is_static_on, get_count, CustomPaginator)
+    is_static_on, get_count, get_window_items, update_result_window, CustomPaginator)
 from mlarchive.archive.view_funcs import (initialize_formsets, get_columns, get_export,
     get_query_neighbors, get_query_string, get_lists_for_user, get_random_token)
 
@@ -268,7 +268,7 @@ class CustomSearchView(View):
         extra['query_string'] = query_string
         extra['results_per_page'] = settings.ELASTICSEARCH_RESULTS_PER_PAGE
         extra['queryset_offset'] = str(self.page.start_index() - 1)
-        extra['count'] = get_count(self.search)
+        extra['count'] = self.paginator.count
 
         # export links
         token = get_random_token(length=16)
@@ -293,6 +293,7 @@ class CustomSearchView(View):
 
         if hasattr(self, 'queryid'):
             extra['queryid'] = self.queryid
+            self.set_result_window()
 
         self.set_thread_links(extra)
         self.set_page_links(extra)
@@ -316,6 +317,12 @@ class CustomSearchView(View):
         return self.response
     '''
 
+    def set_result_window(self):
+        """Record the order of the page's results for the previous / next
+        in search links of the detail page"""
+        update_result_window(self.queryid, get_window_items(self.page.object_list),
+                             first=not self.page.has_previous(), last=not self.page.has_next())
+
     def set_thread_links(self, extra):
         extra['group_by_thread'] = True if 'gbt' in self.request.GET else False
         new_query = self.request.GET.copy()
@@ -392,7 +399,7 @@ class CustomSearchView(View):
 
         There are various places where the Elasticsearch object is 
         evaluated and my raise an exception RequestError (within the
-        paginator when calling count() for example) Catch this exception
+        paginator when executing the page's query for example) Catch this exception
         and redirect to main page.)
         """
         try:
@@ -452,11 +459,15 @@ class CustomBrowseView(CustomSearchView):
                 raise Http404("No such message!")
 
             if 'gbt' in self.request.GET:
-                results = []
+                threads = []
+                count = 0
                 thread = index_message.thread
-                while len(results) < self.results_per_page and thread:
-                    results.extend(thread.message_set.order_by('thread_order'))
+                while count < self.results_per_page and thread:
+                    threads.append(thread)
+                    count += thread.message_count
                     thread = thread.get_previous()  # default ordering is descending by thread date
+                results = list(Message.objects.filter(thread__in=threads).order_by(
+                    '-thread__date', 'thread_id', 'thread_order'))
             else:
                 results = Message.objects.filter(
                     email_list=self.email_list,
@@ -474,7 +485,7 @@ class CustomBrowseView(CustomSearchView):
         extra['browse_list'] = self.list_name
         extra['browse_list_placeholder'] = 'Search {}'.format(self.list_name)
         extra['queryset_offset'] = '0'
-        extra['count'] = get_count(self.search)
+        extra['count'] = self.paginator.count
 
         # export links
         token = get_random_token(length=16)
@@ -492,6 +503,7 @@ class CustomBrowseView(CustomSearchView):
 
         if hasattr(self, 'queryid'):
             extra['queryid'] = self.queryid
+            self.set_result_window()
 
         self.set_thread_links(extra)
         self.set_page_links(extra)
@@ -816,7 +828,7 @@ def detail(request, list_name, id, msg):
     queryid, search = get_cached_query(request)
 
     if search and not is_static_on:
-        previous_in_search, next_in_search = get_query_neighbors(search=search, message=msg)
+        previous_in_search, next_in_search = get_query_neighbors(search=search, message=msg, queryid=queryid)
     else:
         previous_in_search = None
         next_in_search = None
@@ -31,16 +31,13 @@ for elist in lists:
     path = os.path.join(settings.ARCHIVE_DIR, elist.name)
     if not os.path.isdir(path):
         continue
-    files = os.listdir(path)
     messages = Message.objects.filter(email_list__name=elist.name)
-    eprint("{}:{}:{}".format(elist.name,len(files),messages.count()))
-    if len(files) != messages.count():
-        #print()
-        #sys.exit()
-        for message in messages:
-            if os.path.basename(message.get_file_path()) not in files:
-                missing.append(message)
-                print("%s:%s" % (elist.name, message.msgid))
+    eprint("{}:{}".format(elist.name,messages.count()))
+    # message files may be in subdirectories, see archive/storage.py
+    for message in messages:
+        if not os.path.exists(message.get_file_path()):
+            missing.append(message)
+            print("%s:%s" % (elist.name, message.msgid))
 
 for message in missing:
     pattern = "^Message-Id: {}".format(message.msgid)
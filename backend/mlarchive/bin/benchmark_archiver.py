@@ -0,0 +1,106 @@
+#!../../../env/bin/python
+'''
+Benchmark the persistent archiver service (manage.py archiver) against the
+spawn-per-message path, bin/archive-mail.py.  Messages are read from a mailbox
+file and given unique Message-IDs so they get archived rather than rejected as
+duplicates.  Use a throwaway list name.  The archiver service must be running.
+
+Example: ./benchmark_archiver.py --count 200 /path/to/2020-01.mail benchmark-list
+'''
+
+# Standalone broilerplate -------------------------------------------------------------
+from django_setup import do_setup
+do_setup()
+# -------------------------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from email import policy as email_policy
+from subprocess import Popen, PIPE, DEVNULL
+
+from django.conf import settings
+
+from mlarchive.archive.archiver import send_message
+from mlarchive.archive.mail import get_mb
+from mlarchive.archive.models import Message
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_MAIL = os.path.join(BIN_DIR, 'archive-mail.py')
+
+
+def get_messages(path, count, prefix):
+    '''Returns list of message bytes, each with a unique Message-ID'''
+    messages = []
+    mb = get_mb(path)
+    for n, msg in enumerate(mb):
+        if n >= count:
+            break
+        del msg['Message-ID']
+        msg['Message-ID'] = '<{}.{}@benchmark>'.format(prefix, n)
+        messages.append(msg.as_bytes(policy=email_policy.compat32))
+    mb.close()
+    return messages
+
+
+def spawn(data, listname):
+    p = Popen([sys.executable, ARCHIVE_MAIL, listname, '--public'],
+              stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, cwd=BIN_DIR)
+    p.communicate(input=data)
+    return p.returncode
+
+
+def daemon(data, listname):
+    return send_message(data, listname, socket_path=ARGS.socket)
+
+
+def run(func, messages, listname):
+    '''Returns tuple (elapsed seconds, failures)'''
+    failures = 0
+    start = time.time()
+    for data in messages:
+        if func(data, listname) != 0:
+            failures += 1
+    return time.time() - start, failures
+
+
+def report(label, count, elapsed, failures):
+    rate = count / elapsed if elapsed else 0
+    print('{:<8} messages:{:>6}  failures:{:>4}  elapsed:{:>8.2f}s  msgs/sec:{:>8.2f}'.format(
+        label, count, failures, elapsed, rate))
+
+
+def main():
+    global ARGS
+    parser = argparse.ArgumentParser(description='Benchmark archiver service vs archive-mail.py')
+    parser.add_argument('path', help='mailbox file to read messages from')
+    parser.add_argument('listname', help='list to archive the messages to')
+    parser.add_argument('-c', '--count', type=int, default=100, help='number of messages')
+    parser.add_argument('-s', '--socket', default=settings.ARCHIVER_SOCKET, help='archiver socket')
+    parser.add_argument('--cleanup', action='store_true', help='delete benchmark messages when done')
+    ARGS = parser.parse_args()
+
+    if not os.path.exists(ARGS.socket):
+        sys.exit('archiver service not found at {}'.format(ARGS.socket))
+
+    prefix = uuid.uuid4().hex
+    results = []
+    for label, func in (('spawn', spawn), ('daemon', daemon)):
+        messages = get_messages(ARGS.path, ARGS.count, prefix + label)
+        elapsed, failures = run(func, messages, ARGS.listname)
+        results.append((label, len(messages), elapsed, failures))
+
+    for result in results:
+        report(*result)
+    spawn_rate = results[0][1] / results[0][2]
+    daemon_rate = results[1][1] / results[1][2]
+    print('speedup: {:.1f}x'.format(daemon_rate / spawn_rate))
+
+    if ARGS.cleanup:
+        Message.objects.filter(email_list__name=ARGS.listname, msgid__startswith=prefix).delete()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!../../../env/bin/python
+'''
+Benchmark message file compression formats, see archive/storage.py.  A sample
+of existing message files is read, then each is written in every format to a
+temporary directory.  Reports bytes on disk and time to read back (decompress)
+per format.  The archive itself is not modified.
+
+Example: ./benchmark_storage.py --count 1000 ietf
+'''
+
+# Standalone broilerplate -------------------------------------------------------------
+from django_setup import do_setup
+do_setup()
+# -------------------------------------------------------------------------------------
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mlarchive.archive.models import Message
+from mlarchive.archive.storage import COMPRESSORS, compress, read_file, zstandard
+
+BLOCK_SIZE = 4096
+
+
+def get_samples(listname, count):
+    '''Returns list of (hashcode, message bytes), most recent messages first'''
+    samples = []
+    messages = Message.objects.filter(email_list__name=listname).order_by('-date')
+    for message in messages[:count]:
+        try:
+            samples.append((message.hashcode, read_file(message.get_file_path())))
+        except IOError:
+            continue
+    return samples
+
+
+def disk_usage(path):
+    '''Returns bytes allocated to file, rounded up to whole blocks'''
+    size = os.path.getsize(path)
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def run(suffix, samples, directory):
+    '''Returns tuple (bytes, disk bytes, write seconds, read seconds)'''
+    paths = []
+    size = disk = 0
+    start = time.time()
+    for hashcode, data in samples:
+        path = os.path.join(directory, hashcode + suffix)
+        output = compress(data, path)
+        with open(path, 'wb') as f:
+            f.write(output)
+        size += len(output)
+        disk += disk_usage(path)
+        paths.append(path)
+    write_elapsed = time.time() - start
+
+    start = time.time()
+    for path, (hashcode, data) in zip(paths, samples):
+        if read_file(path) != data:
+            sys.exit('round trip failed: {}'.format(path))
+    read_elapsed = time.time() - start
+    return size, disk, write_elapsed, read_elapsed
+
+
+def report(label, count, size, disk, write_elapsed, read_elapsed, base):
+    print('{:<6} bytes:{:>12}  disk:{:>12}  ratio:{:>5.2f}  write:{:>7.2f}s  read:{:>7.3f}ms/msg'.format(
+        label, size, disk, base / size if size else 0, write_elapsed,
+        read_elapsed * 1000 / count if count else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark message file compression')
+    parser.add_argument('listname', help='list to sample messages from')
+    parser.add_argument('-c', '--count', type=int, default=1000, help='number of messages')
+    args = parser.parse_args()
+
+    samples = get_samples(args.listname, args.count)
+    if not samples:
+        sys.exit('no messages found for {}'.format(args.listname))
+
+    formats = [('none', '')]
+    for name, compressor in sorted(COMPRESSORS.items()):
+        if name == 'zstd' and zstandard is None:
+            print('skipping zstd, zstandard package not installed')
+            continue
+        formats.append((name, compressor.suffix))
+
+    directory = tempfile.mkdtemp()
+    try:
+        base = None
+        for label, suffix in formats:
+            subdir = os.path.join(directory, label)
+            os.mkdir(subdir)
+            size, disk, write_elapsed, read_elapsed = run(suffix, samples, subdir)
+            base = base or size
+            report(label, len(samples), size, disk, write_elapsed, read_elapsed, base)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
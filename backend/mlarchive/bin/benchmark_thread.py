@@ -0,0 +1,235 @@
+#!../../../env/bin/python
+'''
+Benchmark the threading algorithm, archive/thread.py, on synthetic lists of each
+shape, see utils/thread_corpus.py: deep reply chains, wide flat threads, missing
+parents, duplicate message ids, reference loops, subject only threads and a mix.
+Each list is threaded as a whole, as when rethreading a list, by each mode:
+
+process         thread.process() of Message instances
+compute_thread  thread.compute_thread() of Message instances
+bulk            BulkThreader, from rows of values as rethread.py does
+ingest          MessageWrapper.process() of each message, as load does, timing
+                the get_thread() and compute_thread stages.  Writes to the
+                database, see --listname
+
+Use --memory to record peak memory while threading, not including the corpus.
+The three list modes must give the same thread order and depth, the "digest"
+of each result, and a warning is printed when they don't.
+
+Use --json to save results and --compare with an earlier file to catch
+regressions, the exit status is 1 if a digest changed or a mode is slower by
+more than --threshold.
+
+Example: ./benchmark_thread.py --count 1000 100000 1000000 --modes bulk --json bulk.json
+'''
+
+# Standalone broilerplate -------------------------------------------------------------
+from django_setup import do_setup
+do_setup()
+# -------------------------------------------------------------------------------------
+
+import argparse
+import datetime
+import hashlib
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+from mlarchive.archive.mail import DedupeIndex, MessageBatch, MessageWrapper
+from mlarchive.archive.models import EmailList, Message, Thread
+from mlarchive.archive.rethread import make_row
+from mlarchive.archive.thread import BulkThreader, compute_thread, get_root_set, process
+from mlarchive.archive.timing import Timings
+from mlarchive.utils.thread_corpus import SHAPES, make_corpus
+
+MODES = ('process', 'compute_thread', 'bulk', 'ingest')
+INGEST_BATCH_SIZE = 500
+
+
+def make_bulk_row(hashcode, **kwargs):
+    return make_row(pk=hashcode, thread_id=0, frm='', **kwargs)
+
+
+def make_email(fields):
+    msg = EmailMessage()
+    msg['Message-ID'] = '<{}>'.format(fields['msgid'])
+    msg['Date'] = format_datetime(fields['date'])
+    msg['From'] = 'Benchmark <benchmark@example.com>'
+    msg['Subject'] = fields['subject']
+    if fields['references']:
+        msg['References'] = fields['references']
+    if fields['in_reply_to_value']:
+        msg['In-Reply-To'] = fields['in_reply_to_value']
+    msg.set_content('benchmark')
+    return msg
+
+
+def get_digest(values):
+    '''Returns digest of (hashcode, depth, order) tuples'''
+    sha = hashlib.sha1()
+    for value in values:
+        sha.update('{} {} {}\n'.format(*value).encode('utf8'))
+    return sha.hexdigest()
+
+
+def thread_process(messages):
+    root_node = process(messages)
+    return [(c.message.hashcode, c.depth, order) for branch in get_root_set(root_node)
+            for order, c in enumerate(branch.walk()) if not c.is_empty()]
+
+
+def thread_compute_thread(messages):
+    return [(info.message.hashcode, info.depth, info.order) for info in compute_thread(messages).values()]
+
+
+def thread_bulk(rows):
+    return [(info.message.pk, info.depth, info.order) for info in BulkThreader().compute_thread(rows)]
+
+
+def ingest(corpus, listname):
+    '''Archive corpus to listname the way load does, with a MessageBatch.  Returns
+    (Timings of all messages, number of threads).  Duplicate message ids are
+    skipped, the archive rejects them
+    '''
+    index = DedupeIndex(listname)
+    batch = MessageBatch(index, size=INGEST_BATCH_SIZE, test=True)
+    timings = Timings()
+    for fields in corpus:
+        if index.has_msgid(fields['msgid']):
+            continue
+        mw = MessageWrapper.from_message(make_email(fields), listname, private=False, batch=batch)
+        mw.process()
+        for stage in ('thread', 'compute_thread'):
+            timings.add(stage, mw.timings.stages.get(stage, 0.0))
+        batch.add(mw)
+        if batch.is_full():
+            batch.flush()
+    batch.flush()
+    return timings, Thread.objects.filter(email_list__name=listname).count()
+
+
+def delete_list(listname):
+    Thread.objects.filter(email_list__name=listname).update(first=None)
+    Message.objects.filter(email_list__name=listname).delete()
+    Thread.objects.filter(email_list__name=listname).delete()
+    EmailList.objects.filter(name=listname).delete()
+
+
+def run(mode, shape, count, args):
+    '''Returns result dictionary of one run'''
+    factory = {'bulk': make_bulk_row, 'ingest': dict}.get(mode, Message)
+    corpus = make_corpus(shape, count, thread_size=args.thread_size, seed=args.seed, factory=factory)
+    result = {'mode': mode, 'shape': shape, 'count': count, 'thread_size': args.thread_size,
+              'seed': args.seed, 'digest': None, 'max_depth': None, 'peak_bytes': None}
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if mode == 'ingest':
+        timings, threads = ingest(corpus, args.listname)
+        result['stages'] = timings.stages
+        result['threads'] = threads
+    else:
+        data = {'process': thread_process,
+                'compute_thread': thread_compute_thread,
+                'bulk': thread_bulk}[mode](corpus)
+    result['elapsed'] = time.perf_counter() - start
+    if args.memory:
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if mode == 'ingest':
+        delete_list(args.listname)
+    else:
+        result['digest'] = get_digest(data)
+        result['max_depth'] = max(depth for _, depth, _ in data)
+    result['msgs_per_sec'] = count / result['elapsed'] if result['elapsed'] else 0
+    return result
+
+
+def report(result):
+    extra = ''
+    if result['peak_bytes'] is not None:
+        extra += '  bytes/msg:{:>7.0f}'.format(result['peak_bytes'] / result['count'])
+    if result['max_depth'] is not None:
+        extra += '  max depth:{:>6}'.format(result['max_depth'])
+    if 'stages' in result:
+        extra += '  threads:{:>7}  get_thread:{:>7.2f}s  compute_thread:{:>7.2f}s'.format(
+            result['threads'], result['stages']['thread'], result['stages']['compute_thread'])
+    print('{:<14} {:<9} messages:{:>8}  elapsed:{:>8.2f}s  msgs/sec:{:>10.0f}{}'.format(
+        result['mode'], result['shape'], result['count'], result['elapsed'], result['msgs_per_sec'], extra))
+
+
+def compare(results, path, threshold):
+    '''Compares results with those saved in path.  Returns number of regressions'''
+    with open(path) as f:
+        previous = {(r['mode'], r['shape'], r['count'], r['thread_size'], r['seed']): r
+                    for r in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        old = previous.get((result['mode'], result['shape'], result['count'], result['thread_size'],
+                            result['seed']))
+        if old is None:
+            continue
+        ratio = result['elapsed'] / old['elapsed'] if old['elapsed'] else 1
+        status = ''
+        if old['digest'] != result['digest']:
+            status = 'RESULT CHANGED'
+        elif ratio > 1 + threshold:
+            status = 'SLOWER'
+        if status:
+            regressions += 1
+        print('{:<14} {:<9} messages:{:>8}  elapsed:{:>8.2f}s -> {:>8.2f}s  {:>5.2f}x  {}'.format(
+            result['mode'], result['shape'], result['count'], old['elapsed'], result['elapsed'], ratio, status))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark threading synthetic lists')
+    parser.add_argument('-c', '--count', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='number of messages, one run per count (1000 to 1000000)')
+    parser.add_argument('-s', '--shapes', nargs='+', choices=SHAPES, default=list(SHAPES),
+                        help='list shapes, see utils/thread_corpus.py')
+    parser.add_argument('-m', '--modes', nargs='+', choices=MODES, default=['process', 'compute_thread', 'bulk'],
+                        help='threading code to time')
+    parser.add_argument('-t', '--thread-size', type=int, default=100, help='messages per thread')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the corpus')
+    parser.add_argument('--memory', action='store_true', help='record peak memory, slows the run')
+    parser.add_argument('-l', '--listname', default='benchmark-thread',
+                        help='list for ingest mode, must not exist, deleted when done')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='compare with results saved by an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction slower than the earlier run reported as a regression')
+    args = parser.parse_args()
+
+    if 'ingest' in args.modes and EmailList.objects.filter(name=args.listname).exists():
+        sys.exit('List already exists: {}'.format(args.listname))
+
+    results = []
+    for shape in args.shapes:
+        for count in args.count:
+            digests = set()
+            for mode in args.modes:
+                result = run(mode, shape, count, args)
+                report(result)
+                results.append(result)
+                if result['digest']:
+                    digests.add(result['digest'])
+            if len(digests) > 1:
+                print('WARNING: modes disagree for {} {}'.format(shape, count))
+
+    if args.json:
+        meta = {'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'node': platform.node()}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,13 @@ have a syntax like:
 The script will make appropriate calls to both archive systems.
 It first calls the mhonarc system then the new archiver.  If either fail handle_error()
 is called.
+
+If the persistent archiver service is running (manage.py archiver) the message is
+handed to it over ARCHIVER_SOCKET, otherwise archive-mail.py is run for the message.
 '''
 
 import getpass
+import json
 import logging
 import logging.handlers
 import os
@@ -24,6 +28,8 @@ from subprocess import Popen, PIPE, STDOUT
     
 
 MAILARCH = '/a/mailarch/current/backend/mlarchive/bin/archive-mail.py'
+ARCHIVER_SOCKET = os.environ.get('MAILARCH_ARCHIVER_SOCKET', '/a/mailarch/data/run/archiver.sock')
+ARCHIVER_TIMEOUT = 300      # seconds
 MAILTO = ['rcross@amsl.com']    # send errors to these addrs
 
 
@@ -39,6 +45,23 @@ def handle_error(error):
     logger.error(error)
 
 
+def call_archiver(data, listname, private):
+    """Hand message to the archiver service.  Returns archive_message() status.
+    Raises ConnectionRefusedError if the service is not running.  See archive/archiver.py
+    """
+    header = json.dumps({'listname': listname, 'private': private, 'length': len(data)})
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(ARCHIVER_TIMEOUT)
+        sock.connect(ARCHIVER_SOCKET)
+        sock.sendall(header.encode('ascii') + b'\n' + data)
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            response = f.readline().strip()
+    if response not in (b'0', b'1'):
+        raise OSError('invalid response from archiver: {}'.format(response))
+    return int(response)
+
+
 path = sys.argv[1]
 with open(path, 'rb') as f:
     data = f.read()
@@ -47,6 +70,18 @@ listname, access, _ = os.path.basename(path).split('.')
 old_args = [listname, '-' + access]
 new_args = [listname, '--' + access]
 
+if os.path.exists(ARCHIVER_SOCKET):
+    try:
+        status = call_archiver(data, listname, access == 'private')
+        if status != 0:
+            handle_error('archiver failed: {}\n\n (exit_code={})\n\n{}'.format(ARCHIVER_SOCKET, status, path))
+        sys.exit(0)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # service not running, fall back to archive-mail.py
+        pass
+    except OSError:
+        handle_error(traceback.format_exc())
+        sys.exit(0)
 
 command = ['/a/mailarch/current/env/bin/python', MAILARCH] + new_args
 cwd = '/a/mailarch/current/backend/mlarchive/bin'
@@ -1,13 +1,44 @@
+from django.conf import settings
 from django.http.response import JsonResponse
 from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
 
+from mlarchive.archive.backends.connections import get_stats
 from mlarchive.exceptions import HttpJson400, HttpJson404
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 class JsonExceptionMiddleware(MiddlewareMixin):
     def process_exception(self, request, exception):
         if isinstance(exception, HttpJson400):
             return JsonResponse({'error': exception.args[0]}, status=400)
         if isinstance(exception, HttpJson404):
-            return JsonResponse({'error': exception.args[0]}, status=404)
\ No newline at end of file
+            return JsonResponse({'error': exception.args[0]}, status=404)
+
+
+class ElasticsearchStatsMiddleware(MiddlewareMixin):
+    """Logs the Elasticsearch requests sent and connections opened while handling
+    each request, see backends.connections.get_stats().  With ELASTICSEARCH_STATS_HEADER
+    set they are also returned in the X-Elasticsearch-Stats response header, to
+    confirm each worker process reuses its connections
+    """
+    def process_request(self, request):
+        request._es_stats = get_stats()
+
+    def process_response(self, request, response):
+        before = getattr(request, '_es_stats', None)
+        if before is None:
+            return response
+        after = get_stats()
+        stats = 'pid={} requests={} connections={} total_requests={} total_connections={}'.format(
+            after['pid'],
+            after['requests'] - before['requests'],
+            after['connections'] - before['connections'],
+            after['requests'],
+            after['connections'])
+        logger.debug('elasticsearch {} {}'.format(request.path, stats))
+        if getattr(settings, 'ELASTICSEARCH_STATS_HEADER', False):
+            response['X-Elasticsearch-Stats'] = stats
+        return response
@@ -47,7 +47,11 @@ env = environ.Env(
     DEBUG_TOOLBAR_ON=(bool, False),
     ELASTICSEARCH_HOST=(str, '127.0.0.1'),
     ELASTICSEARCH_PASSWORD=(str, 'changeme'),
+    ELASTICSEARCH_POOL_SIZE=(int, 10),
     ELASTICSEARCH_SIGNAL_PROCESSOR=(str, 'mlarchive.archive.signals.CelerySignalProcessor'),
+    ELASTICSEARCH_SNIFF=(bool, False),
+    ELASTICSEARCH_STATS_HEADER=(bool, False),
+    ELASTICSEARCH_TIMEOUT=(int, 10),
     EXPORT_LIMIT=(int, 5000),
     HTAUTH_PASSWD_FILENAME=(str, ''),
     IMPORT_MESSAGE_APIKEY=(str, ''),
@@ -144,6 +148,7 @@ MIDDLEWARE = [
     'django_referrer_policy.middleware.ReferrerPolicyMiddleware',
     'csp.middleware.CSPMiddleware',
     'mlarchive.middleware.JsonExceptionMiddleware',
+    'mlarchive.middleware.ElasticsearchStatsMiddleware',
 ]
 
 
@@ -205,11 +210,18 @@ SEARCH_RESULTS_PER_PAGE = 40
 ELASTICSEARCH_INDEX_NAME = 'mail-archive'
 ELASTICSEARCH_SILENTLY_FAIL = True
 ES_URL = 'http://{}:9200/'.format(env('ELASTICSEARCH_HOST'))
+# one client per process, see archive/backends/connections.py
 ELASTICSEARCH_CONNECTION = {
     'URL': ES_URL,
     'INDEX_NAME': 'mail-archive',
     'http_auth': ('elastic', env('ELASTICSEARCH_PASSWORD')),
+    'POOL_SIZE': env('ELASTICSEARCH_POOL_SIZE'),
+    'TIMEOUT': env('ELASTICSEARCH_TIMEOUT'),
+    'KEEP_ALIVE': True,
+    'SNIFF': env('ELASTICSEARCH_SNIFF'),
 }
+# add X-Elasticsearch-Stats response header, see middleware.py
+ELASTICSEARCH_STATS_HEADER = env('ELASTICSEARCH_STATS_HEADER')
 ELASTICSEARCH_DEFAULT_OPERATOR = 'AND'
 ELASTICSEARCH_RESULTS_PER_PAGE = 40
 ELASTICSEARCH_SIGNAL_PROCESSOR = env('ELASTICSEARCH_SIGNAL_PROCESSOR')
@@ -267,9 +279,19 @@ REFERRER_POLICY = 'strict-origin-when-cross-origin'
 ARCHIVE_HOST_URL = 'https://mailarchive.ietf.org'
 DATA_ROOT = env('DATA_ROOT')
 ARCHIVE_DIR = os.path.join(DATA_ROOT, 'archive')
+# layout of message files in ARCHIVE_DIR, "flat" or "sharded", see archive/storage.py
+ARCHIVE_LAYOUT = 'flat'
+ARCHIVE_LAYOUT_OPTIONS = {'sharded': {'levels': 2, 'width': 1}}
+# compress new message files, None, "gzip" or "zstd" (requires zstandard package)
+ARCHIVE_COMPRESSION = None
 INCOMING_DIR = os.path.join(DATA_ROOT, 'incoming')
 ARCHIVE_MBOX_DIR = os.path.join(DATA_ROOT, 'archive_mbox')
 CONSOLE_STATS_FILE = os.path.join(DATA_ROOT, 'log', 'console.json')
+# UNIX socket of the persistent archiver service, see archive/archiver.py
+ARCHIVER_SOCKET = os.path.join(DATA_ROOT, 'run', 'archiver.sock')
+# permissions of the socket, the MTA delivery user must be in ARCHIVER_SOCKET_GROUP
+ARCHIVER_SOCKET_MODE = 0o660
+ARCHIVER_SOCKET_GROUP = None
 
 # maximum number of messages a non-superuser can export
 EXPORT_LIMIT = env('EXPORT_LIMIT')
@@ -277,6 +299,8 @@ EXPORT_LIMIT = env('EXPORT_LIMIT')
 ANONYMOUS_EXPORT_LIMIT = env('ANONYMOUS_EXPORT_LIMIT')
 # maximum results for which we'll provide filter options
 FILTER_CUTOFF = 5000
+# maximum messages fetched per query when loading the messages of search results
+HYDRATE_CHUNK_SIZE = 1000
 
 LOG_DIR = env('LOG_DIR')
 LOG_FILE = os.path.join(LOG_DIR, 'mlarchive.log')
@@ -292,6 +316,8 @@ IMPORT_MESSAGE_APIKEY = env('IMPORT_MESSAGE_APIKEY')
 # API KEYS: key=endpoint, value=[api-key,]
 API_KEYS = {
     '/api/v1/message/import/': [IMPORT_MESSAGE_APIKEY],
+    '/api/v1/message/import/batch/': [IMPORT_MESSAGE_APIKEY],
+    '/api/v1/message/import/batch/status/': [IMPORT_MESSAGE_APIKEY],
 }
 
 # Default timeout for HTTP requests via the requests library
@@ -302,6 +328,8 @@ SESSION_COOKIE_SECURE = True
 
 # number of messages to load when scrolling search results
 SEARCH_SCROLL_BUFFER_SIZE = SEARCH_RESULTS_PER_PAGE
+# number of search results per query whose neighbours are cached for the detail page
+SEARCH_RESULT_WINDOW_SIZE = 1000
 TEST_DATA_DIR = BASE_DIR + '/archive/fixtures'
 USE_EXTERNAL_PROCESSOR = False
 MAX_THREAD_DEPTH = 6
@@ -367,6 +395,10 @@ CELERY_HAYSTACK_TRANSACTION_SAFE = False
 # IMAP Interface
 EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
 IMPORT_DIR = os.path.join(DATA_ROOT, 'incoming')
+IMPORT_CHECKPOINT_DIR = os.path.join(DATA_ROOT, 'checkpoint')     # load command, see mail.Checkpoint
+IMPORT_BATCH_MAX_MESSAGES = 1000        # per request
+IMPORT_BATCH_CHUNK_SIZE = 100           # messages per import_batch task
+IMPORT_BATCH_REQUEUE_AGE = 3600         # seconds a job is idle before unprocessed chunks are queued again
 # NOTIFY_LIST_CHANGE_COMMAND = '/a/mailarch/scripts/call_imap_import.sh'
 
 
@@ -448,6 +480,14 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'stream': sys.stdout,
         },
+        # per message ingestion stage timings, see archive/timing.py
+        'timing': {
+            'level': 'INFO',
+            'formatter': 'json',
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': os.path.join(LOG_DIR, 'timing.log'),
+            'delay': True,
+        },
     },
     'loggers': {
         # Top level logger
@@ -462,6 +502,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': False,
         },
+        'mlarchive.timing': {
+            'handlers': ['timing'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'celery': {
             'handlers': ['console'],
             'level': 'INFO',
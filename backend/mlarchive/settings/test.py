@@ -30,6 +30,7 @@ LOG_FILE = os.path.join(BASE_DIR, 'tests/tmp', 'mlarchive.log')
 SERVER_MODE = 'development'
 
 LOGGING['handlers']['mlarchive']['filename'] = LOG_FILE
+LOGGING['handlers']['timing']['filename'] = os.path.join(BASE_DIR, 'tests/tmp', 'timing.log')
 
 CACHES = {
     'default': {
@@ -39,6 +40,7 @@ CACHES = {
 
 # IMAP Interface
 EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
+IMPORT_CHECKPOINT_DIR = os.path.join(DATA_ROOT, 'checkpoint')
 
 
 # CLOUDFLARE  INTEGRATION
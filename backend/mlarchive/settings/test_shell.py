@@ -36,6 +36,7 @@ LOG_FILE = os.path.join(BASE_DIR, 'tests/tmp', 'mlarchive.log')
 SERVER_MODE = 'development'
 
 LOGGING['handlers']['mlarchive']['filename'] = LOG_FILE
+LOGGING['handlers']['timing']['filename'] = os.path.join(BASE_DIR, 'tests/tmp', 'timing.log')
 
 CACHES = {
     'default': {
@@ -213,10 +213,12 @@ var mailarch = {
         var queryid = mailarch.$msgList.data('queryid');
         var browselist = mailarch.$msgList.data('browse-list');
         var referenceId = $("#msg-list .xtr:last .id-col").text();
+        var sortValues = $("#msg-list .xtr:last .sort-col").text();
         var data = $.extend({ "qid": queryid,
                      "referenceitem": mailarch.lastItem,
                      "browselist": browselist,
                      "referenceid": referenceId,
+                     "sortvalues": sortValues,
                      "direction": "next"
         }, mailarch.urlParams);
         var request = $.ajax({
@@ -259,10 +261,12 @@ var mailarch = {
         var referenceItem = mailarch.$msgList.data('queryset-offset');
         var browselist = mailarch.$msgList.data('browse-list');
         var referenceId = $("#msg-list .xtr:first .id-col").text();
+        var sortValues = $("#msg-list .xtr:first .sort-col").text();
         var data = $.extend({ "qid": queryid,
                      "referenceitem": referenceItem,
                      "browselist": browselist,
                      "referenceid": referenceId,
+                     "sortvalues": sortValues,
                      "direction": "previous"
         }, mailarch.urlParams);
         var request = $.ajax({
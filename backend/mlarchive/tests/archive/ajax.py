@@ -8,6 +8,7 @@ from factories import EmailListFactory, ThreadFactory, MessageFactory
 from mock import patch
 from pyquery import PyQuery
 
+from mlarchive.archive.backends.connections import get_client
 from mlarchive.archive.models import Message, Thread
 from mlarchive.archive.ajax import (get_query_results, get_browse_results,
     get_browse_results_gbt, get_browse_results_date)
@@ -243,6 +244,49 @@ def test_get_query_results(client, messages, settings):
     assert [int(r.django_id) for r in results] == [m.pk for m in messages[10:]]
 
 
+@pytest.mark.django_db(transaction=True)
+def test_get_query_results_search_after(client, messages, settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    url = '%s?email_list=pubthree&so=-date' % reverse('archive_search')
+    response = client.get(url)
+    assert response.status_code == 200
+    q = PyQuery(response.content)
+    qid = q('.msg-list').attr('data-queryid')
+    query = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    query = query.update_from_dict(cache.get(qid))
+    hits = list(query[:21].execute())
+    messages = messages.filter(email_list__name='pubthree').order_by('-date')
+    # next, from the 10th result
+    results = get_query_results(query=query, referenceitem=0, direction='next',
+                                sort_values=list(hits[9].meta.sort))
+    assert [int(r.django_id) for r in results] == [m.pk for m in messages[10:]]
+    # previous, from the 15th result
+    settings.SEARCH_SCROLL_BUFFER_SIZE = 5
+    results = get_query_results(query=query, referenceitem=0, direction='previous',
+                                sort_values=list(hits[14].meta.sort))
+    assert [int(r.django_id) for r in results] == [m.pk for m in messages[9:14]]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ajax_messages_sortvalues(client, messages, settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    url = '%s?email_list=pubthree&so=-date' % reverse('archive_search')
+    response = client.get(url)
+    q = PyQuery(response.content)
+    qid = q('.msg-list').attr('data-queryid')
+    sort_values = q('.xtr .sort-col').eq(-1).text()
+    assert sort_values
+    count = len(q('.xtr .sort-col'))
+    # referenceitem is ignored when sortvalues is given
+    url = '%s?qid=%s&referenceitem=0&direction=next&sortvalues=%s' % (
+        reverse('ajax_messages'), qid, sort_values)
+    response = client.get(url)
+    assert response.status_code == 200
+    messages = messages.filter(email_list__name='pubthree').order_by('-date')
+    q = PyQuery(response.content)
+    assert [int(i.text) for i in q('.xtr .id-col')] == [m.pk for m in messages[count:]]
+
+
 @pytest.mark.django_db(transaction=True)
 def test_get_browse_results(client, messages):
     '''Simple test of high level function'''
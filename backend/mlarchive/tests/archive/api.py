@@ -1,12 +1,16 @@
 import base64
 import datetime
+import fcntl
 import json
 import pytest
 import os
 from datetime import timezone 
 
 from django.urls import reverse
+from unittest.mock import patch
 from factories import EmailListFactory, MessageFactory
+from mlarchive.archive import tasks
+from mlarchive.archive.import_jobs import get_job_results
 from mlarchive.archive.models import Subscriber, Message, EmailList
 
 
@@ -345,3 +349,119 @@ def test_import_message_failure(client, settings):
 
     # assert message does not exist
     assert Message.objects.all().count() == 0
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('mlarchive.archive.tasks.import_batch.delay')
+def test_import_message_batch(mock_delay, client, settings, tmpdir):
+    url = reverse('api_import_message_batch')
+    status_url = reverse('api_import_message_batch_status')
+    settings.API_KEYS = {url: 'valid_token', status_url: 'valid_token'}
+    settings.IMPORT_DIR = str(tmpdir)
+    settings.IMPORT_BATCH_CHUNK_SIZE = 2
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail.1')
+    with open(path, 'rb') as f:
+        message = f.read()
+    items = [
+        {'list_name': 'apple', 'list_visibility': 'public', 'message': base64.b64encode(message).decode()},
+        {'list_name': 'apple', 'message': base64.b64encode(message).decode()},
+        {'list_name': 'apple', 'message': base64.b64encode(b'This is not an email').decode()},
+    ]
+
+    # no api key
+    response = client.post(url, items, content_type='application/json')
+    assert response.status_code == 403
+
+    # invalid item
+    response = client.post(
+        url,
+        items + [{'list_name': '', 'message': ''}],
+        headers={'X-API-Key': 'valid_token'},
+        content_type='application/json')
+    assert response.status_code == 400
+    assert mock_delay.call_count == 0
+
+    # valid request, ndjson
+    response = client.post(
+        url,
+        '\n'.join(json.dumps(item) for item in items),
+        headers={'X-API-Key': 'valid_token'},
+        content_type='application/x-ndjson')
+    assert response.status_code == 202
+    job_id = response.json()['id']
+    assert response.json()['count'] == 3
+    assert mock_delay.call_count == 2
+    mock_delay.assert_called_with(job_id, 2, 4)
+    # messages, manifest and a claim per chunk
+    assert len(os.listdir(os.path.join(str(tmpdir), 'batch', job_id))) == 6
+    assert Message.objects.count() == 0
+
+    # status before processing
+    response = client.get(status_url, {'id': job_id}, headers={'X-API-Key': 'valid_token'})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['status'] == 'queued'
+    assert data['counts'] == {'queued': 3}
+
+    # run tasks
+    for call in mock_delay.call_args_list:
+        tasks.import_batch(*call.args)
+    assert Message.objects.filter(email_list__name='apple').count() == 1
+
+    response = client.get(status_url, {'id': job_id}, headers={'X-API-Key': 'valid_token'})
+    data = response.json()
+    assert data['status'] == 'complete'
+    assert [m['status'] for m in data['messages']] == ['archived', 'duplicate', 'failed']
+
+    # unknown job
+    response = client.get(status_url, {'id': '../etc'}, headers={'X-API-Key': 'valid_token'})
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('mlarchive.archive.tasks.import_batch.delay')
+def test_import_message_batch_broker_down(mock_delay, client, settings, tmpdir):
+    url = reverse('api_import_message_batch')
+    settings.API_KEYS = {url: 'valid_token'}
+    settings.IMPORT_DIR = str(tmpdir)
+    settings.IMPORT_BATCH_CHUNK_SIZE = 2
+    settings.IMPORT_BATCH_REQUEUE_AGE = 0
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail.1')
+    with open(path, 'rb') as f:
+        message = base64.b64encode(f.read()).decode()
+    items = [{'list_name': 'apple', 'message': message}] * 3
+    mock_delay.side_effect = OSError('Connection refused')
+    response = client.post(url, items, headers={'X-API-Key': 'valid_token'}, content_type='application/json')
+    # the job is spooled
+    assert response.status_code == 202
+    job_id = response.json()['id']
+    assert mock_delay.call_count == 1
+
+    # requeued by the periodic task
+    mock_delay.reset_mock()
+    mock_delay.side_effect = None
+    tasks.requeue_import_batch_task()
+    assert [call.args for call in mock_delay.call_args_list] == [(job_id, 0, 2), (job_id, 2, 4)]
+
+    # processed chunks are not requeued
+    tasks.import_batch(job_id, 0, 2)
+    mock_delay.reset_mock()
+    tasks.requeue_import_batch_task()
+    assert [call.args for call in mock_delay.call_args_list] == [(job_id, 2, 4)]
+
+    # chunks queued recently or being processed are not requeued
+    settings.IMPORT_BATCH_REQUEUE_AGE = 3600
+    mock_delay.reset_mock()
+    tasks.requeue_import_batch_task()
+    assert mock_delay.call_count == 0
+    settings.IMPORT_BATCH_REQUEUE_AGE = 0
+    with open(os.path.join(str(tmpdir), 'batch', job_id, 'claim-00002')) as claim:
+        fcntl.flock(claim, fcntl.LOCK_EX)
+        tasks.requeue_import_batch_task()
+        assert mock_delay.call_count == 0
+
+    # a chunk run twice keeps the outcomes of the first run
+    tasks.import_batch(job_id, 0, 2)
+    results = get_job_results(job_id)
+    assert results[0] == 'archived'
+    assert Message.objects.count() == 1
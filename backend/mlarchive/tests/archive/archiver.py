@@ -0,0 +1,80 @@
+import io
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+from mlarchive.archive.archiver import (ArchiverServer, ProtocolError, read_request,
+    send_message)
+from mlarchive.archive.models import Message
+
+
+MESSAGE = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000005@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: This is a test
+
+Hello,
+
+This is a test email.
+'''
+
+
+@pytest.fixture()
+def archiver(tmp_dir):
+    path = os.path.join(tmp_dir, 'run', 'archiver.sock')
+    server = ArchiverServer(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_archiver_socket_mode(archiver):
+    assert stat.S_IMODE(os.stat(archiver.socket_path).st_mode) == 0o660
+
+
+def test_read_request():
+    rfile = io.BytesIO(b'{"listname": "acme", "private": true, "length": 5}\nHello')
+    assert read_request(rfile) == (b'Hello', 'acme', True)
+    # truncated data
+    rfile = io.BytesIO(b'{"listname": "acme", "length": 10}\nHello')
+    with pytest.raises(ProtocolError):
+        read_request(rfile)
+    # bad header
+    rfile = io.BytesIO(b'acme 10\nHello')
+    with pytest.raises(ProtocolError):
+        read_request(rfile)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_archiver(archiver):
+    status = send_message(MESSAGE, 'acme', socket_path=archiver.socket_path)
+    assert status == 0
+    assert Message.objects.filter(email_list__name='acme', msgid='0000000005@example.com').count() == 1
+    # duplicate has same status as archive_message()
+    status = send_message(MESSAGE, 'acme', socket_path=archiver.socket_path)
+    assert status == 0
+    assert Message.objects.count() == 1
+    assert archiver.stats == {'count': 2, 'errors': 0}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_archiver_bad_request(archiver):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(archiver.socket_path)
+        sock.sendall(b'bogus\n')
+        sock.shutdown(socket.SHUT_WR)
+        assert sock.recv(16) == b'1\n'
+    assert Message.objects.count() == 0
+
+
+def test_archiver_not_running(tmp_dir):
+    with pytest.raises(OSError):
+        send_message(MESSAGE, 'acme', socket_path=os.path.join(tmp_dir, 'missing.sock'))
@@ -61,6 +61,7 @@ def data_dir(tmp_dir, settings):
     if not os.path.exists(settings.ARCHIVE_DIR):
         os.mkdir(settings.ARCHIVE_DIR)
     settings.EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
+    settings.IMPORT_CHECKPOINT_DIR = os.path.join(DATA_ROOT, 'checkpoint')
     yield
 
 # -----------------------------------
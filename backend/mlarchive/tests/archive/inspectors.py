@@ -2,10 +2,13 @@ import email
 import os
 import pytest
 
+from django.core.exceptions import ImproperlyConfigured
+
 from mlarchive.archive.inspectors import (ListIdSpamInspector, SpamMessage,
     SpamLevelSpamInspector, NoArchiveInspector, NoArchiveMessage,
-    LongMessageIDSpamInspector)
+    LongMessageIDSpamInspector, Inspector, Pipeline, get_pipeline)
 from mlarchive.archive.mail import MessageWrapper
+from mlarchive.archive.models import EmailList
 
 
 @pytest.mark.django_db(transaction=True)
@@ -95,3 +98,48 @@ def test_LongMessageIDSpamInspector(client, settings):
         inspector.inspect()
     print(excinfo)
     assert 'Spam' in str(excinfo.value)
+
+
+class BodyInspector(Inspector):
+    def has_condition(self):
+        return False
+
+
+def test_Pipeline():
+    pipeline = Pipeline({
+        'BodyInspector': {},
+        'SpamLevelSpamInspector': {'includes': ['acme']},
+        'NoArchiveInspector': {}})
+    # header only first, otherwise settings order
+    assert [k for k, o in pipeline.inspectors] == [SpamLevelSpamInspector, NoArchiveInspector, BodyInspector]
+    assert pipeline.inspectors[0][1]['includes'] == frozenset(['acme'])
+    assert [k for k, o in pipeline.get_inspectors('acme', True)] == [SpamLevelSpamInspector, NoArchiveInspector]
+    assert [k for k, o in pipeline.get_inspectors('ietf', True)] == [NoArchiveInspector]
+    assert [k for k, o in pipeline.get_inspectors('ietf', False)] == [BodyInspector]
+    with pytest.raises(ImproperlyConfigured):
+        Pipeline({'BogusInspector': {}})
+
+
+def test_get_pipeline(settings):
+    settings.INSPECTORS = {'NoArchiveInspector': {}}
+    pipeline = get_pipeline()
+    assert get_pipeline() is pipeline
+    settings.INSPECTORS = {'LongMessageIDSpamInspector': {}}
+    assert get_pipeline() is not pipeline
+    assert [k for k, o in get_pipeline().inspectors] == [LongMessageIDSpamInspector]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_check_headers_before_process(client, settings):
+    settings.INSPECTORS = {'SpamLevelSpamInspector': {'includes': ['acme-headers']}}
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail_spamlevel.2')
+    with open(path, 'rb') as f:
+        data = f.read()
+    mw = MessageWrapper.from_bytes(data, 'acme-headers')
+    with pytest.raises(SpamMessage):
+        mw.save()
+    # rejected before process(), no list created, body never parsed
+    assert mw._archive_message is None
+    assert mw._email_message is None
+    assert not EmailList.objects.filter(name='acme-headers').exists()
+    assert 'inspectors' in mw.timings.stages
@@ -0,0 +1,164 @@
+import ast
+import os
+import shutil
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from mlarchive.archive.mail import Checkpoint, MessageBatch
+from mlarchive.archive.management.commands.load import gather_files, gather_lists
+from mlarchive.archive.models import Message
+
+
+def make_source(tmp_dir):
+    '''Create a directory of list directories'''
+    source = os.path.join(tmp_dir, 'import')
+    for listname, filename in (('acme', 'search_api.mbox'), ('Ford', 'search_api_ford.mbox')):
+        path = os.path.join(source, listname)
+        os.makedirs(path, exist_ok=True)
+        shutil.copy(os.path.join(settings.BASE_DIR, 'tests', 'data', filename),
+                    os.path.join(path, '2017-01.mail'))
+    # empty files and non-matching names are skipped
+    open(os.path.join(source, 'acme', '2017-02.mail'), 'w').close()
+    open(os.path.join(source, 'acme', 'README'), 'w').close()
+    return source
+
+
+def test_gather_files(tmp_dir):
+    source = make_source(tmp_dir)
+    files = gather_files(os.path.join(source, 'acme'))
+    assert files == [os.path.join(source, 'acme', '2017-01.mail')]
+    with pytest.raises(CommandError):
+        gather_files(os.path.join(source, 'missing'))
+
+
+def test_gather_lists(tmp_dir):
+    source = make_source(tmp_dir)
+    jobs = gather_lists(source)
+    assert sorted(name for name, files in jobs) == ['acme', 'ford']
+    # single list directory
+    jobs = gather_lists(os.path.join(source, 'acme'))
+    assert [name for name, files in jobs] == ['acme']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_workers(tmp_dir):
+    source = make_source(tmp_dir)
+    out = StringIO()
+    call_command('load', source, workers=2, summary=True, test=True, stdout=out)
+    stats = ast.literal_eval(out.getvalue().strip())
+    assert stats['lists'] == 2
+    assert stats['count'] == 8
+    assert Message.objects.filter(email_list__name='acme').count() == 4
+    assert Message.objects.filter(email_list__name='ford').count() == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_workers_listname(tmp_dir):
+    source = make_source(tmp_dir)
+    with pytest.raises(CommandError):
+        call_command('load', source, workers=2, listname='acme')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_duplicates(tmp_dir):
+    source = make_source(tmp_dir)
+    path = os.path.join(source, 'acme', '2017-01.mail')
+    call_command('load', path, listname='acme', test=True, stdout=StringIO())
+    assert Message.objects.filter(email_list__name='acme').count() == 4
+    # reload same file, duplicates rejected without saving
+    call_command('load', path, listname='acme', test=True, stdout=StringIO())
+    assert Message.objects.filter(email_list__name='acme').count() == 4
+
+
+def get_thread_summary(listname):
+    '''Returns list of message attributes that depend on threading, keyed by msgid'''
+    summary = []
+    for message in Message.objects.filter(email_list__name=listname).order_by('msgid'):
+        summary.append((message.msgid,
+                        message.thread.first.msgid,
+                        message.thread_order,
+                        message.thread_depth,
+                        message.in_reply_to.msgid if message.in_reply_to else None,
+                        message.attachment_set.count()))
+    return summary
+
+
+def make_combined(tmp_dir):
+    path = os.path.join(tmp_dir, 'combined.mail')
+    with open(path, 'wb') as out:
+        for filename in ('thread.mail', 'export.mbox', 'attachment.mail'):
+            with open(os.path.join(settings.BASE_DIR, 'tests', 'data', filename), 'rb') as f:
+                out.write(f.read())
+    return path
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_batch(tmp_dir):
+    path = make_combined(tmp_dir)
+    call_command('load', path, listname='serial', test=True, stdout=StringIO())
+    call_command('load', path, listname='batch', batch_size=4, test=True, stdout=StringIO())
+    serial = get_thread_summary('serial')
+    assert len(serial) == 25
+    assert any(item[-1] for item in serial)
+    assert get_thread_summary('batch') == serial
+    # reload in batch mode, duplicates rejected
+    call_command('load', path, listname='batch', batch_size=4, test=True, stdout=StringIO())
+    assert Message.objects.filter(email_list__name='batch').count() == 25
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_resume(tmp_dir):
+    path = make_combined(tmp_dir)
+    call_command('load', path, listname='resume-serial', test=True, stdout=StringIO())
+
+    # fail on the third batch
+    flush = MessageBatch.flush
+    calls = []
+
+    def failing_flush(self):
+        calls.append(self)
+        if len(calls) == 3:
+            raise Exception('database went away')
+        return flush(self)
+
+    with patch.object(MessageBatch, 'flush', failing_flush):
+        with pytest.raises(Exception):
+            call_command('load', path, listname='resume', batch_size=4, test=True, stdout=StringIO(),
+                **{'break': True})
+    state = Checkpoint('resume').get(path)
+    assert state['key'] > 0 and not state['complete']
+    loaded = Message.objects.filter(email_list__name='resume').count()
+    assert 0 < loaded < 25
+
+    out = StringIO()
+    call_command('load', path, listname='resume', batch_size=4, resume=True, test=True, summary=True,
+        stdout=out)
+    stats = ast.literal_eval(out.getvalue().strip())
+    # started after the checkpoint, not from the beginning
+    assert stats['count'] == 25 - state['key']
+    assert get_thread_summary('resume') == get_thread_summary('resume-serial')
+    assert Checkpoint('resume').get(path)['complete']
+
+    # loaded files are skipped, progress reported
+    out = StringIO()
+    call_command('load', path, listname='resume', resume=True, test=True, stdout=out)
+    assert 'skipped:1' in out.getvalue()
+    out = StringIO()
+    call_command('load', path, listname='resume', test=True, stdout=out)
+    assert 'combined.mail: 100.0%' in out.getvalue()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_profile(tmp_dir):
+    path = make_combined(tmp_dir)
+    out = StringIO()
+    call_command('load', path, listname='profile', batch_size=10, profile=True, test=True, stdout=out)
+    output = out.getvalue()
+    for stage in ('read', 'parse', 'thread', 'flush'):
+        assert '\n' + stage + ' ' in output
+    assert 'profile:' not in output
@@ -13,6 +13,7 @@ import shutil
 import six
 import sys
 from io import StringIO, BytesIO
+from unittest.mock import patch
 from dateutil.tz import tzoffset
 from datetime import timezone
 
@@ -21,11 +22,13 @@ from django.core.management import call_command
 from django.urls import reverse
 from django.utils.timezone import is_aware
 
-from mlarchive.archive.models import Message, EmailList
-from mlarchive.archive.mail import (archive_message, clean_spaces, MessageWrapper,
+from mlarchive.archive.models import Message, EmailList, Legacy
+from mlarchive.archive.storage import find_path, get_write_path
+from mlarchive.archive.mail import (archive_message, clean_spaces, DedupeIndex, DuplicateMessage, MessageWrapper,
     get_base_subject, get_envelope_date, get_from, get_header_date, get_mb,
     get_received_date, parsedate_to_datetime, subject_is_reply,
-    lookup_extension, get_message_from_bytes)
+    lookup_extension, get_message_from_bytes, scan_mbox, scan_mmdf, CustomMbox, CustomMMDF, MappedMbox,
+    SEPARATOR_PATTERNS, MessageBatch, ThreadCache, get_thread_cache)
 from factories import EmailListFactory, MessageFactory, ThreadFactory
 from mlarchive.utils.test_utils import message_from_file
 
@@ -95,6 +98,22 @@ def test_archive_message_fail(client):
     os.remove(filename)                         # cleanup
 
 
+@pytest.mark.django_db(transaction=True)
+@patch('mlarchive.archive.mail.timing_logger')
+def test_archive_message_timing(mock_logger):
+    status = archive_message(SIMPLE_MESSAGE_BYTES, 'timing', private=False)
+    assert status == 0
+    extra = mock_logger.info.call_args[1]['extra']
+    assert extra['outcome'] == 'archived'
+    assert extra['msgid'] == '0000000002@example.com'
+    for stage in ('parse', 'date', 'thread', 'write', 'save'):
+        assert stage in extra['stages_ms']
+    assert extra['total_ms'] > 0
+    # duplicate
+    archive_message(SIMPLE_MESSAGE_BYTES, 'timing', private=False)
+    assert mock_logger.info.call_args[1]['extra']['outcome'] == 'duplicate'
+
+
 def test_archive_message_bad_order():
     # test that index thread id / date correct if older message added later
     # TODO
@@ -291,6 +310,61 @@ def test_get_mb():
         assert len(mb) > 0
 
 
+def test_MappedMbox():
+    files = ['export.mbox', 'latin1.mbox', 'search_api.mbox', 'thread.mail', 'attachment.mail',
+             'mailbox_mbox']
+    for name in files:
+        path = os.path.join(settings.BASE_DIR, 'tests', 'data', name)
+        mb = MappedMbox(path)
+        expected = mailbox.mbox(path)
+        assert len(mb) == len(expected) > 0
+        assert mb._toc == expected._toc
+        for key in expected.keys():
+            assert mb.get_bytes(key) == expected.get_bytes(key)
+            assert mb.get_message(key).get_from() == expected.get_message(key).get_from()
+        mb.close()
+
+
+def test_MappedMbox_lazy():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'export.mbox')
+    mb = MappedMbox(path)
+    # only scans as far as needed
+    assert next(iter(mb))['Message-ID']
+    assert len(mb._toc) == 1
+    assert len(mb) == len(mailbox.mbox(path))
+    mb.close()
+
+
+def test_scan_mbox():
+    data = b'From a\nA: 1\n\nbody\n\nFrom b\nB: 2\nFrom c\n\nFrom d\n'
+    assert list(scan_mbox(data)) == [(0, 18), (19, 31), (31, 38), (39, 46)]
+    assert list(scan_mbox(b'')) == []
+    assert list(scan_mbox(b'no messages\n')) == []
+
+
+def test_CustomMMDF():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mailbox_mmdf')
+    mb = CustomMMDF(path)
+    expected = mailbox.MMDF(path)
+    assert len(mb) == len(expected) > 0
+    assert mb._toc == expected._toc
+    assert mb.get_message(0)['Message-ID']
+    assert list(scan_mmdf(b'\x01\x01\x01\x01\nA: 1\n\x01\x01\x01\x01\n\x01\x01\x01\x01\nB: 2')) == [
+        (5, 9), (20, 24)]
+    mb.close()
+
+
+def test_CustomMbox():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mailbox_return-path')
+    mb = CustomMbox(path, separator=SEPARATOR_PATTERNS[0])
+    messages = list(mb)
+    assert len(messages) > 1
+    for msg in messages:
+        # separator header kept
+        assert msg['Return-Path']
+    mb.close()
+
+
 def test_get_received_date():
     data = '''Received: from mail.ietf.org ([64.170.98.30]) by localhost \
 (ietfa.amsl.com [127.0.0.1]) (amavisd-new, port 10024) with ESMTP id oE4MnXBb8IJ9 \
@@ -331,6 +405,144 @@ def test_subject_is_reply():
 
 # def test_Loader()
 
+
+@pytest.mark.django_db(transaction=True)
+def test_DedupeIndex():
+    elist = EmailListFactory.create(name='acme')
+    msg = MessageFactory.create(email_list=elist)
+    Legacy.objects.create(email_list_id='acme', msgid='legacy@example.com', number=1)
+    index = DedupeIndex('acme', legacy=True)
+    assert len(index) == 1
+    assert index.has_msgid(msg.msgid)
+    assert index.has_hashcode(msg.hashcode)
+    assert index.has_legacy('legacy@example.com')
+    assert not index.has_msgid('new@example.com')
+    index.add('new@example.com', 'abcdefg=')
+    assert index.has_msgid('new@example.com')
+    assert index.has_hashcode('abcdefg=')
+    assert DedupeIndex('ford').legacy is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ThreadCache(django_assert_num_queries):
+    elist = EmailListFactory.create(name='acme-cache')
+    thread = ThreadFactory.create()
+    first = MessageFactory.create(email_list=elist, thread=thread, msgid='001@example.com',
+        base_subject='Cache', date=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+    MessageFactory.create(email_list=elist, thread=thread, msgid='dup@example.com')
+    MessageFactory.create(email_list=elist, thread=thread, msgid='dup@example.com')
+    thread_cache = ThreadCache(elist, size=2)
+    msgids = ['001@example.com', 'dup@example.com', 'none@example.com']
+    with django_assert_num_queries(1):
+        result = thread_cache.resolve(msgids)
+    assert result == {'001@example.com': (first.pk, thread.pk), 'dup@example.com': None, 'none@example.com': None}
+    with django_assert_num_queries(0):
+        assert thread_cache.resolve(['001@example.com']) == {'001@example.com': (first.pk, thread.pk)}
+    # subject
+    after = datetime.datetime(2017, 1, 1, tzinfo=timezone.utc)
+    assert thread_cache.get_latest_by_subject('Cache', after) == (first.date, thread.pk)
+    # confirmed with one existence query
+    with django_assert_num_queries(1):
+        assert thread_cache.get_latest_by_subject('Cache', after) == (first.date, thread.pk)
+    assert thread_cache.get_latest_by_subject('Cache', first.date) is None
+    # a newer message archived by another process, the cache doesn't see it
+    other = ThreadFactory.create()
+    newer = MessageFactory.create(email_list=elist, thread=other, msgid='004@example.com',
+        base_subject='Cache', date=datetime.datetime(2016, 6, 1, tzinfo=timezone.utc))
+    assert thread_cache.get_latest_by_subject('Cache', after) == (newer.date, other.pk)
+    # expired
+    thread_cache.ttl = -1
+    thread_cache.add(MessageFactory.build(email_list=elist, thread=thread, msgid='005@example.com'))
+    with django_assert_num_queries(1):
+        thread_cache.resolve(['005@example.com'])
+    thread_cache.ttl = 300
+    # lru
+    thread_cache.add(MessageFactory.build(email_list=elist, thread=thread, msgid='002@example.com'))
+    thread_cache.add(MessageFactory.build(email_list=elist, thread=thread, msgid='003@example.com'))
+    assert list(thread_cache.msgids) == ['002@example.com', '003@example.com']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ThreadCache_signals():
+    elist = EmailListFactory.create(name='acme-cache-signals')
+    thread_cache = get_thread_cache(elist)
+    assert get_thread_cache(elist) is thread_cache
+    message = MessageFactory.create(email_list=elist, msgid='001@example.com')
+    assert thread_cache.msgids['001@example.com'][0] == (message.pk, message.thread_id)
+    assert thread_cache.subjects[message.base_subject][0] == (message.date, message.thread_id)
+    message.delete()
+    assert '001@example.com' not in thread_cache.msgids
+    elist.delete()
+    assert get_thread_cache(elist) is not thread_cache
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_get_thread_references(django_assert_max_num_queries):
+    '''A long reference chain resolves with one query'''
+    elist = EmailListFactory.create(name='acme-references')
+    thread = ThreadFactory.create()
+    msgids = ['{:03d}@example.com'.format(n) for n in range(10)]
+    for msgid in msgids:
+        MessageFactory.create(email_list=elist, thread=thread, msgid=msgid)
+    data = SIMPLE_MESSAGE_BYTES.replace(b'Subject: This is a test', b'Subject: Re: This is a test\nReferences: ' +
+        ' '.join('<{}>'.format(n) for n in ['bogus@example.com'] + msgids).encode() +
+        b'\nIn-Reply-To: <009@example.com>')
+    mw = MessageWrapper.from_bytes(data, 'acme-references')
+    mw.email_list = elist
+    mw.thread_cache = get_thread_cache(elist)
+    mw.resolved = {}
+    with django_assert_max_num_queries(1):
+        mw._resolve_msgids([mw.headers['References'], mw.headers['In-Reply-To']])
+    assert mw.resolved['bogus@example.com'] is None
+    assert mw.resolved['000@example.com'][1] == thread.pk
+    assert mw.archive_message.thread == thread
+    assert mw.archive_message.in_reply_to.msgid == '009@example.com'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageBatch_flush_failure():
+    listname = 'acme-batch-failure'
+    EmailListFactory.create(name=listname)
+
+    def get_batch():
+        batch = MessageBatch(DedupeIndex(listname))
+        mw = MessageWrapper(bytes=SIMPLE_MESSAGE_BYTES, listname=listname, batch=batch)
+        mw.process()
+        batch.add(mw)
+        return batch, mw
+
+    batch, mw = get_batch()
+    path = get_write_path(listname, mw.hashcode)
+    if os.path.exists(path):
+        os.remove(path)
+    with patch.object(Message.objects, 'bulk_create', side_effect=Exception('database went away')):
+        with pytest.raises(Exception):
+            batch.flush()
+    # no orphan message file
+    assert find_path(listname, mw.hashcode) is None
+    assert not batch.index.has_msgid(mw.msgid)
+    assert Message.objects.filter(email_list__name=listname).count() == 0
+
+    # retry writes the file without a suffix
+    batch, mw = get_batch()
+    assert batch.flush() == 1
+    assert find_path(listname, mw.hashcode) == path
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_save_index():
+    elist = EmailListFactory.create(name='acme')
+    MessageFactory.create(email_list=elist, msgid='0000000002@example.com')
+    index = DedupeIndex('acme')
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'acme')
+    with pytest.raises(DuplicateMessage):
+        mw.save(test=True, index=index)
+    data = SIMPLE_MESSAGE_BYTES.replace(b'0000000002', b'0000000003')
+    mw = MessageWrapper.from_bytes(data, 'acme')
+    mw.save(test=True, index=index)
+    assert index.has_msgid('0000000003@example.com')
+    assert index.has_hashcode(mw.hashcode)
+
 # --------------------------------------------------
 # MessageWrapper
 # --------------------------------------------------
@@ -341,6 +553,30 @@ def test_MessageWrapper_from_bytes():
     assert isinstance(mw, MessageWrapper)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_from_bytes_headers_only():
+    # single part message is saved without parsing the body
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'acme')
+    mw.save(test=True)
+    assert mw._email_message is None
+    assert mw.archive_message.subject == 'This is a test'
+    # multipart message body is parsed for attachments
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail_multipart.1')
+    with open(path, 'rb') as f:
+        mw = MessageWrapper.from_bytes(f.read(), 'acme')
+    mw.save(test=True)
+    assert mw._email_message is not None
+    assert mw.archive_message.attachment_set.count() == 1
+
+
+def test_MessageWrapper_from_bytes_created_id():
+    data = SIMPLE_MESSAGE_BYTES.replace(b'Message-ID: <0000000002@example.com>\n', b'')
+    mw = MessageWrapper.from_bytes(data, 'acme')
+    assert mw.created_id is True
+    assert mw.headers['Message-ID'] == mw.msgid
+    assert mw.email_message['Message-ID'] == mw.msgid
+
+
 def test_MessageWrapper_from_message():
     msg = email.message_from_bytes(SIMPLE_MESSAGE_BYTES)
     mw = MessageWrapper.from_message(msg, 'acme')
@@ -9,7 +9,7 @@ from factories import EmailListFactory, ThreadFactory, MessageFactory
 from django.urls import reverse
 from django.utils.encoding import smart_str
 from django.utils.http import urlencode
-from mlarchive.archive.models import Message, Attachment, is_attachment, get_message_from_binary_file
+from mlarchive.archive.models import Message, Attachment, Thread, is_attachment, get_message_from_binary_file
 from mlarchive.utils.test_utils import message_from_file, load_message
 from mlarchive.utils.encoding import get_filename
 
@@ -301,6 +301,19 @@ def test_thread_get_snippet(client):
     assert message.thread.get_snippet()
 
 
+@pytest.mark.django_db(transaction=True)
+def test_thread_set_first(client):
+    elist = EmailListFactory.create()
+    message = MessageFactory.create(
+        email_list=elist,
+        date=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+    thread = Thread.objects.get(pk=message.thread.pk)
+    thread.email_list = elist
+    thread.set_first()
+    thread = Thread.objects.get(pk=thread.pk)
+    assert (thread.first, thread.email_list) == (message, elist)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_attachment_get_sub_message(client, attachment_messages_no_index):
     attachment = Attachment.objects.first()
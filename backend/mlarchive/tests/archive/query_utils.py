@@ -1,19 +1,24 @@
 import pytest
+from unittest.mock import patch
 
 from django.core.cache import cache
 from django.conf import settings
+from django.core.paginator import EmptyPage
 from django.http import QueryDict
 from django.test import RequestFactory
 from django.urls import reverse
 from factories import EmailListFactory
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, RequestError, TransportError
 from elasticsearch_dsl import Search
 
+from mlarchive.archive.backends.connections import get_client
 from mlarchive.archive.query_utils import (clean_queryid, generate_queryid, get_cached_query,
     get_filter_params, get_browse_equivalent, parse_query, map_sort_option, get_order_fields,
     DB_THREAD_SORT_FIELDS, IDX_THREAD_SORT_FIELDS, DEFAULT_SORT, get_count,
-    CustomPaginator)
+    get_total, run_multi_search, parse_sort_values, reverse_sort, get_result_window,
+    update_result_window, CustomPaginator)
 from mlarchive.utils.test_utils import get_request
 
 
@@ -141,3 +146,99 @@ def test_CustomPaginator(messages):
     assert page.start_index() == 1
     assert hasattr(page, '__iter__')
     assert len(page) == 10
+
+
+@pytest.mark.django_db(transaction=True)
+def test_CustomPaginator_one_request(messages, monkeypatch):
+    base = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = base.query('match', email_list='pubthree')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('count() called')
+    monkeypatch.setattr(Search, 'count', fail)
+    paginator = CustomPaginator(s, 10)
+    page = paginator.page(3)
+    # count comes from the page response
+    assert paginator.count == 21
+    assert len(page) == 1
+    assert page.has_next() is False
+    with pytest.raises(EmptyPage):
+        paginator.page(4)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_CustomPaginator_orphans(messages):
+    base = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = base.query('match', email_list='pubthree')
+    paginator = CustomPaginator(s, 10, orphans=1)
+    assert len(paginator.page(1)) == 10
+    page = paginator.page(2)
+    assert paginator.count == 21
+    assert paginator.num_pages == 2
+    assert len(page) == 11
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_multi_search(messages):
+    base = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    queries = [base.query('match', email_list='pubthree').extra(track_total_hits=True, size=0),
+               base.query('match', email_list='pubone').extra(track_total_hits=True, size=0)]
+    responses = run_multi_search(queries)
+    assert get_total(responses[0]) == 21
+    assert get_total(responses[1]) == base.query('match', email_list='pubone').count()
+    # bad query
+    with pytest.raises(RequestError):
+        run_multi_search([base.query('query_string', query='-', default_field='text')])
+    # connection errors aren't reported as a bad query
+    with patch('elasticsearch.Elasticsearch.msearch', side_effect=ESConnectionError('N/A', 'refused', None)):
+        with pytest.raises(ESConnectionError):
+            run_multi_search(queries)
+    with patch('elasticsearch.Elasticsearch.msearch', side_effect=TransportError(503, 'unavailable', None)):
+        with pytest.raises(TransportError) as excinfo:
+            run_multi_search(queries)
+        assert not isinstance(excinfo.value, RequestError)
+
+
+def test_reverse_sort():
+    sort = ['email_list', {'date': {'order': 'desc'}}, {'frm_name': 'asc'}, '_score']
+    assert reverse_sort(sort) == [
+        {'email_list': {'order': 'desc', 'missing': '_first'}},
+        {'date': {'order': 'asc', 'missing': '_first'}},
+        {'frm_name': {'order': 'desc', 'missing': '_first'}},
+        {'_score': {'order': 'asc', 'missing': '_first'}}]
+
+
+def test_parse_sort_values():
+    query = Search().sort('-date', 'django_id')
+    assert parse_sort_values('[1546300800000, 5]', query) == [1546300800000, 5]
+    assert parse_sort_values(None, query) is None
+    assert parse_sort_values('', query) is None
+    assert parse_sort_values('[1]', query) is None
+    assert parse_sort_values('{"a": 1}', query) is None
+    assert parse_sort_values('[[1], 5]', query) is None
+
+
+def test_update_result_window(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    settings.SEARCH_RESULT_WINDOW_SIZE = 5
+    queryid = generate_queryid()
+    update_result_window(queryid, [(1, [10]), (2, [20]), (3, [30])], first=True)
+    window = get_result_window(queryid)
+    assert window[1] == {'sort': [10], 'previous': None, 'next': 2}
+    assert window[3] == {'sort': [30], 'previous': 2}
+    # next page
+    update_result_window(queryid, [(4, [40]), (5, [50])], last=True)
+    window = get_result_window(queryid)
+    assert 'previous' not in window[4]
+    assert window[5]['next'] is None
+    # the neighbours of 3 and 4 are learned, the ones known are kept
+    update_result_window(queryid, [(3, None), (4, None)])
+    window = get_result_window(queryid)
+    assert window[3] == {'sort': [30], 'previous': 2, 'next': 4}
+    assert window[4] == {'sort': [40], 'previous': 3, 'next': 5}
+    assert list(window) == [1, 2, 5, 3, 4]
+    # a sixth message drops the oldest
+    update_result_window(queryid, [(6, [60])])
+    window = get_result_window(queryid)
+    assert 1 not in window
+    assert list(window) == [2, 5, 3, 4, 6]
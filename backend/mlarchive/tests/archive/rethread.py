@@ -0,0 +1,148 @@
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from factories import EmailListFactory, ThreadFactory
+from mlarchive.archive.models import Message, Thread
+from mlarchive.archive.rethread import (State, get_changes, get_state, get_threads, make_row, rethread,
+    write_changes)
+from mlarchive.archive.thread import BulkThreader, compute_thread
+from mlarchive.utils.thread_corpus import make_corpus
+from thread_ import make_thread
+
+
+def create_threads(listname, count=2, size=30):
+    '''Saves count random threads with thread order, depth and first unset.
+    Returns dictionary of expected (depth, order) by hashcode'''
+    elist = EmailListFactory.create(name=listname)
+    expected = {}
+    for seed in range(count):
+        thread = ThreadFactory.create(email_list=elist)
+        messages = sorted(make_thread(seed, size=size), key=lambda m: m.date)
+        for message in messages:
+            message.hashcode = '{}:{}'.format(elist.pk, message.hashcode.split('@')[0])
+            message.email_list = elist
+            message.thread = thread
+        Message.objects.bulk_create(messages)
+        for hashcode, info in compute_thread(thread).items():
+            expected[hashcode] = (info.depth, info.order)
+    return expected
+
+
+def get_result(listname):
+    return {m.hashcode: (m.thread_depth, m.thread_order) for m in Message.objects.filter(email_list__name=listname)}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rethread():
+    expected = create_threads('rethread')
+    messages = Message.objects.filter(email_list__name='rethread')
+    assert [len(rows) for rows in get_threads(messages)] == [30, 30]
+
+    stats, changes = rethread(messages, dryrun=True)
+    assert stats['threads'] == 2
+    assert stats['messages'] == 60
+    assert stats['moved'] == len(changes) == len([v for v in expected.values() if v != (0, 0)])
+    assert stats['fixed'] == 2
+    assert set(messages.values_list('thread_depth', 'thread_order')) == {(0, 0)}
+
+    rethread(messages)
+    assert get_result('rethread') == expected
+    assert all(not get_changes(rows) for rows in get_threads(messages))
+    for thread in Thread.objects.filter(email_list__name='rethread'):
+        first = thread.message_set.order_by('date', 'pk').first()
+        assert (thread.first, thread.date) == (first, first.date)
+        assert thread.message_count == 30
+        assert {f: getattr(thread, f) for f in Thread.SUMMARY_FIELDS} == thread.get_summary()
+    stats, changes = rethread(messages)
+    assert (stats['moved'], stats['fixed'], changes) == (0, 0, [])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_changes_skips_changed_threads():
+    create_threads('rethread-skip', count=3)
+    messages = Message.objects.filter(email_list__name='rethread-skip')
+    changes = []
+    states = {}
+    for rows in get_threads(messages):
+        changes.extend(get_changes(rows))
+        states[rows[0].thread_id] = get_state(rows)
+    first, second, third = sorted(states)
+    # a message arrives in the first thread after it was read
+    states[first] = State(states[first].pks - {min(states[first].pks)}, states[first].updated)
+    # a message of the second thread was replaced, the count is unchanged
+    pk = min(states[second].pks)
+    states[second] = State(states[second].pks - {pk} | {-pk}, states[second].updated)
+    assert write_changes(changes, states=states) == [first, second]
+    for thread_id in (first, second):
+        assert set(messages.filter(thread_id=thread_id).values_list('thread_order', flat=True)) == {0}
+    assert len(set(messages.filter(thread_id=third).values_list('thread_order', flat=True))) > 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_changes_skips_updated_threads():
+    create_threads('rethread-updated', count=1)
+    messages = Message.objects.filter(email_list__name='rethread-updated')
+    rows = next(get_threads(messages))
+    state = get_state(rows)
+    # a message of the thread is edited after it was read
+    messages.filter(pk=rows[0].pk).update(updated=timezone.now())
+    assert write_changes(get_changes(rows), states={rows[0].thread_id: state}) == [rows[0].thread_id]
+
+
+def test_make_row():
+    rows = make_corpus('mixed', 200, thread_size=40, factory=lambda hashcode, **f: make_row(pk=hashcode, **f))
+    messages = make_corpus('mixed', 200, thread_size=40, factory=Message)
+    expected = [(m, v.depth, v.order) for m, v in compute_thread(messages).items()]
+    result = [(v.message.pk, v.depth, v.order) for v in BulkThreader().compute_thread(rows)]
+    assert result == expected
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rethread_command():
+    expected = {}
+    for name in ('rethread-a', 'rethread-b', 'rethread-c'):
+        expected[name] = create_threads(name, count=1, size=20)
+
+    out = StringIO()
+    call_command('rethread', dryrun=True, verbosity=2, stdout=out)
+    lines = out.getvalue().splitlines()
+    moved = len([v for v in expected['rethread-a'].values() if v != (0, 0)])
+    assert 'rethread-a: threads:1 messages:20 moved:{} fixed:1 skipped:0'.format(moved) in ''.join(lines)
+    assert len([line for line in lines if line.startswith('rethread-a: message:')]) == moved
+    assert lines[-1].startswith('Total: threads:3 messages:60')
+    assert get_result('rethread-a') != expected['rethread-a']
+
+    call_command('rethread', resume='rethread-b', workers=2, stdout=StringIO())
+    assert get_result('rethread-a') != expected['rethread-a']
+    assert get_result('rethread-b') == expected['rethread-b']
+    assert get_result('rethread-c') == expected['rethread-c']
+
+    call_command('rethread', listname='rethread-a', rate=1000, stdout=StringIO())
+    assert get_result('rethread-a') == expected['rethread-a']
+
+    with pytest.raises(CommandError):
+        call_command('rethread', listname='rethread-none')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_check_thread_summary_command():
+    create_threads('summary', count=2, size=10)
+    threads = Thread.objects.filter(email_list__name='summary')
+    assert set(threads.values_list('message_count', flat=True)) == {0}
+
+    out = StringIO()
+    call_command('check_thread_summary', listname='summary', dryrun=True, verbosity=2, stdout=out)
+    assert 'summary: threads:2 drifted:2' in out.getvalue()
+    assert 'message_count:0->10' in out.getvalue()
+    assert set(threads.values_list('message_count', flat=True)) == {0}
+
+    call_command('check_thread_summary', listname='summary', stdout=StringIO())
+    for thread in threads:
+        assert {f: getattr(thread, f) for f in Thread.SUMMARY_FIELDS} == thread.get_summary()
+    out = StringIO()
+    call_command('check_thread_summary', listname='summary', stdout=out)
+    assert 'summary: threads:2 drifted:0' in out.getvalue()
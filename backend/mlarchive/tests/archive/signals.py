@@ -38,6 +38,51 @@ def test_message_save(client):
     assert thread.date == now
 
 
+@pytest.mark.django_db(transaction=True)
+def test_message_save_delete_thread_summary(client):
+    now = datetime.datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    public = EmailListFactory.create(name='public', private=False)
+    thread = ThreadFactory.create()
+    first = MessageFactory.create(email_list=public, date=now, thread=thread, frm='a@example.com',
+                                  subject='Topic')
+    last = MessageFactory.create(email_list=public, date=now + datetime.timedelta(hours=1),
+                                 thread=thread, frm='b@example.com', subject='Re: Topic')
+    MessageFactory.create(email_list=public, date=now + datetime.timedelta(minutes=30),
+                          thread=thread, frm='a@example.com', subject='Re: Topic')
+    thread = Thread.objects.get(pk=thread.pk)
+    assert (thread.message_count, thread.last_date, thread.participant_count, thread.subject) == (
+        3, last.date, 2, 'Topic')
+    assert thread.get_summary() == {'message_count': 3, 'last_date': last.date,
+                                    'participant_count': 2, 'subject': 'Topic'}
+
+    last.delete()
+    thread = Thread.objects.get(pk=thread.pk)
+    assert (thread.message_count, thread.last_date, thread.participant_count) == (
+        2, now + datetime.timedelta(minutes=30), 1)
+    first.delete()
+    thread = Thread.objects.get(pk=thread.pk)
+    assert thread.message_count == 1
+    assert thread.last_date == now + datetime.timedelta(minutes=30)
+    assert thread.get_summary()['message_count'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_thread_summary_concurrent_writers(client):
+    """Writers holding their own, stale, Thread instance don't lose updates"""
+    now = datetime.datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    public = EmailListFactory.create(name='public', private=False)
+    thread = ThreadFactory.create()
+    one = Thread.objects.get(pk=thread.pk)
+    two = Thread.objects.get(pk=thread.pk)
+    for n, instance in enumerate((one, two)):
+        message = MessageFactory.build(email_list=public, date=now + datetime.timedelta(minutes=n),
+                                       thread=instance, frm='{}@example.com'.format(n))
+        message.save()
+    thread = Thread.objects.get(pk=thread.pk)
+    assert (thread.message_count, thread.participant_count) == (2, 2)
+    assert thread.last_date == now + datetime.timedelta(minutes=1)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_notify_new_list(client, tmpdir, settings):
     settings.EXPORT_DIR = str(tmpdir)
@@ -0,0 +1,248 @@
+import os
+import tarfile
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+
+import pytest
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from mlarchive.archive.mail import MessageWrapper
+from mlarchive.archive.models import Message
+from mlarchive.archive.view_funcs import build_maildir_tar, build_mbox_tar
+from mlarchive.archive.storage import (FlatLayout, ShardedLayout, find_path, get_layout, get_segment_months,
+    get_segment_paths, load_segment_index, read_file, read_packed, resolve_path, split_suffix,
+    verify_segment)
+
+
+MESSAGE = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000010@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: This is a test
+
+Hello,
+
+This is a test email.
+'''
+
+
+def test_layouts():
+    hashcode = 'AbcdefghijklmnopqrstuvwxyzA='
+    assert FlatLayout().get_path('acme', hashcode) == os.path.join(settings.ARCHIVE_DIR, 'acme', hashcode)
+    assert ShardedLayout().get_path('acme', hashcode) == os.path.join(
+        settings.ARCHIVE_DIR, 'acme', 'A', 'b', hashcode)
+    assert ShardedLayout(levels=1, width=2).get_path('acme', hashcode) == os.path.join(
+        settings.ARCHIVE_DIR, 'acme', 'Ab', hashcode)
+    with pytest.raises(ValueError):
+        get_layout('bogus')
+
+
+def test_resolve_path(settings):
+    settings.ARCHIVE_LAYOUT = 'sharded'
+    hashcode = 'resolvepathhashcode01234567='
+    sharded = ShardedLayout().get_path('acme', hashcode)
+    flat = FlatLayout().get_path('acme', hashcode)
+    # missing, path in current layout
+    assert find_path('acme', hashcode) is None
+    assert resolve_path('acme', hashcode) == sharded
+    # old layout still readable
+    os.makedirs(os.path.dirname(flat), exist_ok=True)
+    with open(flat, 'w') as f:
+        f.write('test')
+    assert resolve_path('acme', hashcode) == flat
+    os.remove(flat)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_msg_sharded(settings):
+    settings.ARCHIVE_LAYOUT = 'sharded'
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-write')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    path = message.get_file_path()
+    assert path == ShardedLayout().get_path('storage-write', message.hashcode)
+    assert os.path.exists(path)
+    assert message.pymsg['Subject'] == 'This is a test'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_migrate_storage(settings):
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-migrate')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    flat = FlatLayout().get_path('storage-migrate', message.hashcode)
+    sharded = ShardedLayout().get_path('storage-migrate', message.hashcode)
+    assert os.path.exists(flat)
+
+    settings.ARCHIVE_LAYOUT = 'sharded'
+    out = StringIO()
+    call_command('migrate_storage', listname='storage-migrate', dryrun=True, stdout=out)
+    assert 'moved:1 ' in out.getvalue()
+    assert os.path.exists(flat)
+
+    call_command('migrate_storage', listname='storage-migrate', stdout=out)
+    assert not os.path.exists(flat)
+    assert os.path.exists(sharded)
+    assert message.get_file_path() == sharded
+    assert message.get_body_raw()
+
+    # nothing left to do
+    out = StringIO()
+    call_command('migrate_storage', listname='storage-migrate', stdout=out)
+    assert 'moved:0 current:1 missing:0' in out.getvalue()
+
+
+def test_split_suffix():
+    assert split_suffix('/a/b/AbcdefghijklmnopqrstuvwxyzA=.gz') == ('/a/b/AbcdefghijklmnopqrstuvwxyzA=', '.gz')
+    assert split_suffix('/a/b/AbcdefghijklmnopqrstuvwxyzA=') == ('/a/b/AbcdefghijklmnopqrstuvwxyzA=', '')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_msg_compressed(settings):
+    settings.ARCHIVE_COMPRESSION = 'gzip'
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-gzip')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    path = message.get_file_path()
+    assert path.endswith('.gz')
+    with open(path, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    # readers see original bytes
+    assert message.get_body_raw() == read_file(path)
+    assert message.get_body_raw().startswith(b'From: Joe')
+    assert message.pymsg['Subject'] == 'This is a test'
+    # still readable after setting changed
+    settings.ARCHIVE_COMPRESSION = None
+    assert message.get_file_path() == path
+
+
+@pytest.mark.django_db(transaction=True)
+def test_compress_archive(settings):
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-compress')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    flat = message.get_file_path()
+    original = message.get_body_raw()
+
+    out = StringIO()
+    call_command('compress_archive', listname='storage-compress', format='gzip', dryrun=True,
+        stdout=out, stderr=StringIO())
+    assert 'converted:1 ' in out.getvalue()
+    assert os.path.exists(flat)
+
+    call_command('compress_archive', listname='storage-compress', format='gzip',
+        stdout=StringIO(), stderr=StringIO())
+    assert not os.path.exists(flat)
+    assert message.get_file_path() == flat + '.gz'
+    assert message.get_body_raw() == original
+
+    # decompress
+    out = StringIO()
+    call_command('compress_archive', listname='storage-compress', format='none', stdout=out)
+    assert 'converted:1 ' in out.getvalue()
+    assert message.get_file_path() == flat
+    assert message.get_body_raw() == original
+
+
+@pytest.mark.django_db(transaction=True)
+def test_export_compressed(settings):
+    settings.ARCHIVE_COMPRESSION = 'gzip'
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-export')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    results = [SimpleNamespace(object=message)]
+    for func in (build_maildir_tar, build_mbox_tar):
+        fileobj = BytesIO()
+        with tarfile.open(fileobj=fileobj, mode='w:gz') as tar:
+            func(results, tar, 'export')
+        fileobj.seek(0)
+        with tarfile.open(fileobj=fileobj) as tar:
+            member = tar.getmembers()[0]
+            data = tar.extractfile(member).read()
+        # downloads contain the original message bytes
+        assert message.get_body_raw() in data
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_msg_zstd(settings):
+    pytest.importorskip('zstandard')
+    settings.ARCHIVE_COMPRESSION = 'zstd'
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-zstd')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    assert message.get_file_path().endswith('.zst')
+    assert message.pymsg['Subject'] == 'This is a test'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pack_archive():
+    mw = MessageWrapper.from_bytes(MESSAGE, 'storage-pack')
+    mw.save()
+    message = Message.objects.get(msgid='0000000010@example.com')
+    path = message.get_file_path()
+    original = message.get_body_raw()
+
+    out = StringIO()
+    call_command('pack_archive', listname='storage-pack', before='2013-11', stdout=out)
+    assert 'packed:0 ' in out.getvalue()
+    call_command('pack_archive', listname='storage-pack', before='2013-12', dryrun=True, stdout=out)
+    assert os.path.exists(path)
+
+    out = StringIO()
+    call_command('pack_archive', listname='storage-pack', before='2013-12', stdout=out)
+    assert 'packed:1 ' in out.getvalue()
+    assert not os.path.exists(path)
+    assert get_segment_months('storage-pack') == ['2013-11']
+    message = Message.objects.get(msgid='0000000010@example.com')
+    assert message.get_body_raw() == original
+    assert message.pymsg['Subject'] == 'This is a test'
+
+    # re-run is a no op
+    out = StringIO()
+    call_command('pack_archive', listname='storage-pack', before='2013-12', stdout=out)
+    assert 'packed:0 current:1 missing:0' in out.getvalue()
+
+    out = StringIO()
+    call_command('pack_archive', listname='storage-pack', verify=True, stdout=out)
+    assert 'messages:1 errors:0' in out.getvalue()
+
+    # corrupt segment
+    seg_path, _ = get_segment_paths('storage-pack', '2013-11')
+    with open(seg_path, 'r+b') as f:
+        f.write(b'X')
+    assert verify_segment('storage-pack', '2013-11') == [(message.hashcode, 'checksum mismatch')]
+    with pytest.raises(CommandError):
+        call_command('pack_archive', listname='storage-pack', verify=True, stdout=StringIO())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pack_archive_delete():
+    reply = MESSAGE.replace(b'<0000000010@example.com>',
+                            b'<0000000011@example.com>\nReferences: <0000000010@example.com>')
+    reply = reply.replace(b'17:54:55', b'18:54:55')
+    for data in (MESSAGE, reply):
+        MessageWrapper.from_bytes(data, 'storage-pack-delete').save()
+    call_command('pack_archive', listname='storage-pack-delete', before='2013-12', stdout=StringIO())
+    message = Message.objects.get(msgid='0000000010@example.com')
+    original = message.get_body_raw()
+    thread = message.thread
+    assert thread.message_count == 2
+    assert find_path('storage-pack-delete', message.hashcode) is None
+    removed_path = os.path.join(message.get_removed_dir(), message.hashcode)
+    if os.path.exists(removed_path):
+        os.remove(removed_path)
+
+    message.delete()
+    # moved out of the segment
+    assert message.hashcode not in load_segment_index('storage-pack-delete', '2013-11')
+    assert read_packed('storage-pack-delete', message.hashcode, '2013-11') is None
+    with open(removed_path, 'rb') as f:
+        assert f.read() == original
+    # thread first is reset
+    thread.refresh_from_db()
+    assert thread.first.msgid == '0000000011@example.com'
+    assert thread.message_count == 1
+    assert verify_segment('storage-pack-delete', '2013-11') == []
@@ -5,11 +5,13 @@ from io import StringIO
 
 from django.conf import settings
 from django.core.management import call_command
+from django.urls import reverse
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import Search
 from factories import EmailListFactory, ThreadFactory, MessageFactory
 
 from mlarchive.archive.models import Message
+from mlarchive.archive.backends.connections import get_client, get_client_kwargs, get_stats
 from mlarchive.archive.backends.elasticsearch import ESBackend
 
 
@@ -160,3 +162,40 @@ def test_simple():
                           msgid='a01',
                           date=datetime.datetime(2013, 1, 1, tzinfo=timezone.utc))
     assert Message.objects.all().count() == 1
+
+
+def test_get_client(settings):
+    client = get_client()
+    assert get_client() is client
+    assert ESBackend().client is client
+    settings.ELASTICSEARCH_CONNECTION = dict(settings.ELASTICSEARCH_CONNECTION, POOL_SIZE=2, TIMEOUT=5)
+    other = get_client()
+    assert other is not client
+    assert get_client() is other
+    connection = other.transport.connection_pool.connections[0]
+    assert connection.pool.pool.maxsize == 2
+    stats = get_stats()
+    assert stats['clients'] >= 2
+    assert stats['connections'] <= stats['requests']
+
+
+def test_get_client_kwargs():
+    kwargs = get_client_kwargs({'URL': 'http://localhost:9200/', 'http_auth': ('elastic', 'x'),
+                                'POOL_SIZE': 4, 'TIMEOUT': 3, 'SNIFF': True, 'KEEP_ALIVE': False,
+                                'KWARGS': {'http_compress': True}})
+    assert kwargs == {'http_auth': ('elastic', 'x'), 'maxsize': 4, 'timeout': 3,
+                      'headers': {'Connection': 'close'}, 'sniff_on_start': True,
+                      'sniff_on_connection_fail': True, 'sniffer_timeout': 60, 'http_compress': True}
+    assert get_client_kwargs({'URL': 'http://localhost:9200/'}) == {}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_reuses_client(client, settings, search_api_messages):
+    settings.ELASTICSEARCH_STATS_HEADER = True
+    url = reverse('archive_search') + '?q=data'
+    client.get(url)
+    response = client.get(url)
+    assert response.status_code == 200
+    stats = dict(item.split('=') for item in response['X-Elasticsearch-Stats'].split())
+    assert int(stats['requests']) > 0
+    assert stats['connections'] == '0'
@@ -1,4 +1,6 @@
 import datetime
+import random
+import sys
 from datetime import timezone
 from collections import namedtuple, defaultdict
 
@@ -7,8 +9,10 @@ from factories import EmailListFactory, MessageFactory, ThreadFactory
 from mlarchive.archive.thread import (Container, process, build_container,
     count_root_set, find_root, find_root_set, subject_is_reply,
     gather_subjects, prune_empty_containers, sort_thread, compute_thread,
-    gather_siblings, get_in_reply_to, get_references_or_in_reply_to)
+    gather_siblings, get_in_reply_to, get_references_or_in_reply_to, insert_message,
+    BulkThreader, MessageList, MessageQuerySet)
 from mlarchive.archive.models import Message
+from mlarchive.utils.thread_corpus import SHAPES, make_corpus
 
 
 def create_tree():
@@ -137,6 +141,21 @@ def test_container_has_descendent():
     assert not tree.c3.has_descendent(tree.c1)
 
 
+def test_compute_thread_deep():
+    '''Threads deeper than the recursion limit'''
+    start = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    references = ''
+    for n in range(sys.getrecursionlimit() + 100):
+        msgid = '{}@example.com'.format(n)
+        messages.append(Message(msgid=msgid, hashcode=msgid, date=start + datetime.timedelta(minutes=n),
+                                subject='Re: Deep', base_subject='Deep', references=references))
+        # trimmed, like mail clients do
+        references = ' '.join((references.split() + ['<{}>'.format(msgid)])[-10:])
+    info = compute_thread(messages)
+    assert [(v.depth, v.order) for v in info.values()] == [(n, n) for n in range(len(messages))]
+
+
 def test_container_has_relative():
     '''Test has_relative, finding element up or down tree'''
     tree = create_tree()
@@ -468,3 +487,165 @@ def test_subject_is_reply():
         date=datetime.datetime(2016, 1, 2, tzinfo=timezone.utc))
     assert subject_is_reply(message2)
     assert not subject_is_reply(message1)
+
+
+def make_thread(seed, size=40):
+    '''Returns list of unsaved Messages of a random thread, in arrival order.
+    Includes replies by References and In-Reply-To, references to missing
+    messages, subject only replies and out of order dates
+    '''
+    rand = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for i in range(size):
+        msgid = '{}.{}@example.com'.format(seed, i)
+        date = start + datetime.timedelta(minutes=i * 10 - (rand.randint(1, 25) if rand.random() < 0.1 else 0))
+        subject = 'Re: Topic'
+        references = in_reply_to = ''
+        kind = rand.random()
+        if not messages:
+            subject = 'Topic'
+        elif kind < 0.75:
+            parent = rand.choice(messages)
+            references = ' '.join(parent.references.split() + ['<{}>'.format(parent.msgid)])
+        elif kind < 0.85:
+            in_reply_to = '<{}>'.format(rand.choice(messages).msgid)
+        elif kind < 0.95:
+            references = '<missing.{}@example.com> <{}>'.format(i, rand.choice(messages).msgid)
+        messages.append(Message(msgid=msgid, hashcode=msgid, date=date, subject=subject,
+                                base_subject='Topic', references=references, in_reply_to_value=in_reply_to))
+    return messages
+
+
+def check_insert(messages):
+    '''Add messages to a thread one at a time, comparing insert_message(), when it
+    applies, to compute_thread().  Returns number of incremental inserts'''
+    existing = []
+    inserted = 0
+    for message in messages:
+        info = insert_message(MessageList(existing), message)
+        full = compute_thread(sorted(existing + [message], key=lambda m: m.date))
+        if info is not None:
+            inserted += 1
+            result = {m.hashcode: (m.thread_depth, m.thread_order) for m in existing}
+            result.update({k: (v.depth, v.order) for k, v in info.items()})
+            assert result == {k: (v.depth, v.order) for k, v in full.items()}
+            assert all(full[k] == v for k, v in info.items())
+        for value in full.values():
+            value.message.thread_depth = value.depth
+            value.message.thread_order = value.order
+        existing.append(message)
+    return inserted
+
+
+def test_insert_message_agrees():
+    '''insert_message() gives the same ThreadInfo as the full algorithm'''
+    inserted = sum(check_insert(make_thread(seed)) for seed in range(50))
+    # the common case is handled incrementally
+    assert inserted > 500
+
+
+def test_insert_message_fallback():
+    date = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+    root = Message(msgid='001@example.com', hashcode='001', date=date, subject='A', base_subject='A')
+    reply = Message(msgid='002@example.com', hashcode='002', date=date + datetime.timedelta(hours=1),
+                    subject='Re: A', base_subject='A', references='<001@example.com>', thread_depth=1,
+                    thread_order=1)
+    messages = MessageList([root, reply])
+    # newer reply to reply
+    new = Message(msgid='003@example.com', hashcode='003', date=date + datetime.timedelta(hours=2),
+                  references='<001@example.com> <002@example.com>')
+    info = insert_message(messages, new)
+    assert [(v.message, v.depth, v.order) for v in info.values()] == [(new, 2, 2)]
+    # older than the thread
+    new.date = date - datetime.timedelta(hours=1)
+    assert insert_message(messages, new) is None
+    # no references
+    new.date = date + datetime.timedelta(hours=2)
+    new.references = ''
+    assert insert_message(messages, new) is None
+    # reference not in thread
+    new.references = '<000@example.com> <002@example.com>'
+    assert insert_message(messages, new) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_insert_message_queryset():
+    '''MessageQuerySet gives the same result as MessageList'''
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create()
+    messages = make_thread(7, size=20)
+    for message in messages[:-1]:
+        message.email_list = elist
+        message.thread = thread
+    existing = sorted(messages[:-1], key=lambda m: m.date)
+    for value in compute_thread(existing).values():
+        value.message.thread_depth = value.depth
+        value.message.thread_order = value.order
+    Message.objects.bulk_create(existing)
+    tested = 0
+    for i, message in enumerate(existing):
+        new = Message(msgid='new.{}@example.com'.format(i), hashcode='new{}'.format(i),
+                      date=messages[-1].date + datetime.timedelta(days=1), subject='Re: reply',
+                      references=' '.join(message.references.split() + ['<{}>'.format(message.msgid)]))
+        expected = insert_message(MessageList(existing), new)
+        result = insert_message(MessageQuerySet(thread.message_set.all()), new)
+        if expected is None:
+            assert result is None
+            continue
+        tested += 1
+        assert [(v.message.pk, v.depth, v.order) for v in result.values()] == \
+            [(v.message.pk, v.depth, v.order) for v in expected.values()]
+    assert tested
+
+
+def make_messy_thread(seed, size=60):
+    '''Returns list of unsaved Messages, in date order, with several subjects,
+    duplicate message-ids, reference loops and equal dates'''
+    rand = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+    msgids = ['{}.{}@example.com'.format(seed, i) for i in range(size)]
+    messages = []
+    for i in range(size):
+        msgid = msgids[i] if rand.random() > 0.1 else rand.choice(msgids[:i + 1])
+        topic = 'Topic {}'.format(rand.randint(0, 3)) if rand.random() > 0.1 else ''
+        subject = ('Re: ' if rand.random() < 0.6 else '') + topic
+        references = ['<{}>'.format(rand.choice(msgids)) for _ in range(rand.randint(0, 4))]
+        in_reply_to = '<{}>'.format(rand.choice(msgids)) if rand.random() < 0.3 else ''
+        messages.append(Message(msgid=msgid, hashcode='{}.{}'.format(seed, i),
+                                date=start + datetime.timedelta(minutes=rand.randint(0, size // 2)),
+                                subject=subject, base_subject=topic, references=' '.join(references),
+                                in_reply_to_value=in_reply_to))
+    return sorted(messages, key=lambda m: m.date)
+
+
+def test_BulkThreader():
+    '''BulkThreader gives the same result as compute_thread()'''
+    threader = BulkThreader()
+    for seed in range(100):
+        for messages in (make_thread(seed), make_messy_thread(seed)):
+            expected = [(m, v.depth, v.order) for m, v in compute_thread(messages).items()]
+            result = [(v.message.hashcode, v.depth, v.order) for v in threader.compute_thread(messages)]
+            assert result == expected
+    assert threader.compute_thread([]) == []
+
+
+def test_thread_corpus():
+    '''Every shape of synthetic list threads every message, the same way with
+    BulkThreader and compute_thread()'''
+    threader = BulkThreader()
+    for shape in SHAPES:
+        messages = make_corpus(shape, 500, thread_size=40, factory=Message)
+        assert len(messages) == 500
+        assert [m.msgid for m in make_corpus(shape, 500, thread_size=40, factory=Message)] == \
+            [m.msgid for m in messages]
+        expected = [(m, v.depth, v.order) for m, v in compute_thread(messages).items()]
+        assert len(expected) == 500
+        result = [(v.message.hashcode, v.depth, v.order) for v in threader.compute_thread(messages)]
+        assert result == expected
+    chain = compute_thread(make_corpus('chain', 40, thread_size=40, factory=Message))
+    assert max(v.depth for v in chain.values()) == 39
+    wide = compute_thread(make_corpus('wide', 40, thread_size=40, factory=Message))
+    assert max(v.depth for v in wide.values()) == 1
+    duplicates = make_corpus('duplicate', 500, thread_size=40)
+    assert len({m['msgid'] for m in duplicates}) < 500
@@ -0,0 +1,58 @@
+import time
+
+from mlarchive.archive import timing
+from mlarchive.archive.timing import Histogram, Profile, Timings, activate
+
+
+def test_timings_nested():
+    timings = Timings()
+    with timings.stage('outer'):
+        time.sleep(0.01)
+        with timings.stage('inner'):
+            time.sleep(0.02)
+    # nested time is excluded from the outer stage
+    assert 0.01 <= timings.stages['outer'] < 0.02
+    assert timings.stages['inner'] >= 0.02
+    assert abs(timings.total - sum(timings.stages.values())) < 1e-9
+    assert set(timings.as_ms()) == {'outer', 'inner'}
+
+
+def test_stage_current():
+    # no current timings, no op
+    with timing.stage('index'):
+        pass
+    timings = Timings()
+    with activate(timings):
+        with timing.stage('index'):
+            pass
+    assert 'index' in timings.stages
+    with timing.stage('other'):
+        pass
+    assert 'other' not in timings.stages
+
+
+def test_histogram():
+    histogram = Histogram()
+    for ms in (0.05, 0.3, 3, 3, 700):
+        histogram.add(ms)
+    assert histogram.count == 5
+    assert histogram.max == 700
+    assert histogram.percentile(50) == 5
+    assert histogram.percentile(100) == 700
+    assert histogram.as_dict()['mean_ms'] == round(706.35 / 5, 3)
+
+
+def test_profile():
+    timings = Timings()
+    timings.add('parse', 0.002)
+    timings.add('save', 0.010)
+    profile = Profile()
+    profile.add_timings(timings)
+    profile.add_timings(timings)
+    total = 0 + profile + profile
+    assert total.histograms['parse'].count == 4
+    assert profile.histograms['parse'].count == 2
+    lines = total.format_table()
+    assert lines[0].startswith('stage')
+    # slowest first
+    assert lines[1].startswith('save')
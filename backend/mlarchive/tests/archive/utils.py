@@ -429,3 +429,18 @@ def test_purge_incoming(tmpdir, settings):
     assert len(os.listdir(path)) == 1
     assert os.path.exists(new_file_path)
     assert not os.path.exists(old_file_path)
+
+
+def test_purge_incoming_batch(tmpdir, settings):
+    path = str(tmpdir)
+    settings.INCOMING_DIR = path
+    batch_path = os.path.join(path, 'batch')
+    new_job_path = os.path.join(batch_path, 'new')
+    old_job_path = os.path.join(batch_path, 'old')
+    os.makedirs(new_job_path)
+    os.makedirs(old_job_path)
+    desired_mtime = time.time() - (86400 * 91)  # 91 days ago
+    os.utime(old_job_path, (desired_mtime, desired_mtime))
+    purge_incoming()
+    assert os.path.exists(new_job_path)
+    assert not os.path.exists(old_job_path)
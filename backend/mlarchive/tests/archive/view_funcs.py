@@ -4,6 +4,7 @@ import mailbox
 import os
 import pytest
 import tarfile
+from types import SimpleNamespace
 from factories import EmailListFactory, UserFactory
 
 from elasticsearch import Elasticsearch
@@ -14,7 +15,9 @@ from django.utils.encoding import smart_str
 
 from mlarchive.archive.view_funcs import (chunks, initialize_formsets, get_columns,
     get_export, get_query_neighbors, apply_objects)
-from mlarchive.archive.models import EmailList
+from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.query_utils import (generate_queryid, get_result_window, get_window_items,
+    update_result_window)
 from mlarchive.utils.test_utils import get_request
 
 from mlarchive.archive.view_funcs import get_message_index
@@ -204,6 +207,21 @@ def test_get_export_url(messages):
     assert search_response[0].object.get_absolute_url() in smart_str(response.content)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_apply_objects(messages, django_assert_num_queries):
+    pks = list(Message.objects.order_by('-date').values_list('pk', flat=True))
+    deleted = max(pks) + 1
+    hits = [SimpleNamespace(django_id=str(pk)) for pk in pks[:3] + [deleted] + pks[3:]]
+    # one query per chunk
+    with django_assert_num_queries(2):
+        results = apply_objects(hits, chunk_size=len(pks))
+    # order is kept and the deleted message dropped
+    assert [r.object.pk for r in results] == pks
+    with django_assert_num_queries(0):
+        assert results[0].object.email_list.name
+        assert results[0].object.thread.pk
+
+
 @pytest.mark.django_db(transaction=True)
 def test_get_query_neighbors(messages):
     # typical
@@ -232,3 +250,44 @@ def test_get_query_neighbors(messages):
     before, after = get_query_neighbors(search, response[0].object)
     assert before is None
     assert after is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_query_neighbors_deep(messages):
+    # messages past the first page of hits
+    search = get_search()
+    search = search.query('term', email_list='pubthree').sort('date', 'django_id')
+    pks = [m.pk for m in Message.objects.filter(email_list__name='pubthree').order_by('date', 'pk')]
+    message = Message.objects.get(pk=pks[15])
+    before, after = get_query_neighbors(search, message)
+    assert before.pk == pks[14]
+    assert after.pk == pks[16]
+    message = Message.objects.get(pk=pks[-1])
+    before, after = get_query_neighbors(search, message)
+    assert before.pk == pks[-2]
+    assert after is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_query_neighbors_result_window(messages, settings, monkeypatch):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    search = get_search()
+    search = search.query('term', email_list='pubthree').sort('date', 'django_id')
+    pks = [m.pk for m in Message.objects.filter(email_list__name='pubthree').order_by('date', 'pk')]
+    queryid = generate_queryid()
+    update_result_window(queryid, get_window_items(search[:10].execute()), first=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('search executed')
+    monkeypatch.setattr(Search, 'execute', fail)
+    before, after = get_query_neighbors(search, Message.objects.get(pk=pks[5]), queryid=queryid)
+    assert before.pk == pks[4]
+    assert after.pk == pks[6]
+    before, after = get_query_neighbors(search, Message.objects.get(pk=pks[0]), queryid=queryid)
+    assert before is None
+    assert after.pk == pks[1]
+    monkeypatch.undo()
+    # the end of the window is found with search_after, then cached
+    before, after = get_query_neighbors(search, Message.objects.get(pk=pks[9]), queryid=queryid)
+    assert after.pk == pks[10]
+    assert get_result_window(queryid)[pks[9]]['next'] == pks[10]
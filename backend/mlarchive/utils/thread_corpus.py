@@ -0,0 +1,100 @@
+'''Synthetic mailing lists for testing and benchmarking the threading algorithm,
+archive/thread.py.  See make_corpus() and bin/benchmark_thread.py.
+
+A corpus is a list of threads of one shape:
+
+chain       each reply references the message before it, the deepest threads
+wide        every reply references the first message, flat threads
+missing     replies reference a random earlier message, some messages are left
+            out of the list so others reference messages that don't exist
+duplicate   as missing, but some messages reuse the Message-ID of an earlier one,
+            the "Bogus-id" path of build_container()
+loop        as missing, but some messages reference the message after them, which
+            replies to them, so References form loops
+subject     replies have no References or In-Reply-To, only a "Re:" subject
+mixed       each reply picks one of the above at random, some use In-Reply-To only
+
+The same shape, count, thread_size and seed always give the same corpus.
+'''
+
+import datetime
+import random
+from datetime import timezone
+
+SHAPES = ('chain', 'wide', 'missing', 'duplicate', 'loop', 'subject', 'mixed')
+START = datetime.datetime(2000, 1, 1, tzinfo=timezone.utc)
+MAX_REFERENCES = 20     # mail clients trim long References headers
+ODDITY_RATE = 0.1       # fraction of messages missing, duplicate or in a loop
+
+
+def get_references(parent):
+    references = parent['references'].split() + ['<{}>'.format(parent['msgid'])]
+    if len(references) > MAX_REFERENCES:
+        references = references[:1] + references[-MAX_REFERENCES + 1:]
+    return references
+
+
+def make_thread(shape, number, size, rand):
+    '''Returns list of field dictionaries for the messages of thread number, in
+    date order.  Messages left out of the list may still be referenced
+    '''
+    topic = 'Topic {}'.format(number)
+    start = START + datetime.timedelta(minutes=number * size)
+    messages = []
+    loop_parent = None
+    for i in range(size):
+        fields = {'msgid': '{}.{}@corpus'.format(number, i),
+                  'hashcode': '{}.{}='.format(number, i),
+                  'date': start + datetime.timedelta(minutes=i),
+                  'subject': 'Re: ' + topic if i else topic,
+                  'base_subject': topic,
+                  'references': '',
+                  'in_reply_to_value': ''}
+        messages.append(fields)
+        if not i:
+            continue
+        kind = shape
+        if shape == 'mixed':
+            kind = rand.choice(SHAPES[:-1] + ('in_reply_to',))
+        if kind == 'chain':
+            references = get_references(messages[i - 1])
+        elif kind == 'wide':
+            references = get_references(messages[0])
+        elif kind == 'subject':
+            references = []
+        elif kind == 'in_reply_to':
+            references = []
+            fields['in_reply_to_value'] = '<{}>'.format(rand.choice(messages[:i])['msgid'])
+        elif loop_parent is not None:
+            references = get_references(loop_parent)
+        else:
+            references = get_references(rand.choice(messages[:i]))
+        loop_parent = None
+        if kind == 'duplicate' and rand.random() < ODDITY_RATE:
+            fields['msgid'] = rand.choice(messages[:i])['msgid']
+        elif kind == 'loop' and i < size - 1 and rand.random() < ODDITY_RATE:
+            # reference the next message, which replies to this one
+            references.insert(0, '<{}.{}@corpus>'.format(number, i + 1))
+            loop_parent = fields
+        fields['references'] = ' '.join(references)
+
+    if shape in ('missing', 'duplicate', 'loop', 'mixed'):
+        return messages[:1] + [m for m in messages[1:] if rand.random() >= ODDITY_RATE]
+    return messages
+
+
+def make_corpus(shape, count, thread_size=100, seed=0, factory=dict):
+    '''Returns list of count messages, in date order, threads of up to thread_size
+    messages of shape, one of SHAPES.  Each message is factory(**fields), where
+    fields are msgid, hashcode, date, subject, base_subject, references and
+    in_reply_to_value, ie. factory=Message for unsaved Messages
+    '''
+    if shape not in SHAPES:
+        raise ValueError('Unknown shape: {}'.format(shape))
+    rand = random.Random(seed)
+    messages = []
+    number = 0
+    while len(messages) < count:
+        messages.extend(make_thread(shape, number, thread_size, rand))
+        number += 1
+    return [factory(**fields) for fields in messages[:count]]